@@ -0,0 +1,131 @@
+import numpy as np
+from solver import PressureFieldSummary, consumption_coefficient, get_blood_o2_concentration_value, \
+    get_extraction_factor, get_grid_size, get_initial_profile, get_o2_concentration_table, get_radial_coefficients, \
+    integrate, solve_radial_slices
+from units import get_units
+
+
+units = get_units()
+
+
+def integrate_batch(params_list, newton_tol=1e-6, newton_max_iterations=50, max_newton_step=20.0):
+    """ Integrates several Krogh cylinders together, advancing all of them along the capillary in one pass.
+
+    Each entry of params_list holds the arguments for integrate.  At every z-step the radial problems of all the
+    parameter sets are solved together: the radial Krogh ODE is discretised with central differences, as in the
+    Newton engine, and the tridiagonal systems of all the sets are stacked into one banded system for each Newton
+    iteration.  Sets with fewer radial nodes are padded, and sets with fewer z-steps stop contributing to their
+    results once they reach the end of their capillary.
+
+    Returns a list with the results for each parameter set, in the same format as integrate.
+    """
+    np.seterr(all='raise')
+
+    results_list = [None] * len(params_list)
+
+    # Test runs don't need solving, runs that choose their own resolution are solved one grid at a time, and runs
+    # with sensitivities need the linearisation that integrate adds to the solve.
+    batch = []
+    for i, params in enumerate(params_list):
+        if params.get("test", False) or params.get("resolution_tol") is not None or params.get("sensitivities"):
+            results_list[i] = integrate(**params)
+        else:
+            batch.append(i)
+
+    if len(batch) == 0:
+        return results_list
+
+    n = len(batch)
+    sets = [params_list[i] for i in batch]
+
+    grid_sizes = [get_grid_size(params["r_steps"], params["z_steps"], params["r_Krogh"]) for params in sets]
+    r_steps = np.array([size[0] for size in grid_sizes])
+    z_steps = np.array([size[1] for size in grid_sizes])
+    max_r_steps = np.max(r_steps)
+
+    kappa_max = np.array([consumption_coefficient(params["CMRO2"], params["D"], params["sigma"]) for params in sets])
+    extraction_factors = np.zeros(n)
+    sigma_values = np.zeros(n)
+    Hb_values = np.zeros(n)
+    tables = []
+    summaries = []
+    fields = []
+
+    # Coefficients of the discretised radial equations of each set, from get_radial_coefficients.  Nodes past the
+    # end of a set's radial grid just have P_j = 0.
+    lower = np.zeros((n, max_r_steps))
+    diagonal = np.ones((n, max_r_steps))
+    upper = np.zeros((n, max_r_steps))
+    consumption = np.zeros((n, max_r_steps))
+    P = np.zeros((n, max_r_steps))
+
+    for s, params in enumerate(sets):
+        nr = r_steps[s]
+        r_capillary = params["r_capillary"]
+        r_Krogh = params["r_Krogh"]
+        dr = (r_Krogh - r_capillary) / nr
+        dz = params["z_capillary"] / z_steps[s]
+
+        r = np.linspace(r_capillary.to(units.um).magnitude, r_Krogh.to(units.um).magnitude, nr)
+        lower[s, :nr], diagonal[s, :nr], upper[s, :nr], consumption[s, :nr] = get_radial_coefficients(r, kappa_max[s])
+
+        extraction_factors[s] = get_extraction_factor(params["D"], params["sigma"], r_capillary, params["velocity"],
+                                                      dr, dz)
+        sigma_values[s] = params["sigma"].to(units.mlO2 / units.dL / units.mmHg).magnitude
+        Hb_values[s] = params["Hb"].to(units.g / units.dL).magnitude
+        tables.append(get_o2_concentration_table(params["sigma"], params["Hb"]))
+        summaries.append(PressureFieldSummary(nr, r_capillary, dr, dz))
+        fields.append(np.zeros((z_steps[s], nr)) if params.get("store_pressure_field", False) else None)
+
+        P[s, :nr] = np.maximum(0, params["paO2"].to(units.mmHg).magnitude + get_initial_profile(kappa_max[s], r))
+
+    # Sets that share an O2 concentration table can do their lookups together.
+    table_groups = {}
+    for s, table in enumerate(tables):
+        table_groups.setdefault(id(table), (table, []))[1].append(s)
+
+    wall_pressure = np.array([params["paO2"].to(units.mmHg).magnitude for params in sets], dtype=float)
+    newton_iterations = np.zeros(n, dtype=int)
+    set_indices = np.arange(n)
+
+    for z in range(np.max(z_steps)):
+        active = z < z_steps
+
+        # Move the previous profile to the new wall pressure as the initial guess.
+        P[:, 0] = wall_pressure
+        P, iterations, max_step = solve_radial_slices(P, wall_pressure, lower, diagonal, upper, consumption,
+                                                      active=active, newton_tol=newton_tol,
+                                                      newton_max_iterations=newton_max_iterations,
+                                                      max_newton_step=max_newton_step)
+        newton_iterations += active * iterations
+        for s in set_indices[active & (max_step >= newton_tol)]:
+            print("[{}] Newton solver warning: no convergence at step {} after {} iterations"
+                  .format(sets[s].get("job_number", 0), z, newton_max_iterations))
+
+        p_slices = np.maximum(0, P)
+
+        # Capillary mass balance for all the sets at once.
+        o2_concentration_remaining = (get_blood_o2_concentration_value(p_slices[:, 0], sigma_values, Hb_values)
+                                      - extraction_factors * (p_slices[:, 0] - p_slices[:, 1]))
+
+        for s in set_indices[active]:
+            p_slice = p_slices[s, :r_steps[s]]
+            summaries[s].add_slice(p_slice)
+            if fields[s] is not None:
+                fields[s][z, :] = p_slice
+
+            params = sets[s]
+            if z % params.get("report_interval", 10) == 0:
+                print("[{}] step {}, pa: {}, pb: {}".format(params.get("job_number", 0), z, p_slice[0] * units.mmHg,
+                                                            p_slice[-1] * units.mmHg))
+
+        for table, group in table_groups.values():
+            wall_pressure[group] = table.get_blood_o2_pressure_value(o2_concentration_remaining[group])
+
+    for s, params in enumerate(sets):
+        results = summaries[s].get_results(params["paO2"], params["sigma"], params["Hb"])
+        results["p"] = fields[s] * units.mmHg if fields[s] is not None else None
+        results["newton_iterations"] = int(newton_iterations[s])
+        results_list[batch[s]] = results
+
+    return results_list
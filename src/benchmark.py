@@ -0,0 +1,210 @@
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+from evaluate import SEARCHES, evaluate_point, evaluate_points, search
+from parameters import *
+from solver import O2ConcentrationTable, integrate
+from units import get_units
+
+
+# The parameter files whose grid sizes the integrate benchmarks use.
+CONFIG_FILES = ["basic_params.json", "2018-06-02.json", "2018-06-04.json"]
+
+# Relative slowdown against the previous run that is reported as a regression.
+REGRESSION_THRESHOLD = 0.1
+
+
+def get_benchmark_params(file_name, quick=False):
+    """ Returns the first grid point of a parameter file, set up for timing: no test mode or progress output.
+
+    With quick, the step counts are divided by 4.
+    """
+    params = create_param_grid(Parameters(load_param_values(file_name)))[0]
+    params["test"] = False
+    params["report_interval"] = 10 ** 9
+    params["job_number"] = 0
+    if quick:
+        params["r_steps"] = max(3, params["r_steps"] // 4)
+        params["z_steps"] = max(1, params["z_steps"] // 4)
+    return params
+
+
+def time_call(function, repeats=1):
+    """ Returns the shortest time in seconds of repeats calls to function, and the result of the last one. """
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchmark_integrate(quick):
+    timings = {}
+    for file_name in CONFIG_FILES:
+        params = get_benchmark_params(file_name, quick)
+        timings["integrate[{}]".format(file_name)], _ = time_call(lambda: integrate(**params))
+    return timings
+
+
+def benchmark_table(quick):
+    units = get_units()
+    sigma = 3.1e-5 * units.mlO2 / units.ml / units.mmHg
+    Hb = 10 * units.g / units.dL
+
+    build_time, table = time_call(lambda: O2ConcentrationTable(sigma, Hb), repeats=3)
+
+    concentrations = np.linspace(0, table.table[-1], 100000)
+    array_lookup_time, _ = time_call(lambda: table.get_blood_o2_pressure_value(concentrations), repeats=5)
+
+    scalar_concentrations = concentrations[::100]
+    scalar_lookup_time, _ = time_call(
+        lambda: [table.get_blood_o2_pressure_value(c) for c in scalar_concentrations], repeats=5)
+
+    return {
+        "table_build": build_time,
+        "table_lookup[100000 array]": array_lookup_time,
+        "table_lookup[1000 scalar]": scalar_lookup_time,
+    }
+
+
+def benchmark_search(quick):
+    params = get_benchmark_params(CONFIG_FILES[0], quick)
+    base_results = integrate(**params)
+    timings = {}
+    for prefix, name, step in SEARCHES[:1]:
+        timings["search[{}]".format(name)], _ = time_call(lambda: search(params, name, step, base_results))
+    return timings
+
+
+def benchmark_evaluate_point(quick):
+    params = get_benchmark_params(CONFIG_FILES[0], quick)
+    no_search_params = params.copy()
+    no_search_params["no_search"] = True
+    return {
+        "evaluate_point[no_search]": time_call(lambda: evaluate_point(no_search_params))[0],
+        "evaluate_point": time_call(lambda: evaluate_point(params))[0],
+    }
+
+
+def benchmark_evaluate_points(quick):
+    params = get_benchmark_params(CONFIG_FILES[0], quick)
+    params["no_search"] = True
+
+    # One point for each core, with a slightly different CMRO2 so that no two are the same.
+    max_cores = multiprocessing.cpu_count()
+    params_list = []
+    for i in range(max_cores):
+        point_params = params.copy()
+        point_params["CMRO2"] = params["CMRO2"] * (1 + 0.01 * i)
+        params_list.append(point_params)
+
+    timings = {}
+    num_cores = 1
+    while True:
+        timings["evaluate_points[{} cores]".format(num_cores)], _ = time_call(
+            lambda: evaluate_points([point_params.copy() for point_params in params_list], num_cores=num_cores))
+        if num_cores == max_cores:
+            break
+        num_cores = min(2 * num_cores, max_cores)
+    return timings
+
+
+BENCHMARKS = {
+    "integrate": benchmark_integrate,
+    "table": benchmark_table,
+    "search": benchmark_search,
+    "evaluate_point": benchmark_evaluate_point,
+    "evaluate_points": benchmark_evaluate_points,
+}
+
+
+def get_commit():
+    """ Returns the current git commit, and whether there are uncommitted changes, or (None, None) outside git. """
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+        status = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"],
+                                         stderr=subprocess.DEVNULL).decode()
+        return commit, len(status.strip()) > 0
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def load_history(file_name):
+    if not os.path.exists(file_name):
+        return []
+    with open(file_name, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def append_history(file_name, entry):
+    with open(file_name, 'a') as f:
+        f.write(json.dumps(entry, sort_keys=True) + "\n")
+
+
+def compare_runs(previous, current):
+    """ Prints the change in each timing from the previous run to the current one, marking regressions. """
+    print("Compared with commit {} at {}:".format(previous["commit"], previous["time"]))
+    for name, seconds in sorted(current["timings"].items()):
+        if name not in previous["timings"]:
+            print("  {}: {:.4f}s (new)".format(name, seconds))
+            continue
+        previous_seconds = previous["timings"][name]
+        change = seconds / previous_seconds - 1 if previous_seconds > 0 else 0.0
+        marker = "  REGRESSION" if change > REGRESSION_THRESHOLD else ""
+        print("  {}: {:.4f}s, was {:.4f}s ({:+.1f}%){}".format(name, seconds, previous_seconds, 100 * change,
+                                                               marker))
+
+
+if __name__ == "__main__":
+    # Usage: python benchmark.py [--quick] [--history=FILE] [BENCHMARK ...]
+    # Each run is appended to the history file and compared with the last run on the same machine and settings.
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    quick = "--quick" in sys.argv[1:]
+    history_file_name = "benchmark_history.jsonl"
+    for arg in sys.argv[1:]:
+        if arg.startswith("--history="):
+            history_file_name = arg[len("--history="):]
+
+    names = args if len(args) > 0 else list(BENCHMARKS.keys())
+    for name in names:
+        if name not in BENCHMARKS:
+            print("Unknown benchmark: {}.  The benchmarks are: {}".format(name, ", ".join(BENCHMARKS.keys())))
+            sys.exit(1)
+
+    timings = {}
+    for name in names:
+        print("Running {} benchmarks...".format(name))
+        timings.update(BENCHMARKS[name](quick))
+
+    commit, is_dirty = get_commit()
+    entry = {
+        "time": datetime.datetime.now().isoformat(),
+        "commit": commit,
+        "dirty": is_dirty,
+        "machine": platform.node(),
+        "python": platform.python_version(),
+        "cpu_count": multiprocessing.cpu_count(),
+        "quick": quick,
+        "timings": timings,
+    }
+
+    print()
+    for name, seconds in sorted(timings.items()):
+        print("{}: {:.4f}s".format(name, seconds))
+    print()
+
+    previous_runs = [run for run in load_history(history_file_name)
+                     if run["machine"] == entry["machine"] and run["quick"] == quick]
+    if previous_runs:
+        compare_runs(previous_runs[-1], entry)
+
+    append_history(history_file_name, entry)
+    print("Saved to '{}'.".format(history_file_name))
@@ -0,0 +1,195 @@
+import math
+import numpy as np
+from solver import consumption_coefficient, get_extraction_factor, get_grid_size, get_initial_profile, \
+    get_o2_concentration_table, get_radial_coefficients, summarise_pressure_field
+from units import get_units
+
+# Numba is optional.  Without it the kernels below still run as plain Python, which is far too slow for real use,
+# and integrate falls back to the march engine for engine="compiled".
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+units = get_units()
+
+
+def _compile(function):
+    if numba is None:
+        return function
+    return numba.njit(cache=True)(function)
+
+
+def is_available():
+    return numba is not None
+
+
+@_compile
+def _concentration(pp, sigma_value, Hb_value):
+    # get_blood_o2_concentration_value for one plain pressure.
+    a1 = -8.5322289e3
+    a2 = 2.121301e3
+    a3 = -6.7073989e1
+    a4 = 9.3596087e5
+    a5 = -3.1346258e4
+    a6 = 2.3961674e3
+    a7 = -6.7104406e1
+    saturation = 100 * (a1 * pp + a2 * pp ** 2 + a3 * pp ** 3 + pp ** 4) / (
+        a4 + a5 * pp + a6 * pp ** 2 + a7 * pp ** 3 + pp ** 4)
+    return 1.34 * Hb_value * 0.01 * saturation + sigma_value * pp
+
+
+@_compile
+def _sigmoid(x):
+    # solver.sigmoid for one value.
+    if x > 10.0:
+        return 1.0
+    if x < -10.0:
+        return 0.0
+    return 1.0 / (1.0 + math.exp(-x))
+
+
+@_compile
+def _radial_residual(P, F, wall_pressure, lower, upper, consumption):
+    # The residual of the discretised radial equations of solver.get_radial_coefficients into F.  Returns its norm.
+    n = len(P)
+    F[0] = P[0] - wall_pressure
+    for j in range(1, n - 1):
+        F[j] = lower[j] * P[j - 1] - 2.0 * P[j] + upper[j] * P[j + 1] - consumption * _sigmoid(10.0 * P[j] - 10.0)
+    F[n - 1] = lower[n - 1] * P[n - 2] - 2.0 * P[n - 1] - consumption * _sigmoid(10.0 * P[n - 1] - 10.0)
+    norm = 0.0
+    for j in range(n):
+        norm += F[j] ** 2
+    return math.sqrt(norm)
+
+
+@_compile
+def _solve_slice(P, wall_pressure, lower, upper, consumption, newton_tol, newton_max_iterations, max_newton_step):
+    # Solves the radial equations for one slice by Newton's method in place, starting from P with its wall pressure
+    # replaced.  Each Newton step is a tridiagonal solve with the Thomas algorithm, damped and backtracked as in the
+    # batch engine.  Returns the number of iterations, or minus that if it didn't converge.
+    n = len(P)
+    F = np.empty(n)
+    F_next = np.empty(n)
+    P_next = np.empty(n)
+    step = np.empty(n)
+    diagonal = np.empty(n)
+    c_prime = np.empty(n)
+
+    P[0] = wall_pressure
+    norm = _radial_residual(P, F, wall_pressure, lower, upper, consumption)
+
+    for iteration in range(1, newton_max_iterations + 1):
+        # Diagonal of the Jacobian.
+        diagonal[0] = 1.0
+        for j in range(1, n):
+            s = _sigmoid(10.0 * P[j] - 10.0)
+            diagonal[j] = -2.0 - consumption * 10.0 * s * (1.0 - s)
+
+        # Thomas algorithm for J step = -F.  The wall row has no upper coefficient.
+        c_prime[0] = 0.0
+        step[0] = -F[0] / diagonal[0]
+        for j in range(1, n):
+            denominator = diagonal[j] - lower[j] * c_prime[j - 1]
+            c_prime[j] = upper[j] / denominator
+            step[j] = (-F[j] - lower[j] * step[j - 1]) / denominator
+        for j in range(n - 2, -1, -1):
+            step[j] -= c_prime[j] * step[j + 1]
+
+        max_step = 0.0
+        for j in range(n):
+            max_step = max(max_step, abs(step[j]))
+        scale = 1.0
+        if max_step > max_newton_step:
+            scale = max_newton_step / max_step
+
+        alpha = scale
+        for _ in range(20):
+            for j in range(n):
+                P_next[j] = P[j] + alpha * step[j]
+            next_norm = _radial_residual(P_next, F_next, wall_pressure, lower, upper, consumption)
+            if next_norm <= (1 - 1e-4 * alpha) * norm:
+                break
+            alpha *= 0.5
+
+        for j in range(n):
+            P[j] = P_next[j]
+            F[j] = F_next[j]
+        norm = next_norm
+
+        if max_step < newton_tol:
+            return iteration
+
+    return -newton_max_iterations
+
+
+@_compile
+def _march(P, field, paO2_value, lower, upper, consumption, extraction_factor, sigma_value, Hb_value,
+           branch_concentrations, branch_pressures, newton_tol, newton_max_iterations, max_newton_step):
+    # Marches along the capillary, solving each slice in turn and moving the wall pressure on by the capillary mass
+    # balance, as the batch engine does.  Fills field with the pressures of each slice, floored at zero, and returns
+    # the Newton iterations for each slice, negative where they didn't converge.
+    z_steps = field.shape[0]
+    slice_iterations = np.zeros(z_steps, dtype=np.int64)
+    wall_pressure = paO2_value
+    for z in range(z_steps):
+        slice_iterations[z] = _solve_slice(P, wall_pressure, lower, upper, consumption, newton_tol,
+                                           newton_max_iterations, max_newton_step)
+        for j in range(len(P)):
+            field[z, j] = max(0.0, P[j])
+
+        concentration = (_concentration(field[z, 0], sigma_value, Hb_value)
+                         - extraction_factor * (field[z, 0] - field[z, 1]))
+        if concentration <= 0:
+            wall_pressure = 0.0
+        else:
+            wall_pressure = np.interp(concentration, branch_concentrations, branch_pressures)
+
+    return slice_iterations
+
+
+def integrate_compiled(CMRO2, z_capillary, velocity, D, r_Krogh, r_capillary, paO2, Hb, sigma, r_steps, z_steps,
+                       job_number=0, newton_tol=1e-6, newton_max_iterations=50, max_newton_step=20.0,
+                       store_pressure_field=False, **kwargs):
+    """ Integrates one Krogh cylinder with the z-march in a single compiled loop.
+
+    The equations are those of the batch engine: the radial Krogh ODE is discretised with central differences and
+    solved by Newton's method on each slice, and the wall pressure of the next slice comes from the capillary mass
+    balance and the O2 concentration table.  The loop is compiled with Numba if it is installed (see is_available),
+    and otherwise runs as plain Python.
+    """
+    r_steps, z_steps = get_grid_size(r_steps, z_steps, r_Krogh)
+
+    dr = (r_Krogh - r_capillary) / r_steps
+    dz = z_capillary / z_steps
+
+    r = np.linspace(r_capillary.to(units.um).magnitude, r_Krogh.to(units.um).magnitude, r_steps)
+    h = r[1] - r[0]
+    kappa_max = consumption_coefficient(CMRO2, D, sigma)
+
+    lower, _, upper, _ = get_radial_coefficients(r, kappa_max)
+
+    extraction_factor = get_extraction_factor(D, sigma, r_capillary, velocity, dr, dz)
+    table = get_o2_concentration_table(sigma, Hb)
+    paO2_value = paO2.to(units.mmHg).magnitude
+
+    P = np.maximum(0, paO2_value + get_initial_profile(kappa_max, r))
+    field = np.zeros((z_steps, r_steps))
+
+    slice_iterations = _march(P, field, paO2_value, lower, upper, h ** 2 * kappa_max, extraction_factor,
+                              sigma.to(units.mlO2 / units.dL / units.mmHg).magnitude,
+                              Hb.to(units.g / units.dL).magnitude, table._branch_concentrations,
+                              table._branch_pressures, newton_tol, newton_max_iterations, max_newton_step)
+
+    failed_slices = np.flatnonzero(slice_iterations < 0)
+    if len(failed_slices) > 0:
+        print("[{}] Newton solver warning: no convergence on {} slices, starting at step {}"
+              .format(job_number, len(failed_slices), failed_slices[0]))
+
+    results = summarise_pressure_field(field * units.mmHg, paO2, sigma, Hb, r_capillary, dr, dz)
+    if not store_pressure_field:
+        results["p"] = None
+    results["newton_iterations"] = int(np.sum(np.abs(slice_iterations)))
+    return results
+
@@ -0,0 +1,132 @@
+import numpy as np
+from parameters import get_plain_values
+from result_cache import cached_integrate, get_cache_stats
+
+
+# Solves that started from the analytic or default initial guesses, and ones seeded from an earlier solve, with the
+# solver iterations that they took.  Stats from worker processes are added with add_continuation_stats.
+_stats = {
+    "cold_solves": 0,
+    "cold_iterations": 0,
+    "seeded_solves": 0,
+    "seeded_iterations": 0,
+}
+
+
+def get_solver_iterations(results):
+    # Newton iterations for the Newton and batch engines, and BVP iterations for the march engine.
+    if "newton_iterations" in results:
+        return results["newton_iterations"]
+    return results.get("bvp_iterations", 0)
+
+
+def seeded_integrate(params, seed_results=None):
+    """ Calls cached_integrate(**params), starting the solver from the pressure field in seed_results if it has one.
+
+    The returned results keep the pressure field of a fresh solve even if params doesn't ask for it, so that they
+    can seed the next solve.  Results that come from the cache are returned as they are.
+    """
+    params = dict(params, keep_solved_pressure_field=True)
+    is_seeded = seed_results is not None and seed_results.get("p") is not None
+    if is_seeded:
+        params["initial_field"] = seed_results["p"].to("mmHg").magnitude
+
+    hits = get_cache_stats()["hits"]
+    results = cached_integrate(**params)
+    if get_cache_stats()["hits"] == hits and not params.get("test", False):
+        kind = "seeded" if is_seeded else "cold"
+        _stats[kind + "_solves"] += 1
+        _stats[kind + "_iterations"] += get_solver_iterations(results)
+
+    return results
+
+
+def strip_pressure_field(results, params):
+    """ Returns results without the pressure field that seeded_integrate kept, unless params asked for it. """
+    if params.get("store_pressure_field", False) or results.get("p") is None:
+        return results
+    results = dict(results)
+    results["p"] = None
+    return results
+
+
+def integrate_chain(params_list, keep_pressure_fields=None):
+    """ Solves each parameter set in params_list in turn, seeding each solve from the one before it.
+
+    Returns a list with the results for each parameter set.  The pressure fields that seeded_integrate kept are left
+    out, except for the parameter sets whose flag in keep_pressure_fields is set, so that their results can seed
+    later solves, such as the searches from a base point.
+    """
+    results_list = []
+    previous_results = None
+    for i, params in enumerate(params_list):
+        results = seeded_integrate(params, previous_results)
+        if results.get("p") is not None:
+            previous_results = results
+        if keep_pressure_fields is None or not keep_pressure_fields[i]:
+            results = strip_pressure_field(results, params)
+        results_list.append(results)
+    return results_list
+
+
+def order_by_nearest_neighbour(params_list):
+    """ Returns the indices of params_list in an order that visits similar parameter sets one after another.
+
+    The numeric parameters that vary are scaled to the range [0, 1], on a log scale where they are all positive,
+    and the path is built by always moving to the nearest parameter set that hasn't been visited yet.
+    """
+    if len(params_list) == 0:
+        return []
+
+    plain_values = [get_plain_values(params) for params in params_list]
+    names = sorted(set.intersection(*[set(values.keys()) for values in plain_values]))
+
+    columns = []
+    for name in names:
+        column = [values[name] for values in plain_values]
+        if any(isinstance(value, (bool, str)) or not np.isscalar(value) for value in column):
+            continue
+        column = np.array(column, dtype=float)
+        if np.all(column > 0):
+            column = np.log(column)
+        value_range = np.max(column) - np.min(column)
+        if value_range > 0:
+            columns.append((column - np.min(column)) / value_range)
+
+    if len(columns) == 0:
+        return list(range(len(params_list)))
+
+    points = np.array(columns).T
+    order = [0]
+    is_visited = np.zeros(len(points), dtype=bool)
+    is_visited[0] = True
+    for _ in range(len(points) - 1):
+        distances = np.sum((points - points[order[-1]]) ** 2, axis=1)
+        distances[is_visited] = np.inf
+        nearest = int(np.argmin(distances))
+        order.append(nearest)
+        is_visited[nearest] = True
+
+    return order
+
+
+def get_continuation_stats():
+    return dict(_stats)
+
+
+def add_continuation_stats(stats):
+    for name, value in stats.items():
+        _stats[name] += value
+
+
+def print_continuation_stats():
+    cold_solves = _stats["cold_solves"]
+    seeded_solves = _stats["seeded_solves"]
+    if cold_solves == 0 or seeded_solves == 0:
+        return
+
+    cold_average = _stats["cold_iterations"] / cold_solves
+    seeded_average = _stats["seeded_iterations"] / seeded_solves
+    print("Continuation: {} seeded solves took {:.1f} iterations on average, against {:.1f} for {} cold solves "
+          "(about {:.0f} iterations saved).".format(seeded_solves, seeded_average, cold_average, cold_solves,
+                                                   (cold_average - seeded_average) * seeded_solves))
@@ -1,11 +1,28 @@
+import json
+import os
 import pickle
 import csv
+import sys
+import tempfile
+import numpy as np
+from parameters import get_params_hash
+from units import get_units
 
 
 def save_results(file_name, results):
-    with open(file_name, 'wb') as f:
-        # Pickle the 'data' dictionary using the highest protocol available.
-        pickle.dump(results, f, pickle.HIGHEST_PROTOCOL)
+    # Write to a temporary file and move it into place, so that a crash or another process reading the file never
+    # sees a partly written file.
+    fd, temp_file_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_name)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            # Pickle the 'data' dictionary using the highest protocol available.
+            pickle.dump(results, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file_name, file_name)
+    except BaseException:
+        os.remove(temp_file_name)
+        raise
 
 
 def load_results(file_name):
@@ -20,37 +37,38 @@ def save_pressure_matrix(file_name, pressure_matrix):
             w.writerow([i] + list(p))
 
 
-def export_csv(file_name, results):
-    fields = {
-        "CMRO2": "params.CMRO2",
-        "z_cap": "params.z_capillary",
-        "vel": "params.velocity",
-        "D": "params.D",
-        "r_Krogh": "params.r_Krogh",
-        "r_cap": "params.r_capillary",
-        "paO2": "params.paO2",
-        "Hb": "params.Hb",
-        "pbO2": "base_results.pbO2",
-        "jvO2_sat": "base_results.jugular_venous_o2_sat",
-        "hf": "base_results.hypoxic_fraction",
-        "ratio_pbO2_paO2": "ratio_pbO2_paO2",
-        "paO2up_hf": "paO2up_hf",
-        "ratio_pbO2_vel": "ratio_pbO2_vel",
-        "velup_hf": "velup_hf",
-        "tenpercentvel": "velocity_params.velocity",
-        "tenpercentvelpbO2": "velocity_search.pbO2",
-        "tenpercentvelhf": "velocity_search.hypoxic_fraction",
-        "tenpercentPa": "paO2_params.paO2",
-        "tenpercentPapbO2": "paO2_search.pbO2",
-        "tenpercentPahf": "paO2_search.hypoxic_fraction",
-        "tenpercentCMRO2": "CMRO2_params.CMRO2",
-        "tenpercentCMRO2pbO2": "CMRO2_search.pbO2",
-        "tenpercentCMRO2hf": "CMRO2_search.hypoxic_fraction",
-        "tenpercentHb": "hb_params.Hb",
-        "tenpercentHbpbO2": "hb_search.pbO2",
-        "tenpercentHbhf": "hb_search.hypoxic_fraction",
-    }
+CSV_FIELDS = {
+    "CMRO2": "params.CMRO2",
+    "z_cap": "params.z_capillary",
+    "vel": "params.velocity",
+    "D": "params.D",
+    "r_Krogh": "params.r_Krogh",
+    "r_cap": "params.r_capillary",
+    "paO2": "params.paO2",
+    "Hb": "params.Hb",
+    "pbO2": "base_results.pbO2",
+    "jvO2_sat": "base_results.jugular_venous_o2_sat",
+    "hf": "base_results.hypoxic_fraction",
+    "ratio_pbO2_paO2": "ratio_pbO2_paO2",
+    "paO2up_hf": "paO2up_hf",
+    "ratio_pbO2_vel": "ratio_pbO2_vel",
+    "velup_hf": "velup_hf",
+    "tenpercentvel": "velocity_params.velocity",
+    "tenpercentvelpbO2": "velocity_search.pbO2",
+    "tenpercentvelhf": "velocity_search.hypoxic_fraction",
+    "tenpercentPa": "paO2_params.paO2",
+    "tenpercentPapbO2": "paO2_search.pbO2",
+    "tenpercentPahf": "paO2_search.hypoxic_fraction",
+    "tenpercentCMRO2": "CMRO2_params.CMRO2",
+    "tenpercentCMRO2pbO2": "CMRO2_search.pbO2",
+    "tenpercentCMRO2hf": "CMRO2_search.hypoxic_fraction",
+    "tenpercentHb": "hb_params.Hb",
+    "tenpercentHbpbO2": "hb_search.pbO2",
+    "tenpercentHbhf": "hb_search.hypoxic_fraction",
+}
+
 
+def get_csv_row(result):
     def get_field(d, field):
         sep_index = field.find(".")
         if sep_index < 0:
@@ -65,16 +83,257 @@ def export_csv(file_name, results):
         except AttributeError:
             return v
 
-    rows = [
-        [strip_units(get_field(result, field)) for name, field in fields.items()]
-        for result in results
-    ]
+    return [strip_units(get_field(result, field)) for name, field in CSV_FIELDS.items()]
+
+
+def export_csv(file_name, results):
+    rows = [get_csv_row(result) for result in results]
 
     with open(file_name, 'w') as f:
         w = csv.writer(f, delimiter=',', quoting=csv.QUOTE_MINIMAL)
 
-        headers = list(fields.keys())
+        headers = list(CSV_FIELDS.keys())
         w.writerow(headers)
 
         for row in rows:
             w.writerow(row)
+
+
+def append_csv(file_name, result):
+    """ Appends the row for one result to a CSV file in the format of export_csv, starting the file if needed. """
+    is_new_file = not os.path.exists(file_name) or os.path.getsize(file_name) == 0
+
+    with open(file_name, 'a') as f:
+        w = csv.writer(f, delimiter=',', quoting=csv.QUOTE_MINIMAL)
+
+        if is_new_file:
+            w.writerow(list(CSV_FIELDS.keys()))
+
+        w.writerow(get_csv_row(result))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# Parameters that don't change the results of a job.
+_JOB_IGNORED_PARAMETERS = {
+    "job_number", "verbose", "report_interval", "cache_dir", "cache_max_bytes", "cache_pressure_field",
+    "slice_table_dir", "slice_table_max_bytes",
+}
+
+
+def get_job_key(params):
+    return get_params_hash(params, _JOB_IGNORED_PARAMETERS)
+
+
+class ResultStore:
+    """ A directory holding the results of each job in a separate file, named by a hash of the job's parameters.
+
+    Results are saved as soon as each job finishes, so that a sweep that is interrupted can be resumed without
+    repeating the jobs that were already done.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _get_file_name(self, params):
+        return os.path.join(self.directory, get_job_key(params) + ".pickle")
+
+    def _get_file_names(self):
+        return [
+            os.path.join(self.directory, file_name)
+            for file_name in os.listdir(self.directory) if file_name.endswith(".pickle")
+        ]
+
+    def contains(self, params):
+        return os.path.exists(self._get_file_name(params))
+
+    def save(self, result):
+        save_results(self._get_file_name(result["params"]), result)
+
+    def load(self, params):
+        return load_results(self._get_file_name(params))
+
+    def clear(self):
+        for file_name in self._get_file_names():
+            os.remove(file_name)
+
+
+# Results that are only diagnostics of the solver, and aren't saved by save_results_table.
+_DIAGNOSTIC_RESULTS = {"slice_iterations", "slice_nodes"}
+
+
+def _flatten_result(value, name, scalars, fields):
+    # Splits a nested result into numeric scalar values and arrays, named by their dotted paths as in CSV_FIELDS.
+    # None, strings and anything else that isn't a number are left out, as are the diagnostics in
+    # _DIAGNOSTIC_RESULTS and the parameters in _JOB_IGNORED_PARAMETERS.
+    if hasattr(value, "items"):
+        for key, sub_value in value.items():
+            if key in _DIAGNOSTIC_RESULTS or key in _JOB_IGNORED_PARAMETERS:
+                continue
+            _flatten_result(sub_value, key if name is None else name + "." + key, scalars, fields)
+        return
+
+    magnitude = getattr(value, "magnitude", value)
+    if isinstance(magnitude, np.ndarray) and magnitude.ndim > 0:
+        if np.issubdtype(magnitude.dtype, np.number) or magnitude.dtype == bool:
+            fields[name] = value
+    elif isinstance(magnitude, (bool, int, float, np.number, np.bool_)):
+        scalars[name] = value
+
+
+def _split_units(value, unit=None):
+    # Returns the plain value and the units as a string, converting to unit first if it is given.
+    if hasattr(value, "magnitude"):
+        if unit is not None:
+            value = value.to(unit)
+        return value.magnitude, str(value.units)
+    return value, unit
+
+
+def save_results_table(directory, results, compress_fields=False):
+    """ Saves results in a columnar format that can be read back one column or field at a time.
+
+    results can be any iterable, so they can be read from a ResultStore one at a time without holding them all in
+    memory.  Each numeric scalar value becomes a column stored as a .npy file under columns/, named by its dotted
+    path (e.g. "base_results.pbO2"), with NaN for the rows that don't have it.  None, strings, solver diagnostics
+    and parameters that don't change the results, like cache_dir, aren't saved.  Arrays, like the pressure fields,
+    are stored as floats in one file per field under fields/, with the arrays of all the rows one after another,
+    either as a .npy file that can be memory mapped or, with compress_fields, as a compressed .npz file.  Where
+    several fields of a result are the same array (e.g. the paO2 results when paO2_multiple is 1), it is only
+    stored once.  The units of each column, and the units and the position and shape of each row of each field,
+    are kept in meta.json.
+    """
+    os.makedirs(os.path.join(directory, "columns"), exist_ok=True)
+    os.makedirs(os.path.join(directory, "fields"), exist_ok=True)
+
+    columns = {}
+    column_units = {}
+    field_meta = {}
+    field_files = {}
+    num_rows = 0
+
+    try:
+        for row, result in enumerate(results):
+            scalars = {}
+            fields = {}
+            _flatten_result(result, None, scalars, fields)
+
+            for name, value in scalars.items():
+                value, column_units[name] = _split_units(value, column_units.get(name))
+                columns.setdefault(name, {})[row] = value
+
+            # Maps the id of each array stored for this row to where it was stored.
+            stored_rows = {}
+
+            for name, value in fields.items():
+                value_id = id(value)
+                meta = field_meta.setdefault(name, {"unit": None, "compressed": compress_fields, "size": 0,
+                                                    "rows": {}})
+                if value_id in stored_rows:
+                    stored_name, stored_row = stored_rows[value_id]
+                    meta["unit"] = field_meta[stored_name]["unit"]
+                    meta["rows"][str(row)] = stored_row
+                    continue
+
+                value, meta["unit"] = _split_units(value, meta["unit"])
+                value = np.asarray(value, dtype=float)
+
+                # The arrays are written to a raw file as they come, and turned into the field's file at the end.
+                if name not in field_files:
+                    field_files[name] = open(os.path.join(directory, "fields", name + ".raw"), 'wb')
+                value.tofile(field_files[name])
+                meta["rows"][str(row)] = {"field": name, "offset": meta["size"], "shape": list(value.shape)}
+                meta["size"] += value.size
+                stored_rows[value_id] = (name, meta["rows"][str(row)])
+
+            num_rows = row + 1
+    finally:
+        for f in field_files.values():
+            f.close()
+
+    for name in field_files:
+        raw_file_name = os.path.join(directory, "fields", name + ".raw")
+        values = np.memmap(raw_file_name, dtype=float, mode='r') if field_meta[name]["size"] > 0 else np.zeros(0)
+        if compress_fields:
+            np.savez_compressed(os.path.join(directory, "fields", name + ".npz"), value=values)
+        else:
+            np.save(os.path.join(directory, "fields", name + ".npy"), values)
+        del values
+        os.remove(raw_file_name)
+
+    column_meta = {}
+    for name, values in columns.items():
+        column = np.full(num_rows, np.nan)
+        for row, value in values.items():
+            column[row] = value
+        np.save(os.path.join(directory, "columns", name + ".npy"), column)
+        column_meta[name] = {"unit": column_units[name]}
+
+    with open(os.path.join(directory, "meta.json"), 'w') as f:
+        json.dump({"rows": num_rows, "columns": column_meta, "fields": field_meta}, f, indent=2)
+
+
+class ResultsTable:
+    """ Reads results saved by save_results_table, loading only the columns and fields that are asked for. """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json"), 'r') as f:
+            meta = json.load(f)
+        self.num_rows = meta["rows"]
+        self.columns = meta["columns"]
+        self.fields = meta["fields"]
+        self._field_values = {}
+
+    def __len__(self):
+        return self.num_rows
+
+    def get_column(self, name, with_units=False):
+        """ Returns a memory mapped array of the values in a column, as a pint quantity if with_units is set. """
+        column = np.load(os.path.join(self.directory, "columns", name + ".npy"), mmap_mode='r')
+        unit = self.columns[name]["unit"]
+        if with_units and unit is not None:
+            return get_units().Quantity(np.asarray(column), unit)
+        return column
+
+    def get_columns(self, names, with_units=False):
+        return {name: self.get_column(name, with_units) for name in names}
+
+    def _get_field_values(self, name):
+        # The values of all the rows of a field, memory mapped unless they were compressed, in which case they are
+        # loaded once and kept.
+        if name not in self._field_values:
+            if self.fields[name]["compressed"]:
+                with np.load(os.path.join(self.directory, "fields", name + ".npz")) as npz:
+                    self._field_values[name] = npz["value"]
+            else:
+                self._field_values[name] = np.load(os.path.join(self.directory, "fields", name + ".npy"),
+                                                   mmap_mode='r')
+        return self._field_values[name]
+
+    def get_field(self, name, row, with_units=False):
+        """ Returns the array stored for a field in one row, memory mapped unless it was compressed. """
+        meta = self.fields[name]
+        if str(row) not in meta["rows"]:
+            return None
+
+        # The array may be stored under the name of another field of the same result.
+        location = meta["rows"][str(row)]
+        size = int(np.prod(location["shape"]))
+        values = self._get_field_values(location["field"])
+        field = values[location["offset"]:location["offset"] + size].reshape(location["shape"])
+
+        if with_units and meta["unit"] is not None:
+            return get_units().Quantity(np.asarray(field), meta["unit"])
+        return field
+
+
+def convert_pickle_to_table(file_name, directory, compress_fields=False):
+    """ Converts results saved with save_results to the format of save_results_table. """
+    save_results_table(directory, load_results(file_name), compress_fields)
+
+
+if __name__ == "__main__":
+    # Converts a results pickle from an earlier run: python data.py results.pickle results.table [--compress]
+    convert_pickle_to_table(sys.argv[1], sys.argv[2], compress_fields="--compress" in sys.argv[3:])
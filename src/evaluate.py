@@ -1,146 +1,476 @@
+import functools
+import instrumentation
 import multiprocessing
-import os
-from solver import integrate
-from joblib import Parallel, delayed
+import numpy as np
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from scipy.optimize import brentq
+from continuation import add_continuation_stats, get_continuation_stats, integrate_chain, \
+    order_by_nearest_neighbour, seeded_integrate, strip_pressure_field
+from parameters import Parameters, from_plain_values, get_plain_values
+from result_cache import add_cache_stats, cached_integrate, cached_integrate_batch, get_cache_stats, get_solve_key
 from units import get_units
 
 
-def search(initial_params, is_finished, get_next_params):
-    params = initial_params
-    results = integrate(**params)
-    while not is_finished(results):
-        params = get_next_params(params)
-        results = integrate(**params)
+# The largest change in the logarithm of the multiple that a search tries, when pbO2 levels off below the target.
+# Without it the multiple overflows after about 16 doublings.
+MAX_SEARCH_LOG_MULTIPLE = np.log(1e4)
 
-    return results, params
 
+def search(params, name, step, base_results, target_increase=0.1, tol=1e-3, max_evaluations=30):
+    """ Finds the multiple of params[name] at which pbO2 is target_increase above its value in base_results.
 
-def evaluate_point(params):
-    is_test = params.get("test", False)
+    The multiple is bracketed by repeatedly squaring step, starting from the base point (which is not solved
+    again), and then refined with Brent's method on its logarithm until it is known to a relative accuracy of tol.
+    If pbO2 is still below the target at a multiple of 1e4 (or 1e-4), the results there are returned with a warning.
+
+    With params["continuation"] set, each solve starts from the pressure field of the nearest multiple solved so
+    far.
+
+    Returns the results and parameters at the converged multiple, and the number of integrate calls made.
+    """
+    base_pbO2 = base_results["pbO2"]
     job_number = params.get("job_number", 0)
 
-    def log(s):
-        print("[{}] {}".format(job_number, s))
+    # Results and parameters at each log(multiple) evaluated so far.
+    evaluated = {0.0: (base_results, params)}
 
-    results = {
-        "params": params
+    def evaluate(log_multiple):
+        if log_multiple not in evaluated:
+            new_params = params.copy()
+            new_params[name] = params[name] * np.exp(log_multiple)
+            if params.get("continuation", False):
+                # Start the solver from the nearest multiple evaluated so far that kept its pressure field.
+                seeds = [value for value in evaluated.items() if value[1][0].get("p") is not None]
+                seed = min(seeds, key=lambda value: abs(value[0] - log_multiple), default=(None, (None, None)))
+                evaluated[log_multiple] = (seeded_integrate(new_params, seed[1][0]), new_params)
+            else:
+                evaluated[log_multiple] = (cached_integrate(**new_params), new_params)
+        return evaluated[log_multiple]
+
+    def objective(log_multiple):
+        search_results, _ = evaluate(log_multiple)
+        return float(search_results["pbO2"] / base_pbO2) - 1.0 - target_increase
+
+    lower = 0.0
+    upper = np.log(step)
+    while objective(upper) < 0:
+        if len(evaluated) - 1 >= max_evaluations or abs(upper) >= MAX_SEARCH_LOG_MULTIPLE:
+            print("[{}] Search warning: {} not bracketed after {} evaluations, up to a multiple of {:.4g}"
+                  .format(job_number, name, len(evaluated) - 1, np.exp(upper)))
+            search_results, search_params = evaluate(upper)
+            return strip_pressure_field(search_results, params), search_params, len(evaluated) - 1
+        lower = upper
+        upper = float(np.clip(2 * upper, -MAX_SEARCH_LOG_MULTIPLE, MAX_SEARCH_LOG_MULTIPLE))
+
+    remaining_evaluations = max(1, max_evaluations - (len(evaluated) - 1))
+    log_multiple, root_results = brentq(objective, lower, upper, xtol=tol, maxiter=remaining_evaluations,
+                                        full_output=True, disp=False)
+    if not root_results.converged:
+        print("[{}] Search warning: {} did not converge: {}".format(job_number, name, root_results.flag))
+
+    search_results, search_params = evaluate(log_multiple)
+    return strip_pressure_field(search_results, params), search_params, len(evaluated) - 1
+
+
+# The searches for a 10% increase in pbO2: the prefix of their result keys, the parameter that is varied and the
+# initial step for its multiple.
+SEARCHES = [
+    ("hb", "Hb", 1.01),
+    ("velocity", "velocity", 1.01),
+    ("paO2", "paO2", 1.05),
+    ("CMRO2", "CMRO2", 0.99),
+]
+
+
+def run_integrate(params):
+    with instrumentation.timed("integrate"):
+        return cached_integrate(**params)
+
+
+def run_integrate_batch(params_list):
+    with instrumentation.timed("integrate_batch"):
+        return cached_integrate_batch(params_list)
+
+
+def run_integrate_chain(params_list, keep_pressure_fields=None):
+    with instrumentation.timed("integrate_chain"):
+        return integrate_chain(params_list, keep_pressure_fields)
+
+
+def run_search(params, name, step, base_results):
+    if params.get("test", False):
+        # The test results don't depend on the parameters, so just take the first step.
+        search_params = params.copy()
+        search_params[name] *= step
+        return cached_integrate(**search_params), search_params, 1
+
+    with instrumentation.timed("search[{}]".format(name)):
+        search_results, search_params, evaluations = search(params, name, step, base_results,
+                                                            tol=params.get("search_tol", 1e-3),
+                                                            max_evaluations=params.get("search_max_evaluations", 30))
+    instrumentation.count("search_evaluations[{}]".format(name), evaluations)
+    return search_results, search_params, evaluations
+
+
+class _PlainParameters(dict):
+    # Parameters as plain values in the units of the parameter files.
+    pass
+
+
+class _PlainQuantity(tuple):
+    # A quantity as its magnitude and the name of its units.
+    pass
+
+
+def to_plain(value):
+    """ Converts the Parameters and quantities in value, which may be nested in dicts, lists and tuples, to plain
+    values that are much cheaper to send between processes.  from_plain converts them back. """
+    if isinstance(value, Parameters):
+        return _PlainParameters(get_plain_values(value))
+    if hasattr(value, "magnitude") and hasattr(value, "units"):
+        return _PlainQuantity((value.magnitude, str(value.units)))
+    if isinstance(value, dict):
+        return {name: to_plain(item) for name, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(to_plain(item) for item in value)
+    return value
+
+
+@functools.lru_cache(maxsize=None)
+def _parse_units(units_name):
+    return get_units().parse_units(units_name)
+
+
+def from_plain(value):
+    if isinstance(value, _PlainParameters):
+        return from_plain_values(value)
+    if isinstance(value, _PlainQuantity):
+        return value[0] * _parse_units(value[1])
+    if isinstance(value, dict):
+        return {name: from_plain(item) for name, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(from_plain(item) for item in value)
+    return value
+
+
+def initialize_worker():
+    # Runs once in each worker process, so that the tasks don't pay for setting up the unit registry.
+    get_units()
+
+
+def run_task(is_instrumented, function, *args):
+    """ Runs function(*args) in a worker process, with the instrumentation enabled if is_instrumented.
+
+    The arguments and the result are sent as plain values (see to_plain).  Returns the result along with the result
+    cache, continuation and instrumentation stats for the call, so that they can be added to the totals in the
+    parent process with add_task_stats.
+    """
+    instrumentation.enable(is_instrumented)
+    cache_stats_before = get_cache_stats()
+    continuation_stats_before = get_continuation_stats()
+    instrumentation_stats_before = instrumentation.get_stats()
+    result = function(*from_plain(args))
+    cache_stats_after = get_cache_stats()
+    continuation_stats_after = get_continuation_stats()
+    return to_plain(result), {
+        "cache": {name: cache_stats_after[name] - cache_stats_before[name] for name in cache_stats_after},
+        "continuation": {name: continuation_stats_after[name] - continuation_stats_before[name]
+                         for name in continuation_stats_after},
+        "instrumentation": instrumentation.get_stats_since(instrumentation_stats_before),
     }
 
-    # First get the results at the specified parameter values.
-    base_results = integrate(**params)
 
-    results["base_results"] = base_results
-    log("Base results done.")
+def add_task_stats(stats):
+    add_cache_stats(stats["cache"])
+    add_continuation_stats(stats["continuation"])
+    instrumentation.add_stats(stats["instrumentation"])
 
-    if params["paO2_multiple"] == 1.0:
-        results["paO2_results"] = base_results
-        paO2_results = base_results
-    else:
-        paO2_params = params.copy()
-        paO2_params["paO2"] *= params["paO2_multiple"]
-        paO2_results = integrate(**paO2_params)
-        results["paO2_results"] = paO2_results
-    log("Pa increase results done.")
 
-    if params["velocity_multiple"] == 1.0:
-        results["velocity_results"] = base_results
+def get_multiple_params(params, name):
+    """ Returns the parameters with params[name] scaled by params[name + "_multiple"], or None if that is 1. """
+    multiple = params[name + "_multiple"]
+    if multiple == 1.0:
+        return None
+
+    multiple_params = params.copy()
+    multiple_params[name] *= multiple
+    return multiple_params
+
+
+def is_search_needed(params):
+    return params.get("no_search", False) != True
+
+
+def collect_point_results(params, base_results, paO2_results, vel_results, search_outputs):
+    """ Puts together the results for one grid point.
+
+    paO2_results and vel_results are None where the multiple is 1, and search_outputs maps each search's key
+    prefix to the (results, params, evaluations) returned by run_search.
+    """
+    if paO2_results is None:
+        paO2_results = base_results
+    if vel_results is None:
         vel_results = base_results
-    else:
-        vel_params = params.copy()
-        vel_params["velocity"] *= params["velocity_multiple"]
-        vel_results = integrate(**vel_params)
-        results["velocity_results"] = vel_results
-    log("Velocity increase results done.")
 
-    results["ratio_pbO2_paO2"] = paO2_results["pbO2"] / base_results["pbO2"]
-    results["paO2up_hf"] = paO2_results["hypoxic_fraction"]
-    results["ratio_pbO2_vel"] = vel_results["pbO2"] / base_results["pbO2"]
-    results["velup_hf"] = vel_results["hypoxic_fraction"]
-
-    if params.get("no_search", False) == True:
-        results["hb_search"] = base_results
-        results["hb_params"] = params
-        results["velocity_search"] = base_results
-        results["velocity_params"] = params
-        results["paO2_search"] = base_results
-        results["paO2_params"] = params
-        results["CMRO2_search"] = base_results
-        results["CMRO2_params"] = params
-    else:
-        base_pbO2 = base_results["pbO2"]
-        def is_pbO2_increased_ten_percent(search_results):
-            if is_test:
-                return True
+    results = {
+        "params": params,
+        "base_results": base_results,
+        "paO2_results": paO2_results,
+        "velocity_results": vel_results,
+        "ratio_pbO2_paO2": paO2_results["pbO2"] / base_results["pbO2"],
+        "paO2up_hf": paO2_results["hypoxic_fraction"],
+        "ratio_pbO2_vel": vel_results["pbO2"] / base_results["pbO2"],
+        "velup_hf": vel_results["hypoxic_fraction"],
+    }
 
-            search_pbO2 = search_results["pbO2"]
-            pbO2_increase = search_pbO2 / base_pbO2 - 1.0
-            return pbO2_increase >= 0.1
+    for prefix, name, step in SEARCHES:
+        if prefix in search_outputs:
+            search_results, search_params, evaluations = search_outputs[prefix]
+            results[prefix + "_search"] = search_results
+            results[prefix + "_params"] = search_params
+            results[prefix + "_search_evaluations"] = evaluations
+        else:
+            results[prefix + "_search"] = base_results
+            results[prefix + "_params"] = params
 
-        # Search for 10% increase in pbO2 via Hb
-        def increase_hb(params):
-            new_params = params.copy()
-            new_params["Hb"] *= 1.01
-            return new_params
+    return results
 
-        hb_search_params = increase_hb(params)
-        hb_search_results, hb_final_params = search(hb_search_params, is_pbO2_increased_ten_percent, increase_hb)
-        results["hb_search"] = hb_search_results
-        results["hb_params"] = hb_final_params
-        log("Hb search done.")
 
-        # Search for 10% increase in pbO2 via velocity.
-        def increase_velocity(params):
-            new_params = params.copy()
-            new_params["velocity"] *= 1.01
-            return new_params
+def evaluate_point(params):
+    job_number = params.get("job_number", 0)
+
+    def log(s):
+        print("[{}] {}".format(job_number, s))
+
+    # First get the results at the specified parameter values.  With continuation, the pressure field is kept to
+    # seed the searches.
+    if params.get("continuation", False):
+        seed_results = seeded_integrate(params)
+        base_results = strip_pressure_field(seed_results, params)
+    else:
+        seed_results = base_results = run_integrate(params)
+    log("Base results done.")
 
-        vel_search_params = increase_velocity(params)
-        vel_search_results, vel_final_params = search(vel_search_params, is_pbO2_increased_ten_percent, increase_velocity)
-        results["velocity_search"] = vel_search_results
-        results["velocity_params"] = vel_final_params
-        log("Velocty search done.")
+    paO2_params = get_multiple_params(params, "paO2")
+    paO2_results = None if paO2_params is None else run_integrate(paO2_params)
+    log("Pa increase results done.")
 
-        # Search for 10% increase in pbO2 via paO2.
-        def increase_paO2(params):
-            new_params = params.copy()
-            new_params["paO2"] *= 1.05
-            return new_params
+    vel_params = get_multiple_params(params, "velocity")
+    vel_results = None if vel_params is None else run_integrate(vel_params)
+    log("Velocity increase results done.")
 
-        paO2_search_params = increase_paO2(params)
-        paO2_search_results, paO2_final_params = search(paO2_search_params, is_pbO2_increased_ten_percent, increase_paO2)
-        results["paO2_search"] = paO2_search_results
-        results["paO2_params"] = paO2_final_params
-        log("PaO2 search done.")
+    # Search for a 10% increase in pbO2 via each of Hb, velocity, paO2 and CMRO2.
+    search_outputs = {}
+    if is_search_needed(params):
+        for prefix, name, step in SEARCHES:
+            search_outputs[prefix] = run_search(params, name, step, seed_results)
+            log("{} search done.".format(name))
 
-        # Search for 10% increase in pbO2 via CMRO2.
-        def decrease_CMRO2(params):
-            new_params = params.copy()
-            new_params["CMRO2"] *= 0.99
-            return new_params
+    return collect_point_results(params, base_results, paO2_results, vel_results, search_outputs)
 
-        cmro2_search_params = decrease_CMRO2(params)
-        cmro2_search_results, cmro2_final_params = search(cmro2_search_params, is_pbO2_increased_ten_percent, decrease_CMRO2)
-        results["CMRO2_search"] = cmro2_search_results
-        results["CMRO2_params"] = cmro2_final_params
-        log("CMRO2 search done.")
 
-    return results
+def evaluate_points(params_list, num_cores=None, on_point_done=None, return_results=True, batch_size=32,
+                    chains_per_core=2, on_point_failed=None):
+    """ Evaluates every point in params_list, spreading the work over num_cores processes.
+
+    Each point is split into independent tasks (the base solve, the paO2 and velocity multiples, and the four
+    searches), and the tasks from all points share one pool of workers.  The searches are started as soon as the
+    base results for their point are available, so even a single point keeps several cores busy.  The base and
+    multiple solves of points that use the "batch" engine are grouped into tasks of up to batch_size solves, which
+    batch_solver.integrate_batch does together.
+
+    For points with params["continuation"] set, the base and multiple solves are instead ordered along a short path
+    through parameter space and split into about chains_per_core chains for each core.  Each chain is one task, in
+    which every solve starts from the pressure field of the one before it.
+
+    Solves that are the same for several points, like a paO2 multiple that lands on another grid point's paO2, are
+    only done once, and the results are shared between the points.
 
+    on_point_done is called with the results for each point as soon as all of its tasks are finished.  If
+    return_results is False the results aren't kept after that, and None is returned.
 
-def evaluate_points(params_list, num_cores=None):
-    # Attach a job number to each parameter set so that we can include it in any output.
+    An exception in any task is raised, unless on_point_failed is given.  Then on_point_failed is called with the
+    parameters of each point that the task was for and the exception, once for each point, and the other points
+    carry on.  Failed points have no results.  A task with several points, like a batch, fails all of them.
+    """
+    # Attach a job number to each parameter set so that we can include it in any output, unless the caller has
+    # already numbered them.
     for i in range(len(params_list)):
-        params_list[i]["job_number"] = i + 1
+        if "job_number" not in params_list[i].keys():
+            params_list[i]["job_number"] = i + 1
 
     if num_cores is None:
         num_cores = multiprocessing.cpu_count()
 
     print("Evaluating using {} cores.".format(num_cores))
 
-    # This is necessary to make numpy work on OSX with joblib Parallel.
-    os.environ["JOBLIB_START_METHOD"] = "forkserver"
+    def log(i, s):
+        print("[{}] {}".format(params_list[i]["job_number"], s))
+
+    base_results = [None] * len(params_list)
+    multiple_results = [{"paO2": None, "velocity": None} for _ in params_list]
+    search_outputs = [{} for _ in params_list]
+    results_list = [None] * len(params_list)
+
+    # Number of unfinished tasks for each point.
+    remaining_tasks = [0] * len(params_list)
+
+    # forkserver is necessary to make numpy work on OSX with multiprocessing.  The fork server imports the solvers
+    # once, so that each worker starts with them already loaded.
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["evaluate"])
+
+    with ProcessPoolExecutor(max_workers=num_cores, mp_context=context, initializer=initialize_worker) as executor:
+        # Maps each running task to whether it returns a list of results, and to the index of the point, the kind of
+        # task and the parameter for each of its results.
+        pending = {}
+
+        def submit(is_list, outputs, function, *args):
+            pending[executor.submit(run_task, instrumentation.is_enabled(), function, *to_plain(args))] = \
+                (is_list, outputs)
+            for i, _, _ in outputs:
+                remaining_tasks[i] += 1
+
+        # Batch engine solves waiting to be submitted together, and solves waiting to be put into continuation
+        # chains.
+        batch = []
+        chain_solves = []
+
+        def flush_batch():
+            if batch:
+                submit(True, [output for output, _ in batch], run_integrate_batch, [params for _, params in batch])
+                del batch[:]
+
+        def submit_chains():
+            order = order_by_nearest_neighbour([params for _, params in chain_solves])
+            for chain in np.array_split(order, min(len(order), num_cores * chains_per_core)):
+                # The base solves keep their pressure fields, so that the searches from them start seeded.
+                keep_pressure_fields = [chain_solves[j][0][1] == "base" and is_search_needed(chain_solves[j][1])
+                                        for j in chain]
+                submit(True, [chain_solves[j][0] for j in chain], run_integrate_chain,
+                       [chain_solves[j][1] for j in chain], keep_pressure_fields)
+
+        # The solve key of each planned integrate call, by its output, and the other outputs that share its results.
+        # Identical solves, such as a multiple that lands on another grid point, are only done once.
+        planned_solves = {}
+        solve_keys = {}
+        shared_outputs = {}
+
+        def submit_integrate(i, task, name, params):
+            key = get_solve_key(params)
+            if key in planned_solves:
+                shared_outputs[planned_solves[key]].append((i, task, name))
+                remaining_tasks[i] += 1
+                return
+            planned_solves[key] = (i, task, name)
+            solve_keys[(i, task, name)] = key
+            shared_outputs[(i, task, name)] = []
+
+            if params.get("engine", "march") == "batch":
+                batch.append(((i, task, name), params))
+                if len(batch) >= batch_size:
+                    flush_batch()
+            elif params.get("continuation", False):
+                chain_solves.append(((i, task, name), params))
+            else:
+                submit(False, [(i, task, name)], run_integrate, params)
+
+        failed_points = set()
+
+        def point_failed(i, error):
+            remaining_tasks[i] -= 1
+            if i not in failed_points:
+                failed_points.add(i)
+                log(i, "Failed: {!r}".format(error))
+                base_results[i] = None
+                multiple_results[i] = None
+                search_outputs[i] = None
+                on_point_failed(params_list[i], error)
+
+        def task_done(i, task, name, task_results):
+            params = params_list[i]
+            remaining_tasks[i] -= 1
+            if i in failed_points:
+                return
+
+            if task == "base":
+                # Only the searches get the pressure field that a base solve may have kept to seed them.
+                base_results[i] = strip_pressure_field(task_results, params)
+                log(i, "Base results done.")
+
+                # The searches need the base pbO2, so they can only start now.
+                if is_search_needed(params):
+                    for prefix, search_name, step in SEARCHES:
+                        submit(False, [(i, "search", prefix)], run_search, params, search_name, step,
+                               task_results)
+            elif task == "multiple":
+                multiple_results[i][name] = strip_pressure_field(task_results, params)
+                log(i, "{} increase results done.".format(name))
+            else:
+                search_outputs[i][name] = task_results
+                log(i, "{} search done.".format(name))
+
+            if remaining_tasks[i] == 0:
+                point_results = collect_point_results(params, base_results[i], multiple_results[i]["paO2"],
+                                                      multiple_results[i]["velocity"], search_outputs[i])
+
+                # Let go of the task results, which may include whole pressure fields.
+                base_results[i] = None
+                multiple_results[i] = None
+                search_outputs[i] = None
+
+                if on_point_done is not None:
+                    on_point_done(point_results)
+                if return_results:
+                    results_list[i] = point_results
+
+        for i, params in enumerate(params_list):
+            submit_integrate(i, "base", None, params)
+
+            for name in ("paO2", "velocity"):
+                multiple_params = get_multiple_params(params, name)
+                if multiple_params is not None:
+                    submit_integrate(i, "multiple", name, multiple_params)
+
+        flush_batch()
+        if chain_solves:
+            submit_chains()
+
+        num_shared = sum(len(outputs) for outputs in shared_outputs.values())
+        if num_shared > 0:
+            print("{} of {} solves are duplicates, which share the results of the others.".format(
+                num_shared, num_shared + len(planned_solves)))
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                is_list, outputs = pending.pop(future)
+                try:
+                    task_results, task_stats = future.result()
+                except BrokenProcessPool:
+                    # The pool can't run any more tasks, so there is nothing to carry on with.
+                    raise
+                except Exception as e:
+                    if on_point_failed is None:
+                        raise
+                    task_results = None
+                    error = e
+                else:
+                    task_results = from_plain(task_results)
+                    add_task_stats(task_stats)
+                    if not is_list:
+                        task_results = [task_results]
 
-    par = Parallel(n_jobs=num_cores)
-    results_list = par(delayed(evaluate_point)(params) for params in params_list)
+                for j, output in enumerate(outputs):
+                    # Later solves with the same key are done again rather than waiting for results that have
+                    # already been handed out.
+                    if output in solve_keys:
+                        del planned_solves[solve_keys.pop(output)]
+                    for i, task, name in [output] + shared_outputs.pop(output, []):
+                        if task_results is None:
+                            point_failed(i, error)
+                        else:
+                            task_done(i, task, name, task_results[j])
 
-    return results_list
+    return results_list if return_results else None
@@ -0,0 +1,121 @@
+import contextlib
+import json
+import time
+
+
+# Timings and counters are only collected once enable() is called, so that the calls in the solvers cost next to
+# nothing otherwise.
+_enabled = False
+
+# Number of calls and total seconds for each timed phase, and the value of each counter.  Stats from worker
+# processes are added with add_stats.
+_timings = {}
+_counters = {}
+
+_null_timer = contextlib.nullcontext()
+
+
+class _Timer:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        timing = _timings.setdefault(self.name, [0, 0.0])
+        timing[0] += 1
+        timing[1] += time.perf_counter() - self.start
+
+
+def enable(enabled=True):
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled():
+    return _enabled
+
+
+def timed(name):
+    """ Returns a context manager that adds the time spent in it to the timings for name, if enabled. """
+    if not _enabled:
+        return _null_timer
+    return _Timer(name)
+
+
+def count(name, value=1):
+    """ Adds value to the counter for name, if enabled. """
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def counted(function, name):
+    """ Returns function wrapped so that each call adds one to the counter for name, or function itself if not
+    enabled. """
+    if not _enabled:
+        return function
+
+    def counted_function(*args, **kwargs):
+        _counters[name] = _counters.get(name, 0) + 1
+        return function(*args, **kwargs)
+
+    return counted_function
+
+
+def get_stats():
+    return {
+        "timings": {name: list(timing) for name, timing in _timings.items()},
+        "counters": dict(_counters),
+    }
+
+
+def get_stats_since(stats_before):
+    """ Returns the stats collected since get_stats returned stats_before. """
+    stats = get_stats()
+    for name, (calls, seconds) in stats_before["timings"].items():
+        stats["timings"][name][0] -= calls
+        stats["timings"][name][1] -= seconds
+    for name, value in stats_before["counters"].items():
+        stats["counters"][name] -= value
+    return stats
+
+
+def add_stats(stats):
+    for name, (calls, seconds) in stats["timings"].items():
+        timing = _timings.setdefault(name, [0, 0.0])
+        timing[0] += calls
+        timing[1] += seconds
+    for name, value in stats["counters"].items():
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def get_report():
+    """ Returns the timings and counters as a dictionary that can be saved as JSON.  The time of each phase is the
+    total over all processes, so it can be more than the wall clock time of a run. """
+    return {
+        "timings": {name: {"calls": calls, "seconds": seconds, "seconds_per_call": seconds / calls if calls else 0.0}
+                    for name, (calls, seconds) in sorted(_timings.items())},
+        "counters": dict(sorted(_counters.items())),
+    }
+
+
+def print_report():
+    report = get_report()
+    if not report["timings"] and not report["counters"]:
+        return
+
+    print("Timings (summed over all processes):")
+    for name, timing in sorted(report["timings"].items(), key=lambda item: -item[1]["seconds"]):
+        print("  {}: {:.3f}s in {} calls ({:.3g}s per call)".format(name, timing["seconds"], timing["calls"],
+                                                                   timing["seconds_per_call"]))
+    print("Counters:")
+    for name, value in report["counters"].items():
+        print("  {}: {}".format(name, value))
+
+
+def save_report(file_name):
+    with open(file_name, 'w') as f:
+        json.dump(get_report(), f, indent=2)
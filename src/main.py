@@ -1,9 +1,13 @@
 import datetime
+import instrumentation
 import sys
 from parameters import *
 from evaluate import evaluate_points
 from data import *
+from continuation import print_continuation_stats
+from result_cache import print_cache_stats
 from units import get_units
+from work_queue import WorkQueue, evaluate_points_with_queue
 
 
 if __name__ == '__main__':
@@ -12,9 +16,32 @@ if __name__ == '__main__':
     param_values = None
     base_file_name = "results" + datetime.datetime.now().strftime('%Y-%m-%d %H-%M-%S')
 
-    if len(sys.argv) > 1:
-        param_values = Parameters(load_param_values(sys.argv[1]))
-        base_file_name = "results" + sys.argv[1]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+
+    # With --resume, the jobs that an earlier run with the same parameter file already finished are skipped.
+    resume = "--resume" in sys.argv[1:]
+
+    # With --queue=FILE, the jobs go through a work queue, so that workers on other hosts can help with them (see
+    # work_queue.py).
+    queue_file_name = None
+    for arg in sys.argv[1:]:
+        if arg.startswith("--queue="):
+            queue_file_name = arg[len("--queue="):]
+
+    # With --shard=i/n, only the ith of every n grid points is run, so that n runs of the same parameter file, e.g. on
+    # different hosts, split the grid between them.  Each shard has its own output files.
+    shard = None
+    for arg in sys.argv[1:]:
+        if arg.startswith("--shard="):
+            shard = parse_shard(arg[len("--shard="):])
+
+    # With --instrument, the time spent in each phase of the solvers is measured and saved at the end.
+    if "--instrument" in sys.argv[1:]:
+        instrumentation.enable()
+
+    if len(args) > 0:
+        param_values = Parameters(load_param_values(args[0]))
+        base_file_name = "results" + args[0]
 
     if not param_values:
         param_values = Parameters({
@@ -63,22 +90,72 @@ if __name__ == '__main__':
             "velocity_multiple": [1.1],
         })
 
+    # Reuse the results of earlier runs unless the parameters say otherwise.
+    if "cache_dir" not in param_values.keys():
+        param_values["cache_dir"] = ["integrate_cache"]
+
     print("Parameter values:")
     print_param_values(param_values)
 
+    if shard is not None:
+        base_file_name += ".shard{}of{}".format(shard[0] + 1, shard[1])
+
     csv_results_file_name = base_file_name + ".csv"
-    raw_results_file_name = base_file_name + ".pickle"
+    table_results_dir = base_file_name + ".results"
     pressure_matrix_file_name = base_file_name + ".pressure.csv"
+    instrumentation_file_name = base_file_name + ".timing.json"
+    result_store_dir = base_file_name + ".jobs"
 
     print()
     print("Results will be in '%s'" % csv_results_file_name)
     print()
 
-    param_grid = create_param_grid(param_values)
-    results = evaluate_points(param_grid)
-
-    export_csv(csv_results_file_name, results)
-    save_results(raw_results_file_name, results)
+    # Job numbers are the positions in the whole grid, so they are the same whichever shard a point is run in.
+    param_grid = []
+    for index, params in iterate_param_grid(param_values, shard):
+        params["job_number"] = index + 1
+        param_grid.append(params)
+
+    if shard is not None:
+        print("Shard {} of {}: {} of the {} grid points.".format(shard[0] + 1, shard[1], len(param_grid),
+                                                                 get_param_grid_size(param_values)))
+
+    # The results of each job are saved as soon as it finishes, both to the CSV file and to the result store.
+    result_store = ResultStore(result_store_dir)
+    if os.path.exists(csv_results_file_name):
+        os.remove(csv_results_file_name)
+
+    if resume:
+        done_params = [params for params in param_grid if result_store.contains(params)]
+        print("Resuming: {} of {} jobs are already done.".format(len(done_params), len(param_grid)))
+
+        # Rewrite the CSV file from the store, in case the earlier run stopped part way through writing a row.
+        for params in done_params:
+            append_csv(csv_results_file_name, result_store.load(params))
+
+        remaining_params = [params for params in param_grid if not result_store.contains(params)]
+    else:
+        result_store.clear()
+        remaining_params = param_grid
+
+    def save_point_results(point_results):
+        result_store.save(point_results)
+        append_csv(csv_results_file_name, point_results)
+
+    if queue_file_name is not None:
+        evaluate_points_with_queue(WorkQueue(queue_file_name), remaining_params, on_point_done=save_point_results)
+    else:
+        evaluate_points(remaining_params, on_point_done=save_point_results, return_results=False)
+
+    # Read the results back from the store one at a time, so that they never all need to be in memory at once.
+    save_results_table(table_results_dir, (result_store.load(params) for params in param_grid))
+    print_cache_stats()
+    print_continuation_stats()
+
+    if instrumentation.is_enabled():
+        instrumentation.print_report()
+        instrumentation.save_report(instrumentation_file_name)
+        print("Timings saved to '%s'" % instrumentation_file_name)
 
     #for i, result in enumerate(results):
     #    file_name = base_file_name + "pressure{}.csv".format(i)
@@ -0,0 +1,197 @@
+import instrumentation
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+from solver import blood_o2_saturation_derivative, consumption_coefficient, gamma, gamma_derivative, \
+    get_blood_o2_concentration_value, get_extraction_factor, get_grid_size, get_initial_profile, \
+    get_o2_concentration_table, resample_pressure_field, summarise_pressure_field
+from units import get_units
+
+
+units = get_units()
+
+
+class NewtonSystem:
+    """ The discretised Krogh equations for the whole (z, r) field, as a nonlinear system residual(P) = 0 in the
+    pressures P in mmHg, with shape (z_steps, r_steps).
+
+    The radial Krogh ODE is discretised with central differences on r_steps nodes for every z-slice, and the
+    capillary mass balance between neighbouring slices is included in the same system.  r_steps and z_steps are the
+    step counts after scaling with get_grid_size.
+    """
+
+    def __init__(self, CMRO2, z_capillary, velocity, D, r_Krogh, r_capillary, paO2, Hb, sigma, r_steps, z_steps):
+        self.kappa_max = consumption_coefficient(CMRO2, D, sigma)
+        self.r_steps = r_steps
+        self.z_steps = z_steps
+
+        self.dr = (r_Krogh - r_capillary) / r_steps
+        self.dz = z_capillary / z_steps
+
+        # Radial nodes in um.  The first node is on the capillary wall and the last one on the outside of the
+        # cylinder.
+        self.r = np.linspace(r_capillary.to(units.um).magnitude, r_Krogh.to(units.um).magnitude, r_steps)
+        self.h = self.r[1] - self.r[0]
+
+        # Drop in blood O2 concentration (mlO2/dL) over one z-step per mmHg of pressure difference across the first
+        # radial step at the wall.
+        self.extraction_factor = get_extraction_factor(D, sigma, r_capillary, velocity, self.dr, self.dz)
+
+        self.paO2_value = paO2.to(units.mmHg).magnitude
+        self.Hb_value = Hb.to(units.g / units.dL).magnitude
+        self.sigma_value = sigma.to(units.mlO2 / units.dL / units.mmHg).magnitude
+
+        # Index of each unknown in the flattened vector.
+        self.index = np.arange(z_steps * r_steps).reshape(z_steps, r_steps)
+
+        # The radial equations are multiplied through by h^2 so that all residuals are of the order of a pressure.
+        self.lower = 1.0 - self.h / (2 * self.r[1:-1])
+        self.upper = 1.0 + self.h / (2 * self.r[1:-1])
+
+    def concentration(self, pp):
+        return get_blood_o2_concentration_value(pp, self.sigma_value, self.Hb_value)
+
+    def concentration_derivative(self, pp):
+        o2_capacity = 1.34
+        return o2_capacity * self.Hb_value * 0.01 * blood_o2_saturation_derivative(pp * units.mmHg) \
+            + self.sigma_value
+
+    def residual(self, P):
+        h = self.h
+        kappa_max = self.kappa_max
+        F = np.empty_like(P)
+        F[:, 1:-1] = self.lower * P[:, :-2] - 2 * P[:, 1:-1] + self.upper * P[:, 2:] \
+            - h ** 2 * gamma(kappa_max, P[:, 1:-1])
+        # Zero gradient on the outside of the cylinder, using a mirrored ghost node.
+        F[:, -1] = 2 * (P[:, -2] - P[:, -1]) - h ** 2 * gamma(kappa_max, P[:, -1])
+        F[0, 0] = P[0, 0] - self.paO2_value
+        C = self.concentration(P[:, 0])
+        F[1:, 0] = C[1:] - C[:-1] + self.extraction_factor * (P[:-1, 0] - P[:-1, 1])
+        return F
+
+    def jacobian(self, P):
+        h = self.h
+        kappa_max = self.kappa_max
+        index = self.index
+        extraction_factor = self.extraction_factor
+        rows = []
+        cols = []
+        values = []
+
+        def add(row_index, col_index, value):
+            row_index, col_index, value = np.broadcast_arrays(row_index, col_index, value)
+            rows.append(row_index.ravel())
+            cols.append(col_index.ravel())
+            values.append(value.ravel())
+
+        interior = index[:, 1:-1]
+        add(interior, index[:, :-2], self.lower)
+        add(interior, interior, -2 - h ** 2 * gamma_derivative(kappa_max, P[:, 1:-1]))
+        add(interior, index[:, 2:], self.upper)
+
+        add(index[:, -1], index[:, -2], 2.0)
+        add(index[:, -1], index[:, -1], -2 - h ** 2 * gamma_derivative(kappa_max, P[:, -1]))
+
+        add(index[0, 0], index[0, 0], 1.0)
+        dC = self.concentration_derivative(P[:, 0])
+        add(index[1:, 0], index[1:, 0], dC[1:])
+        add(index[1:, 0], index[:-1, 0], extraction_factor - dC[:-1])
+        add(index[1:, 0], index[:-1, 1], -extraction_factor)
+
+        n = self.z_steps * self.r_steps
+        return scipy.sparse.csc_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                                       shape=(n, n))
+
+
+def integrate_newton(CMRO2, z_capillary, velocity, D, r_Krogh, r_capillary, paO2, Hb, sigma, r_steps, z_steps,
+                     verbose=False, job_number=0, newton_tol=1e-6, newton_max_iterations=100,
+                     max_newton_step=20.0, store_pressure_field=False, initial_field=None, **kwargs):
+    """ Solves for the whole (z, r) oxygen field at once with a sparse Newton method.
+
+    The equations are those of NewtonSystem.  The mass balance uses the same one-sided wall gradient as the marching
+    solver in solver.integrate, so the two engines agree up to the radial discretisation error.
+
+    initial_field is an optional pressure field, in mmHg, from an earlier solve with similar parameters.  It is used
+    as the initial guess instead of the analytic profile, after scaling it to paO2.
+    """
+
+    def log(s):
+        print("[{}] {}".format(job_number, s))
+
+    r_steps, z_steps = get_grid_size(r_steps, z_steps, r_Krogh)
+    system = NewtonSystem(CMRO2, z_capillary, velocity, D, r_Krogh, r_capillary, paO2, Hb, sigma, r_steps, z_steps)
+    kappa_max = system.kappa_max
+    r = system.r
+    dr = system.dr
+    dz = system.dz
+    extraction_factor = system.extraction_factor
+    concentration = system.concentration
+    residual = system.residual
+    jacobian = system.jacobian
+
+    # Start from the analytic Krogh profile for unsaturated consumption.  With that profile every slice extracts the
+    # same amount of O2, which gives the initial capillary pressures by inverting the blood concentration.
+    profile = get_initial_profile(kappa_max, r)
+    extracted = extraction_factor * (profile[0] - profile[1]) * np.arange(z_steps)
+    blood_concentration = concentration(paO2.to(units.mmHg).magnitude) - extracted
+    table = get_o2_concentration_table(sigma, Hb)
+    p_wall = table.get_blood_o2_pressure(blood_concentration * units.mlO2 / units.dL).magnitude
+    P = np.maximum(0, p_wall[:, np.newaxis] + profile)
+
+    if initial_field is not None:
+        initial_field = resample_pressure_field(initial_field, z_steps, r_steps)
+        if initial_field[0, 0] > 0:
+            P = initial_field * (paO2.to(units.mmHg).magnitude / initial_field[0, 0])
+
+    converged = False
+    F = residual(P)
+    for iteration in range(1, newton_max_iterations + 1):
+        with instrumentation.timed("newton_jacobian"):
+            J = jacobian(P)
+        with instrumentation.timed("newton_linear_solve"):
+            step = scipy.sparse.linalg.spsolve(J, -F.ravel()).reshape(P.shape)
+        instrumentation.count("newton_iterations")
+
+        # Damp large steps so that an early iterate can't jump far outside the range where the saturation curve fit
+        # is meaningful.
+        max_step = np.max(np.abs(step))
+        if max_step > max_newton_step:
+            step *= max_newton_step / max_step
+
+        # Backtracking line search on the residual norm.  The sigmoid consumption is almost a step function, so full
+        # Newton steps tend to oscillate around the edge of hypoxic regions.
+        norm = np.linalg.norm(F)
+        alpha = 1.0
+        for _ in range(20):
+            P_next = P + alpha * step
+            F_next = residual(P_next)
+            if np.linalg.norm(F_next) <= (1 - 1e-4 * alpha) * norm:
+                break
+            alpha *= 0.5
+        P = P_next
+        F = F_next
+
+        if verbose:
+            log("Newton iteration %s, max residual: %s, max step: %s, step length: %s"
+                % (iteration, np.max(np.abs(F)), max_step, alpha))
+
+        if max_step < newton_tol:
+            converged = True
+            break
+
+    if not converged:
+        log("Newton solver warning: no convergence after %s iterations" % newton_max_iterations)
+        instrumentation.count("newton_failed_solves")
+
+    min_pressure = np.min(P)
+    if min_pressure < 0:
+        log("Warning: pressures are negative.  Lowest pressure = {}".format(min_pressure))
+
+    p = np.maximum(0, P) * units.mmHg
+
+    with instrumentation.timed("summary"):
+        results = summarise_pressure_field(p, paO2, sigma, Hb, r_capillary, dr, dz)
+    if not store_pressure_field:
+        results["p"] = None
+    results["newton_iterations"] = iteration
+    return results
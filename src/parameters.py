@@ -1,3 +1,5 @@
+import functools
+import hashlib
 import itertools
 import json
 from units import get_units
@@ -10,21 +12,72 @@ def _strip_units(v):
         return v
 
 
-def _add_units(param_values):
+@functools.lru_cache(maxsize=None)
+def _get_parameter_units():
+    """ Returns the units that the plain values of the physical parameters are given in.
+
+    Looking units up in the registry is slow, so this is only done once.  The dict that is returned is shared, so it
+    must not be changed.
+    """
     units = get_units()
+    return {
+        "CMRO2": 1.0 * units.mlO2 / units.hundred_g / units.min,
+        "z_capillary": 1.0 * units.um,
+        "velocity": 1.0 * units.mm / units.sec,
+        "D": 1.0 * units.cm ** 2 / units.sec,
+        "r_Krogh": 1.0 * units.um,
+        "r_capillary": 1.0 * units.um,
+        "paO2": 1.0 * units.mmHg,
+        "Hb": 1.0 * units.g / units.dL,
+        "sigma": 1.0 * units.mlO2 / units.hundred_ml / units.mmHg,
+    }
+
+
+def _add_units(param_values):
     params = param_values.copy()
-    params["CMRO2"] *= (1.0 * units.mlO2 / units.hundred_g / units.min)
-    params["z_capillary"] *= units.um
-    params["velocity"] *= (1.0 * units.mm / units.sec)
-    params["D"] *= (1.0 * units.cm ** 2 / units.sec)
-    params["r_Krogh"] *= units.um
-    params["r_capillary"] *= units.um
-    params["paO2"] *= units.mmHg
-    params["Hb"] *= (1.0 * units.g / units.dL)
-    params["sigma"] *= (1.0 * units.mlO2 / units.hundred_ml / units.mmHg)
+    for name, unit in _get_parameter_units().items():
+        params[name] *= unit
     return params
 
 
+def get_plain_values(params):
+    """ Returns the parameter values as plain numbers, with the physical parameters converted to the units used in
+    the parameter files. """
+    parameter_units = _get_parameter_units()
+    values = {}
+    for name, value in params.items():
+        if name in parameter_units:
+            value = value.to(parameter_units[name].units).magnitude
+        values[name] = value
+    return values
+
+
+def from_plain_values(values):
+    """ Returns Parameters for plain values in the units used in the parameter files, as given by get_plain_values.
+    """
+    parameter_units = _get_parameter_units()
+    return Parameters({name: value * parameter_units[name].units if name in parameter_units else value
+                       for name, value in values.items()})
+
+
+def get_params_hash(params, ignored=(), extra_values=None, significant_digits=None):
+    """ Returns a hash of the parameter values, leaving out the names in ignored.
+
+    The physical parameters are converted to the units used in the parameter files first, so the same point
+    specified in different units has the same hash.  Any extra_values are included as if they were parameters.  With
+    significant_digits, floats are rounded to that many significant digits first, so that values that only differ
+    by rounding errors, like 200 * 1.1 and 220, have the same hash.
+    """
+    values = {name: value for name, value in get_plain_values(params).items() if name not in ignored}
+    if extra_values is not None:
+        values.update(extra_values)
+    if significant_digits is not None:
+        values = {name: float("{:.{}g}".format(value, significant_digits)) if isinstance(value, float) else value
+                  for name, value in values.items()}
+    key_string = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha256(key_string.encode("utf-8")).hexdigest()
+
+
 class Parameters:
     def __init__(self, param_dict=None):
         self.param_dict = param_dict
@@ -56,20 +109,44 @@ class Parameters:
         return self.param_dict.__setitem__(key, value)
 
 
-def create_param_grid(param_dict):
-    """ Creates a parameter grid from a dictionary of parameter names to lists of values. """
+def get_param_grid_size(param_dict):
+    """ Returns the number of points in the parameter grid of param_dict. """
+    size = 1
+    for _, values in param_dict.items():
+        size *= len(values)
+    return size
 
-    grid = []
 
-    names = list(param_dict.keys())
+def iterate_param_grid(param_dict, shard=None):
+    """ Yields the index and the Parameters of each point in the parameter grid of param_dict, one at a time.
 
+    With shard = (i, n), only the points whose index is i modulo n are yielded, so that n runs with i from 0 to n - 1
+    split the grid between them.  The indices are always those in the full grid.
+    """
+    names = list(param_dict.keys())
     values_lists = [param_dict[name] for name in names]
 
-    for values in itertools.product(*values_lists):
-        grid_point = Parameters({name: value for name, value in zip(names, values)})
-        grid.append(grid_point)
+    shard_index, shard_count = shard if shard is not None else (0, 1)
+    points = itertools.islice(itertools.product(*values_lists), shard_index, None, shard_count)
+    for index, values in zip(itertools.count(shard_index, shard_count), points):
+        yield index, Parameters({name: value for name, value in zip(names, values)})
+
+
+def parse_shard(text):
+    """ Parses a shard given as "i/n", for the ith of n shards counting from 1, into the (i - 1, n) that
+    iterate_param_grid takes. """
+    try:
+        shard_number, shard_count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise ValueError("A shard must be given as i/n, e.g. 1/4, not {}".format(text))
+    if not 1 <= shard_number <= shard_count:
+        raise ValueError("Shard {} is not between 1 and {}".format(shard_number, shard_count))
+    return shard_number - 1, shard_count
+
 
-    return grid
+def create_param_grid(param_dict):
+    """ Creates a parameter grid from a dictionary of parameter names to lists of values. """
+    return [params for _, params in iterate_param_grid(param_dict)]
 
 
 def load_param_values(file_name):
@@ -2,29 +2,180 @@ import sys
 from parameters import *
 from evaluate import evaluate_points
 from data import *
+from result_cache import print_cache_stats
 from units import get_units
-import random
+from work_queue import WorkQueue, evaluate_points_with_queue
+import functools
+import numpy as np
+from scipy.stats import qmc
 
 
-def get_random_params(param_ranges):
+SAMPLING_METHODS = ["random", "lhs", "sobol"]
+
+# The base results that adaptive sampling puts more points where they change fastest.
+ADAPTIVE_RESULTS = ["pbO2", "hypoxic_fraction"]
+
+
+def get_varying_names(param_ranges):
+    """ Returns the names of the parameters that are given as a [min, max] range rather than a single value. """
+    return [name for name, value_range in param_ranges.items() if len(value_range) > 1]
+
+
+def get_unit_samples(num_points, dimensions, method="lhs", seed=None):
+    """ Returns num_points samples in the unit cube of the given number of dimensions.
+
+    method is "random" for independent uniform samples, "lhs" for a Latin hypercube, or "sobol" for a scrambled
+    Sobol sequence.  The same seed always gives the same samples.
+    """
+    if method == "random":
+        return np.random.default_rng(seed).random((num_points, dimensions))
+    if method == "lhs":
+        return qmc.LatinHypercube(dimensions, seed=seed).random(num_points)
+    if method == "sobol":
+        # Sobol points are only balanced in powers of 2, so draw the next power of 2 and drop the extra points.
+        m = max(0, int(np.ceil(np.log2(max(num_points, 1)))))
+        return qmc.Sobol(dimensions, seed=seed).random_base2(m)[:num_points]
+    raise ValueError("Unknown sampling method: {}".format(method))
+
+
+def get_params_at(param_ranges, unit_point):
+    """ Returns the parameters at a point in the unit cube, whose coordinates are the varying parameters in the
+    order of get_varying_names. """
     params = {}
+    names = get_varying_names(param_ranges)
     for name, value_range in param_ranges.items():
         if len(value_range) == 1:
             params[name] = value_range[0]
         else:
             range_min, range_max = value_range.magnitude
-            range_size = range_max = range_min
-            value = range_min + range_size * random.random()
+            range_size = range_max - range_min
+            value = range_min + range_size * unit_point[names.index(name)]
             params[name] = value * value_range.units
     return params
 
 
+def get_random_params(param_ranges, seed=None):
+    return get_params_at(param_ranges, get_unit_samples(1, len(get_varying_names(param_ranges)), "random", seed)[0])
+
+
+def get_sample_params(param_ranges, num_points, method="lhs", seed=None):
+    """ Returns num_points parameter sets spread over param_ranges with the given sampling method. """
+    unit_points = get_unit_samples(num_points, len(get_varying_names(param_ranges)), method, seed)
+    return [get_params_at(param_ranges, unit_point) for unit_point in unit_points]
+
+
+def get_result_values(results_list):
+    """ Returns an array with the ADAPTIVE_RESULTS of the base results of each point, each scaled by its range over
+    the points so that they count equally. """
+    values = np.array([[float(getattr(results["base_results"][name], "magnitude", results["base_results"][name]))
+                        for name in ADAPTIVE_RESULTS] for results in results_list])
+    value_range = np.max(values, axis=0) - np.min(values, axis=0)
+    value_range[value_range == 0] = 1.0
+    return values / value_range
+
+
+def get_adaptive_unit_points(unit_points, values, num_points, method="lhs", seed=None, num_neighbours=4,
+                             candidates_per_point=20):
+    """ Returns num_points new points in the unit cube, placed where the results change fastest.
+
+    unit_points are the points evaluated so far and values their results from get_result_values.  The rate of
+    change at each evaluated point is estimated as the largest change in the results to one of its num_neighbours
+    nearest neighbours, divided by the distance to it.  The new points are picked in turn from a space-filling set
+    of candidates, each time taking the candidate with the largest rate at its nearest evaluated point times the
+    distance to the nearest point evaluated or already picked.  The distance keeps the new points apart, and lets
+    regions where nothing seems to change still get a point now and then.
+    """
+    num_evaluated, dimensions = unit_points.shape
+    distances = np.sqrt(np.sum((unit_points[:, np.newaxis, :] - unit_points[np.newaxis, :, :]) ** 2, axis=2))
+    np.fill_diagonal(distances, np.inf)
+    changes = np.max(np.abs(values[:, np.newaxis, :] - values[np.newaxis, :, :]), axis=2)
+
+    num_neighbours = min(num_neighbours, num_evaluated - 1)
+    rates = np.zeros(num_evaluated)
+    if num_neighbours > 0:
+        neighbours = np.argsort(distances, axis=1)[:, :num_neighbours]
+        rows = np.arange(num_evaluated)[:, np.newaxis]
+        rates = np.max(changes[rows, neighbours] / distances[rows, neighbours], axis=1)
+    if np.max(rates) == 0:
+        rates[:] = 1.0
+
+    candidates = get_unit_samples(num_points * candidates_per_point, dimensions, method, seed)
+    candidate_distances = np.sqrt(np.sum((candidates[:, np.newaxis, :] - unit_points[np.newaxis, :, :]) ** 2,
+                                         axis=2))
+    candidate_rates = rates[np.argmin(candidate_distances, axis=1)]
+    nearest_distances = np.min(candidate_distances, axis=1)
+
+    new_points = []
+    for _ in range(min(num_points, len(candidates))):
+        best = int(np.argmax(candidate_rates * nearest_distances))
+        new_points.append(candidates[best])
+        nearest_distances = np.minimum(nearest_distances, np.sqrt(np.sum((candidates - candidates[best]) ** 2,
+                                                                          axis=1)))
+        nearest_distances[best] = 0.0
+
+    return np.array(new_points).reshape(-1, dimensions)
+
+
+def sample_adaptively(param_ranges, num_points, rounds, method="lhs", seed=None, evaluate=evaluate_points):
+    """ Evaluates num_points points over param_ranges in rounds, returning the params and results of all of them.
+
+    The first round spreads its points evenly with the given sampling method, and each round after that puts its
+    points where the results of the rounds so far change fastest (see get_adaptive_unit_points).  Each round is one
+    call to evaluate, so all of its points share the process pool.
+    """
+    names = get_varying_names(param_ranges)
+    round_sizes = [num_points // rounds + (1 if i < num_points % rounds else 0) for i in range(rounds)]
+    rng = np.random.default_rng(seed)
+
+    unit_points = np.zeros((0, len(names)))
+    params_list = []
+    results_list = []
+    for round_number, round_size in enumerate(round_sizes):
+        if round_size == 0:
+            continue
+        round_seed = int(rng.integers(2 ** 32))
+        if len(results_list) < 2:
+            new_unit_points = get_unit_samples(round_size, len(names), method, round_seed)
+        else:
+            new_unit_points = get_adaptive_unit_points(unit_points, get_result_values(results_list), round_size,
+                                                       method, round_seed)
+
+        print("Round {} of {}: evaluating {} points.".format(round_number + 1, rounds, len(new_unit_points)))
+        round_params = [get_params_at(param_ranges, unit_point) for unit_point in new_unit_points]
+        for i, params in enumerate(round_params):
+            params["job_number"] = len(params_list) + i + 1
+
+        unit_points = np.concatenate([unit_points, new_unit_points])
+        params_list += round_params
+        results_list += evaluate(round_params)
+
+    return params_list, results_list
+
+
 if __name__ == "__main__":
-    num_points = 100
-    if len(sys.argv) > 1:
-        num_points = int(sys.argv[1])
+    # Usage: python random_grid.py [NUM_POINTS] [--method=random|lhs|sobol] [--seed=N] [--rounds=N] [--queue=FILE]
+    #                               [--engine=ENGINE]
+    # With more than one round, each round after the first adds points where pbO2 and the hypoxic fraction change
+    # fastest.  With --queue, the points go through a work queue that workers on other hosts can help with (see
+    # work_queue.py).  --engine picks the solver engine of integrate, which is the march engine by default.
+    # --engine=batch solves the points together in batches, which is much faster for a sweep like this one.
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    options = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if arg.startswith("--") and "=" in arg)
 
-    print("Using %s random points." % num_points)
+    num_points = 100
+    if len(args) > 0:
+        num_points = int(args[0])
+    method = options.get("method", "lhs")
+    seed = int(options["seed"]) if "seed" in options else None
+    rounds = int(options.get("rounds", 1))
+    engine = options.get("engine", "march")
+
+    if method not in SAMPLING_METHODS:
+        print("Unknown sampling method: {}.  The methods are: {}".format(method, ", ".join(SAMPLING_METHODS)))
+        sys.exit(1)
+
+    print("Using {} points from {} sampling in {} round(s), seed {}, with the {} engine.".format(
+        num_points, method, rounds, seed, engine))
     print("Results will be saved to random_grid_results.csv")
     units = get_units()
 
@@ -65,11 +216,19 @@ if __name__ == "__main__":
         "test": [False],
         "paO2_multiple": [1.0],
         "velocity_multiple": [1.0],
-        "no_search": [True]
+        "no_search": [True],
+
+        "engine": [engine],
+
+        # Reuse the results of earlier runs.
+        "cache_dir": ["integrate_cache"]
     }
 
-    param_grid = [get_random_params(param_ranges) for i in range(num_points)]
+    evaluate = evaluate_points
+    if "queue" in options:
+        evaluate = functools.partial(evaluate_points_with_queue, WorkQueue(options["queue"]))
 
-    results = evaluate_points(param_grid)
+    _, results = sample_adaptively(param_ranges, num_points, rounds, method, seed, evaluate)
 
     export_csv('random_grid_results.csv', results)
+    print_cache_stats()
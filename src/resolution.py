@@ -0,0 +1,100 @@
+from solver import get_grid_size
+
+
+# The results that the resolution is refined for, and whether their error is measured relative to their value.
+# The hypoxic fraction is already a fraction, and is often zero, so its error is absolute.
+CONVERGED_RESULTS = [
+    ("pbO2", True),
+    ("hypoxic_fraction", False),
+    ("jugular_venous_o2_sat", True),
+]
+
+
+def _magnitude(value):
+    return float(getattr(value, "magnitude", value))
+
+
+def richardson_extrapolate(values, order=1):
+    """ Extrapolates a result to zero step size from its values on grids that are each twice as fine as the last.
+
+    The solver's error is first order in the step sizes, from the one-sided gradient at the capillary wall and the
+    explicit capillary mass balance.  Returns the extrapolated value and the estimated error of the last value.
+    """
+    correction = (values[-1] - values[-2]) / (2 ** order - 1)
+    return values[-1] + correction, abs(correction)
+
+
+def integrate_to_tolerance(integrate_function, params, resolution_tol, resolution_levels=4,
+                           resolution_extrapolate=False):
+    """ Runs integrate_function(**params) on finer and finer grids until the results converge to resolution_tol.
+
+    The first grid has r_steps and z_steps divided by 2 ** (resolution_levels - 1), and each grid after that doubles
+    both, so params["r_steps"] and params["z_steps"] are the finest resolution that is tried.  After each grid, the
+    results in CONVERGED_RESULTS are Richardson extrapolated from the grids so far, and the refinement stops once
+    all of their estimated errors are within resolution_tol.
+
+    resolution_levels must be at least 2, since the errors are estimated from the change between grids.
+
+    Returns the results on the last grid, with the step counts used on it (after the scaling by r_Krogh of
+    solver.get_grid_size), the extrapolated values and the estimated errors added as "r_steps_used",
+    "z_steps_used", "<name>_extrapolated" and "<name>_error".  With resolution_extrapolate, the results in
+    CONVERGED_RESULTS are replaced by their extrapolated values, and the errors are estimated from the change in
+    those between the last two grids, which usually meets a tolerance on a much coarser grid.
+    """
+    if resolution_levels < 2:
+        raise ValueError("resolution_levels must be at least 2 to estimate the errors, not %s" % resolution_levels)
+    job_number = params.get("job_number", 0)
+
+    values = {name: [] for name, _ in CONVERGED_RESULTS}
+    extrapolated_values = {name: [] for name, _ in CONVERGED_RESULTS}
+    for level in range(resolution_levels):
+        scale = 2 ** (resolution_levels - 1 - level)
+        level_params = dict(params)
+        level_params["r_steps"] = max(3, int(round(params["r_steps"] / scale)))
+        level_params["z_steps"] = max(1, int(round(params["z_steps"] / scale)))
+        results = integrate_function(**level_params)
+        r_steps_used, z_steps_used = get_grid_size(level_params["r_steps"], level_params["z_steps"],
+                                                   params["r_Krogh"])
+
+        for name, _ in CONVERGED_RESULTS:
+            values[name].append(results[name])
+
+        if level == 0:
+            continue
+
+        converged = True
+        for name, is_relative in CONVERGED_RESULTS:
+            extrapolated, error = richardson_extrapolate(values[name])
+            extrapolated_values[name].append(extrapolated)
+            results[name + "_extrapolated"] = extrapolated
+
+            if resolution_extrapolate:
+                if len(extrapolated_values[name]) < 2:
+                    # The error in the extrapolation needs another grid to estimate.
+                    converged = False
+                    results[name + "_error"] = None
+                    continue
+                error = abs(extrapolated - extrapolated_values[name][-2])
+            results[name + "_error"] = error
+
+            error = _magnitude(error)
+            if is_relative:
+                size = max(abs(_magnitude(values[name][-1])), abs(_magnitude(extrapolated)))
+                if size > 0:
+                    error /= size
+            if error > resolution_tol:
+                converged = False
+
+        if converged:
+            break
+    else:
+        print("[{}] Resolution warning: not converged to {} at r_steps = {}, z_steps = {}"
+              .format(job_number, resolution_tol, r_steps_used, z_steps_used))
+
+    if resolution_extrapolate:
+        for name, _ in CONVERGED_RESULTS:
+            results[name] = results[name + "_extrapolated"]
+
+    results["r_steps_used"] = r_steps_used
+    results["z_steps_used"] = z_steps_used
+    return results
@@ -0,0 +1,236 @@
+import inspect
+import os
+import pickle
+from data import save_results
+from parameters import get_params_hash
+from batch_solver import integrate_batch
+from solver import SOLVER_VERSION, integrate
+
+
+# Parameters that don't change the results of integrate, and so are left out of the cache key.
+_IGNORED_PARAMETERS = {
+    "job_number", "verbose", "report_interval", "no_search", "paO2_multiple", "velocity_multiple", "search_tol",
+    "search_max_evaluations", "cache_dir", "cache_max_bytes", "cache_pressure_field", "store_pressure_field",
+    "continuation", "initial_field", "slice_table_dir", "slice_table_max_bytes",
+}
+
+# The defaults of integrate's options, which are hashed along with the given parameters, so that cached results
+# aren't reused after a default, e.g. of the engine or of the discretisation, changes.
+_INTEGRATE_DEFAULTS = {
+    name: parameter.default for name, parameter in inspect.signature(integrate).parameters.items()
+    if parameter.default is not inspect.Parameter.empty and name not in _IGNORED_PARAMETERS
+}
+
+# An eviction brings the cache down to this fraction of its maximum size, so that the next one is only needed once
+# that much more has been written.
+_EVICTION_TARGET = 0.9
+
+# The estimated size in bytes of each cache directory used in this process: its size at the last scan plus the
+# entries written since.
+_cache_bytes = {}
+
+# Hits and misses in this process, plus any added from worker processes with add_cache_stats.
+_stats = {
+    "hits": 0,
+    "misses": 0,
+}
+
+
+def get_cache_key(params):
+    """ Returns a hash of the parameters that affect the results of integrate, with integrate's defaults for any
+    that aren't given, and of the solver version. """
+    return get_params_hash(dict(_INTEGRATE_DEFAULTS, **params), _IGNORED_PARAMETERS,
+                           {"solver_version": SOLVER_VERSION})
+
+
+def get_solve_key(params):
+    """ Returns a hash that is the same for any two parameter sets that integrate gives the same results for, up to
+    rounding errors in the parameters, for finding duplicate solves within a run. """
+    return get_params_hash(params, _IGNORED_PARAMETERS,
+                           {"store_pressure_field": params.get("store_pressure_field", False)}, significant_digits=12)
+
+
+def read_cache_entry(path):
+    """ Returns the entry saved at path by write_cache_entry, or None if there is none, and marks it as recently used
+    so that it is evicted last. """
+    try:
+        with open(path, 'rb') as f:
+            results = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        # Missing, or only partly written by a process that crashed.
+        return None
+
+    # Mark the entry as recently used for the eviction.
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+    return results
+
+
+def _evict(cache_dir, max_bytes):
+    """ Deletes the least recently used entries, if the cache is bigger than max_bytes, until it is smaller than
+    _EVICTION_TARGET times that.  Returns the size of the cache afterwards. """
+    entries = []
+    total_bytes = 0
+    for root, _, file_names in os.walk(cache_dir):
+        for file_name in file_names:
+            if not file_name.endswith(".pickle"):
+                continue
+            path = os.path.join(root, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_bytes += stat.st_size
+
+    if total_bytes <= max_bytes:
+        return total_bytes
+
+    entries.sort()
+    for _, size, path in entries:
+        try:
+            os.remove(path)
+        except OSError:
+            # Another process got there first.
+            pass
+        total_bytes -= size
+        if total_bytes <= _EVICTION_TARGET * max_bytes:
+            break
+    return total_bytes
+
+
+def _add_entry_bytes(cache_dir, max_bytes, entry_bytes):
+    # Adds a new entry to the estimated size of the cache, and only scans the cache to evict entries once the
+    # estimate passes max_bytes.  The first entry in each process scans it anyway, since the estimate starts from
+    # there and other processes may have added to the cache.  Their entries aren't counted until the next scan, so
+    # the cache can grow past max_bytes by what the other processes add between scans.
+    estimate = _cache_bytes.get(cache_dir)
+    if estimate is None or estimate + entry_bytes > max_bytes:
+        _cache_bytes[cache_dir] = _evict(cache_dir, max_bytes)
+    else:
+        _cache_bytes[cache_dir] = estimate + entry_bytes
+
+
+def write_cache_entry(path, entry, cache_dir, max_bytes):
+    """ Saves entry at path, somewhere under cache_dir, and deletes the least recently used entries under cache_dir
+    once they take up more than max_bytes. """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    save_results(path, entry)
+    _add_entry_bytes(cache_dir, max_bytes, os.path.getsize(path))
+
+
+def _get_entry_path(cache_dir, params):
+    key = get_cache_key(params)
+    return os.path.join(cache_dir, key[:2], key + ".pickle")
+
+
+def _load_cached_results(path, store_pressure_field):
+    """ Returns the cached results at path, or None if there are none with everything that was asked for. """
+    results = read_cache_entry(path)
+    if results is not None and (results["p"] is not None or not store_pressure_field):
+        _stats["hits"] += 1
+        if not store_pressure_field:
+            results["p"] = None
+        return results
+
+    _stats["misses"] += 1
+    return None
+
+
+def _save_cached_results(path, results, cache_dir, cache_max_bytes, cache_pressure_field, store_pressure_field):
+    entry = dict(results)
+    if not cache_pressure_field:
+        entry["p"] = None
+    write_cache_entry(path, entry, cache_dir, cache_max_bytes)
+
+    if not store_pressure_field:
+        results["p"] = None
+    return results
+
+
+def cached_integrate(cache_dir=None, cache_max_bytes=1e9, cache_pressure_field=False,
+                     keep_solved_pressure_field=False, **params):
+    """ Calls integrate(**params), reusing the results from an earlier call with the same parameters if possible.
+
+    The results are stored under cache_dir, one file per parameter set, and the least recently used ones are
+    deleted once the cache grows beyond cache_max_bytes.  The pressure field "p" is only stored if
+    cache_pressure_field is set, and only returned if store_pressure_field is set, as for integrate.  Without a
+    cache_dir, or in test mode, this is just integrate.
+
+    With keep_solved_pressure_field, the pressure field is returned whenever integrate is actually called, but
+    cached results without one are still used.  This is for seeding later solves from the results.
+    """
+    store_pressure_field = params.get("store_pressure_field", False)
+    return_pressure_field = store_pressure_field or keep_solved_pressure_field
+
+    if cache_dir is None or params.get("test", False):
+        params["store_pressure_field"] = return_pressure_field
+        return integrate(**params)
+
+    path = _get_entry_path(cache_dir, params)
+
+    results = _load_cached_results(path, store_pressure_field)
+    if results is not None:
+        return results
+
+    params["store_pressure_field"] = return_pressure_field or cache_pressure_field
+    return _save_cached_results(path, integrate(**params), cache_dir, cache_max_bytes, cache_pressure_field,
+                                return_pressure_field)
+
+
+def cached_integrate_batch(params_list):
+    """ Solves every parameter set in params_list with batch_solver.integrate_batch, using the cache as for
+    cached_integrate.
+
+    Only the parameter sets that aren't in the cache are solved, together in one batch.  The parameter sets should
+    have engine set to "batch", so that their results are cached under the engine that produced them.
+    """
+    results_list = [None] * len(params_list)
+    misses = []
+
+    for i, params in enumerate(params_list):
+        params = dict(params)
+        cache_dir = params.pop("cache_dir", None)
+        cache_max_bytes = params.pop("cache_max_bytes", 1e9)
+        cache_pressure_field = params.pop("cache_pressure_field", False)
+        store_pressure_field = params.get("store_pressure_field", False)
+
+        if cache_dir is None or params.get("test", False):
+            misses.append((i, params, None))
+            continue
+
+        path = _get_entry_path(cache_dir, params)
+        params["store_pressure_field"] = store_pressure_field or cache_pressure_field
+
+        results_list[i] = _load_cached_results(path, store_pressure_field)
+        if results_list[i] is None:
+            misses.append((i, params, (path, cache_dir, cache_max_bytes, cache_pressure_field, store_pressure_field)))
+
+    if len(misses) > 0:
+        batch_results = integrate_batch([params for _, params, _ in misses])
+        for (i, _, cache_entry), results in zip(misses, batch_results):
+            if cache_entry is not None:
+                results = _save_cached_results(cache_entry[0], results, *cache_entry[1:])
+            results_list[i] = results
+
+    return results_list
+
+
+def get_cache_stats():
+    return dict(_stats)
+
+
+def add_cache_stats(stats):
+    for name, value in stats.items():
+        _stats[name] += value
+
+
+def print_cache_stats():
+    hits = _stats["hits"]
+    misses = _stats["misses"]
+    if hits + misses > 0:
+        print("Result cache: {} hits, {} misses ({:.1f}% hit rate).".format(hits, misses,
+                                                                           100.0 * hits / (hits + misses)))
@@ -0,0 +1,101 @@
+import instrumentation
+import numpy as np
+import scipy.sparse.linalg
+from newton_solver import NewtonSystem
+from solver import summarise_pressure_field
+from units import get_units
+
+
+units = get_units()
+
+# The parameters that sensitivities can be found for, and the results whose sensitivities are found.
+SENSITIVITY_PARAMETERS = ["CMRO2", "z_capillary", "velocity", "D", "r_Krogh", "r_capillary", "paO2", "Hb", "sigma"]
+SENSITIVITY_RESULTS = ["pbO2", "hypoxic_fraction", "jugular_venous_o2_sat"]
+
+# Hypoxic tissue is tissue at or below this pressure, as in solver.PressureFieldSummary.
+HYPOXIC_PRESSURE = 10.0
+
+
+def get_interpolated_hypoxic_fraction(P, r):
+    """ Returns the fraction of the cylinder at or below HYPOXIC_PRESSURE, taking the pressure to vary linearly
+    between the radial nodes r.
+
+    The hypoxic fraction in the summary counts whole elements, so it only changes when a node crosses the threshold
+    and its derivative is zero almost everywhere.  This one moves smoothly with the boundary of the hypoxic region.
+    """
+    inner = r[:-1]
+    outer = r[1:]
+    p_inner = P[:, :-1]
+    p_outer = P[:, 1:]
+
+    # The fraction of each interval between nodes that is hypoxic, and which end of it the hypoxic part is at.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossing = np.clip((HYPOXIC_PRESSURE - p_inner) / (p_outer - p_inner), 0.0, 1.0)
+    is_inner_hypoxic = p_inner <= HYPOXIC_PRESSURE
+    is_outer_hypoxic = p_outer <= HYPOXIC_PRESSURE
+    crossing_radius = inner + crossing * (outer - inner)
+
+    hypoxic_area = np.where(is_inner_hypoxic & is_outer_hypoxic, outer ** 2 - inner ** 2, 0.0)
+    hypoxic_area += np.where(is_inner_hypoxic & ~is_outer_hypoxic, crossing_radius ** 2 - inner ** 2, 0.0)
+    hypoxic_area += np.where(~is_inner_hypoxic & is_outer_hypoxic, outer ** 2 - crossing_radius ** 2, 0.0)
+    return np.sum(hypoxic_area) / (P.shape[0] * (r[-1] ** 2 - r[0] ** 2))
+
+
+def _get_result_values(P, system, params):
+    # The values of SENSITIVITY_RESULTS for the field P, as plain floats, and their units.
+    results = summarise_pressure_field(P * units.mmHg, params["paO2"], params["sigma"], params["Hb"],
+                                       params["r_capillary"], system.dr, system.dz)
+    results["hypoxic_fraction"] = get_interpolated_hypoxic_fraction(P, system.r) * units.dimensionless
+    values = {}
+    for name in SENSITIVITY_RESULTS:
+        # The saturation is a plain number.
+        value = results[name]
+        values[name] = (getattr(value, "magnitude", value), getattr(value, "units", units.dimensionless))
+    return values
+
+
+def get_sensitivities(p, names, relative_step=1e-6, **params):
+    """ Returns the derivatives of the results in SENSITIVITY_RESULTS with respect to each parameter in names, at the
+    solution p of integrate(**params).
+
+    The derivatives are found from the equations of NewtonSystem, linearised about p: the derivative of the field
+    with respect to a parameter q is -J^-1 dF/dq, where J is the Jacobian of the residual F.  J is factorised once
+    and dF/dq is a difference of two residual evaluations, so each parameter costs a back substitution and two
+    summaries, rather than a solve.  p can come from any engine, since they all solve the same equations up to the
+    discretisation error.  The derivative of the hypoxic fraction is that of get_interpolated_hypoxic_fraction.
+
+    Returns a dict mapping each result name to a dict of its derivatives by parameter name, as quantities.
+    """
+    for name in names:
+        if name not in SENSITIVITY_PARAMETERS:
+            raise ValueError("Unknown sensitivity parameter: {}.  The parameters are: {}"
+                             .format(name, ", ".join(SENSITIVITY_PARAMETERS)))
+
+    P = p.to(units.mmHg).magnitude
+    z_steps, r_steps = P.shape
+    system_params = {name: params[name] for name in SENSITIVITY_PARAMETERS}
+
+    with instrumentation.timed("sensitivity_factorisation"):
+        system = NewtonSystem(r_steps=r_steps, z_steps=z_steps, **system_params)
+        F = system.residual(P)
+        lu = scipy.sparse.linalg.splu(system.jacobian(P))
+    values = _get_result_values(P, system, system_params)
+
+    gradient = {result_name: {} for result_name in SENSITIVITY_RESULTS}
+    for name in names:
+        with instrumentation.timed("sensitivity_parameter"):
+            step = params[name] * relative_step
+            perturbed_params = dict(system_params)
+            perturbed_params[name] = params[name] + step
+            perturbed_system = NewtonSystem(r_steps=r_steps, z_steps=z_steps, **perturbed_params)
+
+            # The change in the field for the step in the parameter, to first order.
+            dP = lu.solve(-(perturbed_system.residual(P) - F).ravel()).reshape(P.shape)
+            perturbed_values = _get_result_values(P + dP, perturbed_system, perturbed_params)
+
+            for result_name in SENSITIVITY_RESULTS:
+                value, value_units = values[result_name]
+                derivative = (perturbed_values[result_name][0] - value) / step.magnitude
+                gradient[result_name][name] = derivative * value_units / step.units
+
+    return gradient
@@ -0,0 +1,228 @@
+import functools
+import os
+import sys
+import numpy as np
+from result_cache import read_cache_entry, write_cache_entry
+from sensitivity import HYPOXIC_PRESSURE
+from solver import PressureFieldSummary, consumption_coefficient, get_extraction_factor, get_grid_size, \
+    get_initial_profile, get_o2_concentration_table, get_blood_o2_concentration_value, get_radial_coefficients, \
+    integrate, solve_radial_slices
+from units import get_units
+
+
+units = get_units()
+
+# Bump this whenever a change to the way the tables are built changes them, so that old tables on disk aren't used.
+TABLE_VERSION = 3
+
+# The pressure scale of the slice problem: the pressure at which the consumption of solver.gamma is half its
+# maximum.  Pressures in the tables are in units of this.
+CONSUMPTION_PRESSURE = 1.0
+
+# Dimensionless wall pressures in each node's table, which are closer together at low pressures, where the hypoxic
+# region appears.  The highest is raised in steps of 1000 for an arterial pressure above it.
+TABLE_PRESSURES = 129
+TABLE_MAX_PRESSURE = 1000.0
+
+# Spacing of the nodes that the tables are built at, in nodes per decade of each dimensionless group.
+CONSUMPTION_NODES_PER_DECADE = 32
+RATIO_NODES_PER_DECADE = 128
+
+# The responses of a slice that are tabulated for each wall pressure.
+TABLE_RESPONSES = ["wall_gradient", "average_pressure", "hypoxic_fraction"]
+
+# The results that the table engine estimates its interpolation error for.
+TABLE_ERROR_RESULTS = ["pbO2", "hypoxic_fraction", "jugular_venous_o2_sat"]
+
+
+def get_slice_groups(CMRO2, D, sigma, r_Krogh, r_capillary):
+    """ Returns the two dimensionless groups that a slice's radial problem depends on, besides its dimensionless wall
+    pressure and the number of radial nodes: the consumption CMRO2 / (D sigma) r_capillary^2 / CONSUMPTION_PRESSURE,
+    and r_Krogh / r_capillary.
+
+    With x = r / r_capillary and pressures in units of CONSUMPTION_PRESSURE, the radial Krogh ODE is
+    p'' + p' / x = consumption * gamma(p) on 1 <= x <= ratio, with the gamma of solver.gamma for a maximum
+    consumption of 1.
+    """
+    r_capillary_value = r_capillary.to(units.um).magnitude
+    consumption = consumption_coefficient(CMRO2, D, sigma) * r_capillary_value ** 2 / CONSUMPTION_PRESSURE
+    ratio = (r_Krogh / r_capillary).to(units.dimensionless).magnitude
+    return consumption, ratio
+
+
+def build_slice_responses(consumption, ratio, r_steps, max_pressure=TABLE_MAX_PRESSURE, pressures=TABLE_PRESSURES,
+                          newton_tol=1e-6, newton_max_iterations=100):
+    """ Solves the dimensionless radial problem of get_slice_groups for a range of wall pressures, and returns the
+    responses of each slice that the march along the capillary needs.
+
+    The radial ODE is discretised on r_steps nodes exactly as in the batch and Newton engines.  Returns a dict of
+    arrays with one value for each wall pressure: the wall pressures ("wall_pressure"), the one-sided pressure
+    gradient at the wall, (p[0] - p[1]) / dx ("wall_gradient"), the pressure averaged over the volume of the slice
+    ("average_pressure") and the fraction of that volume at or below HYPOXIC_PRESSURE ("hypoxic_fraction"), with the
+    element volumes of solver.PressureFieldSummary.  Pressures and gradients are dimensionless.
+    """
+    x = np.linspace(1.0, ratio, r_steps)
+    wall_pressure = max_pressure * np.linspace(0, 1, pressures) ** 2
+
+    coefficients = [np.tile(values, (pressures, 1)) for values in get_radial_coefficients(x, consumption)]
+    P = np.maximum(0, wall_pressure[:, np.newaxis] + get_initial_profile(consumption, x))
+    P, _, max_step = solve_radial_slices(P, wall_pressure, *coefficients, newton_tol=newton_tol,
+                                         newton_max_iterations=newton_max_iterations)
+    if np.any(max_step >= newton_tol):
+        print("Slice table warning: no convergence after {} iterations".format(newton_max_iterations))
+    P = np.maximum(0, P)
+
+    element_width = (ratio - 1) / r_steps
+    inner_radii = 1 + np.arange(0, r_steps) * element_width
+    element_volumes = (inner_radii + element_width) ** 2 - inner_radii ** 2
+    element_volumes /= np.sum(element_volumes)
+
+    return {
+        "wall_pressure": wall_pressure,
+        "wall_gradient": (P[:, 0] - P[:, 1]) / (x[1] - x[0]),
+        "average_pressure": P @ element_volumes,
+        "hypoxic_fraction": (P <= HYPOXIC_PRESSURE / CONSUMPTION_PRESSURE) @ element_volumes,
+    }
+
+
+@functools.lru_cache(maxsize=64)
+def get_node_responses(consumption_node, ratio_node, r_steps, max_pressure, table_dir, table_max_bytes):
+    """ Returns the slice responses at the table node with consumption 10^(consumption_node /
+    CONSUMPTION_NODES_PER_DECADE) and ratio 10^(ratio_node / RATIO_NODES_PER_DECADE), from table_dir if they have
+    been built before, and saves them there otherwise.  The least recently used nodes are deleted once table_dir
+    takes up more than table_max_bytes, as for the result cache.  Nodes used recently in this process are kept in
+    memory, and without table_dir, nodes are only kept in memory. """
+    path = None
+    if table_dir is not None:
+        path = os.path.join(table_dir, "v{}_{}_{}_{}_{:.10g}_{}.pickle".format(
+            TABLE_VERSION, consumption_node, ratio_node, r_steps, max_pressure, TABLE_PRESSURES))
+        responses = read_cache_entry(path)
+        if responses is not None:
+            return responses
+
+    responses = build_slice_responses(10 ** (consumption_node / CONSUMPTION_NODES_PER_DECADE),
+                                      10 ** (ratio_node / RATIO_NODES_PER_DECADE), r_steps, max_pressure)
+    if path is not None:
+        write_cache_entry(path, responses, table_dir, table_max_bytes)
+    return responses
+
+
+def _get_node_weights(value, nodes_per_decade, stride):
+    # The two nodes, stride apart, either side of value, with the weights for interpolating linearly in log(value).
+    position = np.log10(value) * nodes_per_decade
+    lower = int(np.floor(position / stride)) * stride
+    t = (position - lower) / stride
+    return [(lower, 1 - t), (lower + stride, t)]
+
+
+def get_slice_table(consumption, ratio, r_steps, max_pressure=TABLE_MAX_PRESSURE, table_dir=None,
+                    table_max_bytes=1e8, stride=1):
+    """ Returns the slice responses for the given groups and number of radial nodes, interpolated bilinearly in the
+    logs of the groups between the four surrounding nodes of get_node_responses.  Any run whose groups fall between
+    the same nodes shares them, so a sweep over CMRO2, D, sigma or r_Krogh only builds the nodes it passes through.
+    With a stride of 2, only every other node is used, for estimating the interpolation error. """
+    table = {name: 0.0 for name in TABLE_RESPONSES}
+    for consumption_node, consumption_weight in _get_node_weights(consumption, CONSUMPTION_NODES_PER_DECADE, stride):
+        for ratio_node, ratio_weight in _get_node_weights(ratio, RATIO_NODES_PER_DECADE, stride):
+            responses = get_node_responses(consumption_node, ratio_node, r_steps, max_pressure, table_dir,
+                                           table_max_bytes)
+            for name in TABLE_RESPONSES:
+                table[name] = table[name] + consumption_weight * ratio_weight * responses[name]
+    table["wall_pressure"] = responses["wall_pressure"]
+    return table
+
+
+def integrate_table(CMRO2, z_capillary, velocity, D, r_Krogh, r_capillary, paO2, Hb, sigma, r_steps, z_steps,
+                    job_number=0, report_interval=10, slice_table_dir="slice_tables", slice_table_max_bytes=1e8,
+                    store_pressure_field=False, **kwargs):
+    """ Integrates along the capillary with the responses of each slice interpolated from a slice table, instead of
+    solving the slice.
+
+    The tables are built at fixed nodes of the dimensionless groups of get_slice_groups and interpolated between
+    them (see get_slice_table), and saved under slice_table_dir, so that later runs whose groups fall between the
+    same nodes don't need to build them again.  The march then only interpolates the table and does the capillary
+    mass balance for each of the z_steps.  Only the responses of the slices are tabulated, so there is no pressure
+    field, whatever store_pressure_field is.
+
+    The nodes hold the slices of the batch and Newton engines, and the mass balance and summary are theirs too, so
+    the results only differ from theirs by the interpolation error.  That error is estimated for each result in
+    TABLE_ERROR_RESULTS by marching again with every other node and every other wall pressure, and returned as
+    "<name>_table_error".
+    """
+    r_steps, z_steps = get_grid_size(r_steps, z_steps, r_Krogh)
+    dr = (r_Krogh - r_capillary) / r_steps
+    dz = z_capillary / z_steps
+
+    consumption, ratio = get_slice_groups(CMRO2, D, sigma, r_Krogh, r_capillary)
+    paO2_value = paO2.to(units.mmHg).magnitude
+    max_pressure = TABLE_MAX_PRESSURE * max(1, int(np.ceil(paO2_value / CONSUMPTION_PRESSURE / TABLE_MAX_PRESSURE)))
+    table = get_slice_table(consumption, ratio, r_steps, max_pressure, slice_table_dir, slice_table_max_bytes)
+
+    # The drop in pressure, in mmHg, from the wall to the next node for a unit dimensionless wall gradient.
+    node_drop = (ratio - 1) / (r_steps - 1) * CONSUMPTION_PRESSURE
+
+    extraction_factor = get_extraction_factor(D, sigma, r_capillary, velocity, dr, dz)
+    sigma_value = sigma.to(units.mlO2 / units.dL / units.mmHg).magnitude
+    Hb_value = Hb.to(units.g / units.dL).magnitude
+    o2_table = get_o2_concentration_table(sigma, Hb)
+
+    def march(table, report=False):
+        summary = PressureFieldSummary(r_steps, r_capillary, dr, dz)
+        wall_pressure = paO2_value
+        for z in range(z_steps):
+            responses = {name: np.interp(wall_pressure / CONSUMPTION_PRESSURE, table["wall_pressure"], table[name])
+                         for name in TABLE_RESPONSES}
+            summary.add_slice_summary(wall_pressure, responses["average_pressure"] * CONSUMPTION_PRESSURE,
+                                      responses["hypoxic_fraction"])
+            if report and z % report_interval == 0:
+                print("[{}] step {}, pa: {}".format(job_number, z, wall_pressure * units.mmHg))
+
+            concentration = (get_blood_o2_concentration_value(wall_pressure, sigma_value, Hb_value)
+                             - extraction_factor * responses["wall_gradient"] * node_drop)
+            wall_pressure = float(o2_table.get_blood_o2_pressure_value(concentration))
+        return summary.get_results(paO2, sigma, Hb)
+
+    results = march(table, report=True)
+
+    # Linear interpolation is second order in the spacing of the nodes and the wall pressures, so the error of the
+    # full table is about a third of the difference from the table with every other one.
+    coarse_table = get_slice_table(consumption, ratio, r_steps, max_pressure, slice_table_dir, slice_table_max_bytes,
+                                   stride=2)
+    coarse_results = march({name: values[::2] for name, values in coarse_table.items()})
+    for name in TABLE_ERROR_RESULTS:
+        results[name + "_table_error"] = abs(results[name] - coarse_results[name]) / 3
+
+    results["p"] = None
+    return results
+
+
+def compare_with_exact(params, engines=("batch", "march")):
+    """ Prints the results of the table engine, with its estimated interpolation errors, next to those of engines
+    that solve every slice.  The batch engine solves the same discretisation as the table, so the differences from
+    it should be of the order of the interpolation errors.  The march engine's differ by its discretisation error
+    as well. """
+    params = dict(params, test=False)
+    results = {"table": integrate(**dict(params, engine="table"))}
+    for engine in engines:
+        results[engine] = integrate(**dict(params, engine=engine))
+
+    for name in TABLE_ERROR_RESULTS:
+        table_value = float(getattr(results["table"][name], "magnitude", results["table"][name]))
+        table_error = float(getattr(results["table"][name + "_table_error"], "magnitude",
+                                    results["table"][name + "_table_error"]))
+        line = "{}: table {:.6g} (interpolation error about {:.2g})".format(name, table_value, table_error)
+        for engine in engines:
+            value = float(getattr(results[engine][name], "magnitude", results[engine][name]))
+            line += ", {} {:.6g} (difference {:.2g})".format(engine, value, table_value - value)
+        print(line)
+
+
+if __name__ == "__main__":
+    # Usage: python slice_table.py [PARAM_FILE]
+    # Compares the table engine with the batch and march engines on the first grid point of the parameter file.
+    from parameters import Parameters, create_param_grid, load_param_values
+
+    file_name = sys.argv[1] if len(sys.argv) > 1 else "basic_params.json"
+    params = create_param_grid(Parameters(load_param_values(file_name)))[0]
+    params["report_interval"] = 10 ** 9
+    compare_with_exact(params)
@@ -1,11 +1,26 @@
+import functools
+import instrumentation
 import numpy as np
 from scipy.integrate import solve_bvp
+from scipy.linalg import solve_banded
 from units import get_units
 
 
 units = get_units()
 
+# Bump this in every change that changes the results of any engine, so that cached results from older versions are
+# not reused.  The cache key (result_cache.get_cache_key) holds the parameters and the defaults of integrate's own
+# options, but not the numerics inside the engines or the defaults of their own options, like the Newton tolerances
+# of batch_solver.integrate_batch or the node spacing of the slice tables.
+SOLVER_VERSION = 2
+
+
 def blood_o2_saturation(partial_pressure):
+    return blood_o2_saturation_value(partial_pressure.magnitude)
+
+
+def blood_o2_saturation_value(pp):
+    # blood_o2_saturation for a plain partial pressure in mmHg.
     a1 = -8.5322289e3
     a2 = 2.121301e3
     a3 = -6.7073989e1
@@ -13,7 +28,6 @@ def blood_o2_saturation(partial_pressure):
     a5 = -3.1346258e4
     a6 = 2.3961674e3
     a7 = -6.7104406e1
-    pp = partial_pressure.magnitude
     sats_percent = 100 * (a1 * pp + a2 * pp ** 2 + a3 * pp ** 3 + pp ** 4) / (
                 a4 + a5 * pp + a6 * pp ** 2 + a7 * pp ** 3 + pp ** 4)
 
@@ -21,6 +35,23 @@ def blood_o2_saturation(partial_pressure):
     return sats_percent
 
 
+def blood_o2_saturation_derivative(partial_pressure):
+    # Derivative of blood_o2_saturation with respect to the partial pressure, in percent per mmHg.
+    a1 = -8.5322289e3
+    a2 = 2.121301e3
+    a3 = -6.7073989e1
+    a4 = 9.3596087e5
+    a5 = -3.1346258e4
+    a6 = 2.3961674e3
+    a7 = -6.7104406e1
+    pp = partial_pressure.magnitude
+    numerator = a1 * pp + a2 * pp ** 2 + a3 * pp ** 3 + pp ** 4
+    denominator = a4 + a5 * pp + a6 * pp ** 2 + a7 * pp ** 3 + pp ** 4
+    numerator_derivative = a1 + 2 * a2 * pp + 3 * a3 * pp ** 2 + 4 * pp ** 3
+    denominator_derivative = a5 + 2 * a6 * pp + 3 * a7 * pp ** 2 + 4 * pp ** 3
+    return 100 * (numerator_derivative * denominator - numerator * denominator_derivative) / denominator ** 2
+
+
 def get_blood_o2_concentration(partial_pressure, sigma, Hb):
     # The theoretical maximum oxygen carrying capacity is 1.39 ml O2/g Hb, but direct measurement gives a
     # capacity of 1.34 ml O2/g Hb. 1.34 is also known as Hufner's constant.
@@ -42,6 +73,12 @@ def get_blood_o2_concentration(partial_pressure, sigma, Hb):
     return Hb_concentration
 
 
+def get_blood_o2_concentration_value(pp, sigma_value, Hb_value):
+    # get_blood_o2_concentration for plain values: pp in mmHg, sigma_value in mlO2/dL/mmHg and Hb_value in g/dL.
+    # The result is in mlO2/dL.
+    return 1.34 * Hb_value * 0.01 * blood_o2_saturation_value(pp) + sigma_value * pp
+
+
 class O2ConcentrationTable:
     _pressure_step = 0.01
 
@@ -49,30 +86,288 @@ class O2ConcentrationTable:
         pressure_values = np.arange(0, 2000, self._pressure_step) * units.mmHg
         self.table = get_blood_o2_concentration(pressure_values, sigma, Hb).magnitude
 
+        # The saturation curve fit dips slightly below zero for the first couple of mmHg, so the concentration
+        # is only monotonic from the minimum of the table upwards.  Lookups are done on that part of the table.
+        branch_start = np.argmin(self.table)
+        self._branch_concentrations = self.table[branch_start:]
+        self._branch_pressures = pressure_values.magnitude[branch_start:]
+
     def get_blood_o2_pressure(self, concentration):
         assert concentration.units == units.mlO2 / units.dL, ("concentration units are wrong: %s" % concentration.units)
-        concentration_value = concentration.magnitude
-        diffs = (self.table - concentration_value) ** 2
-        min_index = np.argmin(diffs)
-        pp = min_index * self._pressure_step * units.mmHg
-        return pp
+
+        # np.interp does a binary search on the monotonic part of the table and interpolates linearly between the
+        # neighbouring entries.  Concentrations above the table are clamped to the highest pressure, and no
+        # oxygen at all means no pressure.
+        return self.get_blood_o2_pressure_value(concentration.magnitude) * units.mmHg
+
+    def get_blood_o2_pressure_value(self, concentration_value):
+        # get_blood_o2_pressure for a plain concentration in mlO2/dL, returning a plain pressure in mmHg.
+        with instrumentation.timed("table_lookup"):
+            pp = np.interp(concentration_value, self._branch_concentrations, self._branch_pressures)
+            return np.where(concentration_value <= 0, 0.0, pp)
+
+
+@functools.lru_cache(maxsize=16)
+def _get_cached_o2_concentration_table(sigma_value, Hb_value):
+    with instrumentation.timed("table_build"):
+        return O2ConcentrationTable(sigma_value * units.mlO2 / units.dL / units.mmHg, Hb_value * units.g / units.dL)
+
+
+def get_o2_concentration_table(sigma, Hb):
+    """ Returns an O2ConcentrationTable for sigma and Hb, shared with any earlier calls using the same values.
+
+    The most recently used tables are kept, so that repeated solves (e.g. in a search over Hb or a sweep over
+    other parameters) don't pay for rebuilding the table each time.
+    """
+    sigma_value = float(sigma.to(units.mlO2 / units.dL / units.mmHg).magnitude)
+    Hb_value = float(Hb.to(units.g / units.dL).magnitude)
+    return _get_cached_o2_concentration_table(sigma_value, Hb_value)
 
 
 def sigmoid(x):
-    if x > 10:
-        return 1.0
-    elif x < -10:
-        return 0.0
-    else:
-        return 1.0 / (1.0 + np.exp(-x))
+    # Works on scalars and arrays alike.  The argument is clipped before the exponential so that
+    # np.seterr(all='raise') never sees an overflow; values outside [-10, 10] saturate to 0 or 1.
+    x = np.asarray(x, dtype=float)
+    s = 1.0 / (1.0 + np.exp(-np.clip(x, -10, 10)))
+    return np.where(x > 10, 1.0, np.where(x < -10, 0.0, s))
 
 
 def gamma(CMRO2max, partial_pressure):
     return CMRO2max * sigmoid(partial_pressure * 10 - 10)
 
 
+def gamma_derivative(CMRO2max, partial_pressure):
+    # Derivative of gamma with respect to the partial pressure.  It is zero where the sigmoid saturates.
+    s = sigmoid(partial_pressure * 10 - 10)
+    return CMRO2max * 10 * s * (1.0 - s)
+
+
+def consumption_coefficient(CMRO2, D, sigma):
+    """ Returns CMRO2 / (D * sigma) in mmHg / um^2 as a plain float.
+
+    This is the maximum of the consumption term in the radial Krogh ODE
+    p'' + p' / r = gamma(p) / (D * sigma), taking the tissue density as 1 g/ml.
+    """
+    CMRO2_value = CMRO2.to(units.mlO2 / units.g / units.sec).magnitude
+    D_value = D.to(units.cm ** 2 / units.sec).magnitude
+    sigma_value = sigma.to(units.mlO2 / units.ml / units.mmHg).magnitude
+    kappa_factor = (1.0 * units.mmHg / units.cm ** 2).to(units.mmHg / units.um ** 2).magnitude
+    return kappa_factor * CMRO2_value / (D_value * sigma_value)
+
+
+class PressureFieldSummary:
+    """ Accumulates the summary results for a tissue pressure field one z-slice at a time.
+
+    Only O(r_steps) memory is needed, so the whole field doesn't have to be kept to get the summary.  The slices
+    are plain arrays of pressures in mmHg, with the capillary blood pressure as the first value.
+    """
+
+    def __init__(self, r_steps, r_capillary, dr, dz):
+        inner_radii = np.arange(0, r_steps) * dr + r_capillary
+        outer_radii = np.arange(1, r_steps + 1) * dr + r_capillary
+        self.element_volumes = (np.pi * ((outer_radii ** 2) - (inner_radii ** 2)) * dz).to(units.um ** 3).magnitude
+        self.z_steps = 0
+        self.total_weighted_pbO2 = 0.0
+        self.hypoxic_volume = 0.0
+        self.first_wall_pressure = None
+        self.last_wall_pressure = None
+
+    def add_slice(self, p_slice):
+        if self.first_wall_pressure is None:
+            self.first_wall_pressure = p_slice[0]
+        self.last_wall_pressure = p_slice[0]
+        self.z_steps += 1
+        self.total_weighted_pbO2 += np.dot(p_slice, self.element_volumes)
+        self.hypoxic_volume += np.dot(p_slice <= 10.0, self.element_volumes)
+
+    def add_slice_summary(self, wall_pressure, average_pressure, hypoxic_fraction):
+        # Adds a slice that is only known by its wall pressure, its volume averaged pressure and the fraction of it
+        # that is hypoxic, as the table engine gives them.
+        if self.first_wall_pressure is None:
+            self.first_wall_pressure = wall_pressure
+        self.last_wall_pressure = wall_pressure
+        self.z_steps += 1
+        slice_volume = np.sum(self.element_volumes)
+        self.total_weighted_pbO2 += average_pressure * slice_volume
+        self.hypoxic_volume += hypoxic_fraction * slice_volume
+
+    def get_results(self, paO2, sigma, Hb):
+        total_volume = self.z_steps * np.sum(self.element_volumes)
+        average_pbO2 = self.total_weighted_pbO2 / total_volume * units.mmHg
+
+        first_wall_pressure = self.first_wall_pressure * units.mmHg
+        last_wall_pressure = self.last_wall_pressure * units.mmHg
+
+        # A-V oxygen pressure difference.
+        pavO2 = first_wall_pressure - last_wall_pressure
+
+        # A-V oxygen concentration difference.
+        av_o2_difference = (get_blood_o2_concentration(first_wall_pressure, sigma, Hb)
+                            - get_blood_o2_concentration(last_wall_pressure, sigma, Hb))
+
+        # Fraction of oxygen concentration extracted.
+        o2_extraction_fraction = av_o2_difference / get_blood_o2_concentration(first_wall_pressure, sigma, Hb)
+
+        # Calculates jugular venous o2 saturation percentage.
+        jugular_venous_o2_sat = blood_o2_saturation(last_wall_pressure)
+
+        hypoxic_fraction = self.hypoxic_volume / total_volume * units.dimensionless
+
+        return {
+            "paO2": paO2,
+            "pbO2": average_pbO2,
+            "av_o2_difference": av_o2_difference,
+            "jugular_venous_o2_sat": jugular_venous_o2_sat,
+            "o2_extraction_fraction": o2_extraction_fraction,
+            "pavO2": pavO2,
+            "hypoxic_fraction": hypoxic_fraction,
+        }
+
+
+def summarise_pressure_field(p, paO2, sigma, Hb, r_capillary, dr, dz):
+    """ Computes the summary results for a tissue pressure field p with shape (z_steps, r_steps).
+
+    p[:, 0] is taken to be the capillary blood pressure along the capillary.
+    """
+    z_steps, r_steps = p.shape
+    summary = PressureFieldSummary(r_steps, r_capillary, dr, dz)
+    for p_slice in p.to(units.mmHg).magnitude:
+        summary.add_slice(p_slice)
+
+    results = summary.get_results(paO2, sigma, Hb)
+    results["p"] = p
+    return results
+
+
+def get_extraction_factor(D, sigma, r_capillary, velocity, dr, dz):
+    """ Returns the drop in blood O2 concentration over one z-step, in mlO2/dL, per mmHg of pressure difference
+    across the first radial step out from the capillary wall. """
+    return (2 * D * sigma * dz / (r_capillary * velocity * dr)).to(units.mlO2 / units.dL / units.mmHg).magnitude
+
+
+def get_grid_size(r_steps, z_steps, r_Krogh):
+    # The step counts are specified for a 20um Krogh cylinder and scaled with its radius.
+    r_scale = (r_Krogh / (20 * units.um)).to(units.dimensionless).magnitude
+    return int(np.round(r_steps * r_scale)), int(np.round(z_steps * r_scale))
+
+
+def resample_pressure_field(field, z_steps, r_steps):
+    """ Linearly interpolates a pressure field, as a plain array, onto z_steps by r_steps points over the same
+    cylinder. """
+    field = np.asarray(field, dtype=float)
+    if field.shape == (z_steps, r_steps):
+        return field
+
+    z_old = np.linspace(0, 1, field.shape[0])
+    r_old = np.linspace(0, 1, field.shape[1])
+    z_new = np.linspace(0, 1, z_steps)
+    r_new = np.linspace(0, 1, r_steps)
+    field = np.array([np.interp(r_new, r_old, row) for row in field])
+    return np.array([np.interp(z_new, z_old, column) for column in field.T]).T
+
+
+def get_initial_profile(kappa_max, r):
+    """ Returns the analytic Krogh profile for unsaturated consumption on the radial nodes r, relative to the wall
+    pressure, which is right wherever the tissue isn't hypoxic.  The Newton engines start from it. """
+    return kappa_max / 4 * (r ** 2 - r[0] ** 2) - kappa_max * r[-1] ** 2 / 2 * np.log(r / r[0])
+
+
+def get_radial_coefficients(r, kappa_max):
+    """ Returns the coefficients of the radial Krogh ODE for one slice, discretised with central differences on the
+    evenly spaced radial nodes r and multiplied through by h^2, so that the residual at node j is
+    lower_j P_{j-1} + diagonal_j P_j + upper_j P_{j+1} - consumption_j gamma(1, P_j), less the wall pressure at the
+    first node.
+
+    The first node is on the capillary wall, where the pressure is fixed.  The gradient is zero on the outside of
+    the cylinder, which is discretised with a mirrored ghost node.
+    """
+    h = r[1] - r[0]
+    lower = np.zeros(len(r))
+    upper = np.zeros(len(r))
+    lower[1:-1] = 1.0 - h / (2 * r[1:-1])
+    upper[1:-1] = 1.0 + h / (2 * r[1:-1])
+    lower[-1] = 2.0
+    diagonal = np.full(len(r), -2.0)
+    diagonal[0] = 1.0
+    consumption = np.full(len(r), h ** 2 * kappa_max)
+    consumption[0] = 0.0
+    return lower, diagonal, upper, consumption
+
+
+def solve_radial_slices(P, wall_pressure, lower, diagonal, upper, consumption, active=None, newton_tol=1e-6,
+                        newton_max_iterations=50, max_newton_step=20.0):
+    """ Solves the discretised radial equations of several slices together by Newton's method, starting from P.
+
+    Each row of P and of the coefficients, as from get_radial_coefficients, is a slice, and wall_pressure holds the
+    wall pressure of each.  Rows can be padded with nodes that have a diagonal of 1 and no other coefficients.  The
+    tridiagonal systems of all the slices are stacked into one banded system for each Newton iteration.  Large steps
+    are damped, and each slice backtracks on its own residual norm.  The iterations stop once the slices in active,
+    which defaults to all of them, have converged.
+
+    Returns the solution, the number of iterations and the largest step of each slice in the last iteration, which
+    is at least newton_tol for those that didn't converge.
+    """
+    n, nodes = P.shape
+    if active is None:
+        active = np.ones(n, dtype=bool)
+
+    def residual(P):
+        F = diagonal * P - consumption * gamma(1.0, P)
+        F[:, 1:] += lower[:, 1:] * P[:, :-1]
+        F[:, :-1] += upper[:, :-1] * P[:, 1:]
+        F[:, 0] -= wall_pressure
+        return F
+
+    F = residual(P)
+    for iteration in range(1, newton_max_iterations + 1):
+        # The first node of each slice has no lower coefficient and the last has no upper one, so the slices don't
+        # couple.
+        with instrumentation.timed("radial_linear_solve"):
+            banded = np.zeros((3, n * nodes))
+            banded[0, 1:] = upper.ravel()[:-1]
+            banded[1] = (diagonal - consumption * gamma_derivative(1.0, P)).ravel()
+            banded[2, :-1] = lower.ravel()[1:]
+            step = solve_banded((1, 1), banded, -F.ravel()).reshape(P.shape)
+        instrumentation.count("radial_newton_iterations")
+
+        max_step = np.max(np.abs(step), axis=1)
+        step *= np.minimum(1.0, max_newton_step / np.maximum(max_step, 1e-300))[:, np.newaxis]
+
+        # Slices that have converged, or don't need to, take the full step, since their residuals may be down to
+        # rounding errors.
+        needs_line_search = active & (max_step >= newton_tol)
+        norm = np.linalg.norm(F, axis=1)
+        alpha = np.ones(n)
+        P_next = P + step
+        F_next = residual(P_next)
+        for _ in range(20):
+            is_worse = (np.linalg.norm(F_next, axis=1) > (1 - 1e-4 * alpha) * norm) & needs_line_search
+            if not np.any(is_worse):
+                break
+            alpha[is_worse] *= 0.5
+            P_next = P + alpha[:, np.newaxis] * step
+            F_next = residual(P_next)
+
+        P = P_next
+        F = F_next
+
+        if not np.any(needs_line_search):
+            break
+
+    return P, iteration, max_step
+
+
+@functools.lru_cache(maxsize=None)
+def _warn_no_numba():
+    # Only warns once for each process.
+    print("Numba isn't installed, so the compiled engine falls back to the march engine.")
+
+
 def integrate(CMRO2, z_capillary, velocity, D, r_Krogh, r_capillary, paO2, Hb, sigma, r_steps, z_steps,
-              verbose=False, report_interval=10, test=False, job_number=0, **kwargs):
+              verbose=False, report_interval=10, test=False, job_number=0, analytic_jacobian=True, warm_start=False,
+              engine="march", store_pressure_field=False, resolution_tol=None, resolution_levels=4,
+              resolution_extrapolate=False, z_tol=None, z_min_step=0.01, z_max_step=100.0, initial_field=None,
+              sensitivities=None, **kwargs):
 
     def log(s):
         print("[{}] {}".format(job_number, s))
@@ -88,34 +383,92 @@ def integrate(CMRO2, z_capillary, velocity, D, r_Krogh, r_capillary, paO2, Hb, s
             "o2_extraction_fraction": 1,
             "pavO2": 1,
             "hypoxic_fraction": 1,
-            "p": np.zeros(shape=(z_steps, r_steps))
+            "p": np.zeros(shape=(z_steps, r_steps)) if store_pressure_field else None,
+            "bvp_iterations": 0,
+            "bvp_nodes": 0,
+            "slice_iterations": np.zeros(z_steps, dtype=int),
+            "slice_nodes": np.zeros(z_steps, dtype=int)
         }
 
-    # We need to convert between ml and cm^3 in a few places below and pint doesn't support that.
-    ml_to_cm3 = units.ml / (units.cm ** 3)
-
-    sigma_ode = sigma.to(units.mlO2 / units.ml / units.mmHg) * ml_to_cm3
-    gamma_factor = (CMRO2 / CMRO2.magnitude).to(units.mlO2 / units.g / units.sec).magnitude
-    kappa_factor = (1.0 * units.mmHg / units.cm ** 2).to(units.mmHg / units.um ** 2).magnitude
-
-    def odewboundary(D, CMRO2max, x, y):
-        g = gamma(CMRO2max, y[0]) * gamma_factor
-        s = sigma_ode
-        kappa = kappa_factor * g / (D * s)
-        return np.array([y[1], kappa.magnitude - y[1] / x])
+    params = dict(kwargs, CMRO2=CMRO2, z_capillary=z_capillary, velocity=velocity, D=D, r_Krogh=r_Krogh,
+                  r_capillary=r_capillary, paO2=paO2, Hb=Hb, sigma=sigma, r_steps=r_steps, z_steps=z_steps,
+                  verbose=verbose, report_interval=report_interval, job_number=job_number,
+                  analytic_jacobian=analytic_jacobian, warm_start=warm_start, engine=engine,
+                  store_pressure_field=store_pressure_field, z_tol=z_tol, z_min_step=z_min_step,
+                  z_max_step=z_max_step, initial_field=initial_field)
+
+    if sensitivities:
+        # Solve as usual, keeping the pressure field, and linearise the equations about it for the derivatives of
+        # the results with respect to each of the parameters in sensitivities.
+        from sensitivity import get_sensitivities
+        results = integrate(**dict(params, resolution_tol=resolution_tol, resolution_levels=resolution_levels,
+                                   resolution_extrapolate=resolution_extrapolate, store_pressure_field=True))
+        if results["p"] is None:
+            raise ValueError("The %s engine doesn't give a pressure field, so it can't give sensitivities" % engine)
+        results["gradient"] = get_sensitivities(results["p"], sensitivities, **params)
+        if not store_pressure_field:
+            results["p"] = None
+        return results
+
+    if resolution_tol is not None:
+        # Pick the resolution for resolution_tol, with r_steps and z_steps as the finest that is allowed.
+        from resolution import integrate_to_tolerance
+        return integrate_to_tolerance(integrate, params, resolution_tol, resolution_levels, resolution_extrapolate)
+
+    if engine == "newton":
+        # Solve the whole field as one sparse nonlinear system instead of marching along the capillary.
+        from newton_solver import integrate_newton
+        return integrate_newton(CMRO2, z_capillary, velocity, D, r_Krogh, r_capillary, paO2, Hb, sigma, r_steps,
+                                z_steps, verbose=verbose, job_number=job_number,
+                                store_pressure_field=store_pressure_field, initial_field=initial_field, **kwargs)
+    elif engine == "batch":
+        # A batch of one; evaluate.evaluate_points groups batch engine solves together.
+        from batch_solver import integrate_batch
+        return integrate_batch([dict(kwargs, CMRO2=CMRO2, z_capillary=z_capillary, velocity=velocity, D=D,
+                                     r_Krogh=r_Krogh, r_capillary=r_capillary, paO2=paO2, Hb=Hb, sigma=sigma,
+                                     r_steps=r_steps, z_steps=z_steps, report_interval=report_interval,
+                                     job_number=job_number, store_pressure_field=store_pressure_field)])[0]
+    elif engine == "compiled":
+        # The march of the batch engine as one loop compiled with Numba, or the usual march if Numba isn't
+        # installed.
+        from compiled_solver import integrate_compiled, is_available
+        if is_available():
+            return integrate_compiled(CMRO2, z_capillary, velocity, D, r_Krogh, r_capillary, paO2, Hb, sigma,
+                                      r_steps, z_steps, job_number=job_number,
+                                      store_pressure_field=store_pressure_field, **kwargs)
+        _warn_no_numba()
+    elif engine == "table":
+        # Interpolate the responses of each slice from tables built at nodes of the slice problem's dimensionless
+        # groups, instead of solving every slice.
+        from slice_table import integrate_table
+        return integrate_table(CMRO2, z_capillary, velocity, D, r_Krogh, r_capillary, paO2, Hb, sigma, r_steps,
+                               z_steps, job_number=job_number, report_interval=report_interval,
+                               store_pressure_field=store_pressure_field, **kwargs)
+    elif engine != "march":
+        raise ValueError("Unknown engine: %s" % engine)
+
+    # Maximum value of the consumption term in the radial ODE, in mmHg / um^2, as a plain float.
+    kappa_max = consumption_coefficient(CMRO2, D, sigma)
 
     def boundarycd(paO2, ya, yb):
-        return np.array([ya[0] - paO2.magnitude, yb[1]])
+        return np.array([ya[0] - paO2, yb[1]])
 
-    CMRO2max = CMRO2
-    r_steps = np.round(r_steps * r_Krogh / (20 * units.um)).astype(int)
-    z_steps = np.round(z_steps * r_Krogh / (20 * units.um)).astype(int)
+    r_steps, z_steps = get_grid_size(r_steps, z_steps, r_Krogh)
 
     dr = (r_Krogh - r_capillary) / r_steps
     dz = z_capillary / z_steps
 
-    p = np.zeros(shape=(z_steps, r_steps)) * units.mmHg
-    p[0, 0] = paO2
+    # The summary results are accumulated one slice at a time, and the whole pressure field is only kept if it is
+    # asked for.
+    summary = PressureFieldSummary(r_steps, r_capillary, dr, dz)
+    p = np.zeros(shape=(z_steps, r_steps)) if store_pressure_field else None
+
+    # Plain float versions of the quantities needed for the capillary mass balance in each slice.
+    extraction_factor = get_extraction_factor(D, sigma, r_capillary, velocity, dr, dz)
+    sigma_value = sigma.to(units.mlO2 / units.dL / units.mmHg).magnitude
+    Hb_value = Hb.to(units.g / units.dL).magnitude
+    r_values = np.linspace(r_capillary, r_Krogh, r_steps).to(units.um).magnitude
+    z_paO2 = paO2.to(units.mmHg).magnitude
 
     # We need to convert between ml and cm^3 in a few places below and pint doesn't support that.
     ml_to_cm3 = units.ml / (units.cm ** 3)
@@ -127,31 +480,107 @@ def integrate(CMRO2, z_capillary, velocity, D, r_Krogh, r_capillary, paO2, Hb, s
         # x is the array of mesh points.
         # y is the array of values at each mesh point
         # y[:, i] is the value of the function at point x[i].
-        m = len(x)
-        dy = np.array([odewboundary(D, CMRO2max, x[i], y[:, i]) for i in range(m)]).T
-        return dy
+        # The whole mesh is evaluated in one array expression.
+        return np.vstack((y[1], gamma(kappa_max, y[0]) - y[1] / x))
+
+    # Analytic Jacobians of the ODE and the boundary conditions.  Without these solve_bvp estimates them by
+    # finite differences, which costs extra right hand side evaluations on every Newton step.
+    def ode_jac(x, y):
+        # df[i, j, k] is the derivative of f_i with respect to y_j at mesh point x[k].
+        df = np.zeros((2, 2, len(x)))
+        df[0, 1] = 1.0
+        df[1, 0] = gamma_derivative(kappa_max, y[0])
+        df[1, 1] = -1.0 / x
+        return df
+
+    bc_dya = np.array([[1.0, 0.0], [0.0, 0.0]])
+    bc_dyb = np.array([[0.0, 0.0], [0.0, 1.0]])
+
+    def bc_jac(ya, yb):
+        return bc_dya, bc_dyb
+
+    if not analytic_jacobian:
+        ode_jac = None
+        bc_jac = None
+
+    # Count the right hand side evaluations if the instrumentation is enabled.
+    ode = instrumentation.counted(ode, "bvp_rhs_evaluations")
+
+    table = get_o2_concentration_table(sigma, Hb)
+
+    def log_extraction(p0, p1):
+        # Logs the steps of the O2 mass balance between the capillary and the tissue for one slice, with units.
+        pressure_gradient = (p0 - p1) / (dr.to(units.cm))
+        log("p0: %s, p1: %s, pressure_gradient: %s" % (p0, p1, pressure_gradient))
+
+        density_gradient = (sigma * pressure_gradient).to(units.mlO2 / units.ml / units.cm)
+        log("density_gradient: %s" % density_gradient)
+
+        capillary_surface_area = (2 * np.pi * r_capillary * dz).to(units.cm ** 2)
+        o2_extracted_per_second = D * capillary_surface_area * density_gradient * ml_to_cm3
+        log("o2_extracted_per_second: %s" % o2_extracted_per_second)
+
+        o2_extracted = o2_extracted_per_second * dz.to(units.cm) / velocity
+        log("o2_extracted: %s" % o2_extracted)
+
+        blood_o2_concentration = get_blood_o2_concentration(p0, sigma, Hb).to(units.mlO2 / units.ml)
+        blood_o2_content = blood_o2_concentration * np.pi * dz.to(units.cm) * r_capillary.to(units.cm) ** 2 * ml_to_cm3
+        log("blood_o2_content: %s" % blood_o2_content)
+
+    # Newton iterations and mesh nodes used by solve_bvp for each slice that is solved.
+    slice_iterations = []
+    slice_nodes = []
 
-    table = O2ConcentrationTable(sigma, Hb)
+    previous_solution = None
+    previous_paO2 = None
 
-    for z in range(z_steps):
-        z_paO2 = p[z, 0]
+    # The pressure field of a similar, earlier solve, which gives better initial guesses than the exponential decay.
+    if initial_field is not None:
+        initial_field = resample_pressure_field(initial_field, z_steps, r_steps)
+
+    def solve_slice(z_paO2, z):
+        # Solves the radial BVP for slice z with wall pressure z_paO2, and returns the pressures at r_values.
+        nonlocal previous_solution, previous_paO2
 
         def bc(ya, yb):
             return boundarycd(z_paO2, ya, yb)
 
-        # x is the initial grid.
-        x = np.linspace(r_capillary, r_Krogh, initial_grid_size) * units.um
-
-        # y is a guess of the function value at the initial grid points.
-        # Columns of y correspond to grid points, so it should have shape (2, initial_grid_size)
-        # Start with a guess of an exponential decay to give the solver an easier time.
-        y0 = z_paO2.magnitude / np.e * np.exp(1 / (x.magnitude - x[0].magnitude + 1))
-        # The derivative of an exponential decay is equal to the function value.
-        y1 = y0
-        y = np.array([y0, y1])
-        solution = solve_bvp(ode, bc, x, y, tol=1e-2, max_nodes=2000)
+        if warm_start and previous_solution is not None and previous_paO2 > 0:
+            # Adjacent slices only differ slightly in their wall pressure, so start from the previous slice's
+            # converged mesh and profile, scaled to the new wall pressure.
+            x = previous_solution.x
+            y = previous_solution.y * (z_paO2 / previous_paO2)
+        elif initial_field is not None and initial_field[z, 0] > 0:
+            # Start from the same slice of the earlier solve, scaled to the new wall pressure.
+            x = np.linspace(r_values[0], r_values[-1], 2 * initial_grid_size)
+            y0 = np.interp(x, r_values, initial_field[z]) * (z_paO2 / initial_field[z, 0])
+            y = np.array([y0, np.gradient(y0, x)])
+        else:
+            # x is the initial grid.
+            x = np.linspace(r_values[0], r_values[-1], initial_grid_size)
+
+            # y is a guess of the function value at the initial grid points.
+            # Columns of y correspond to grid points, so it should have shape (2, initial_grid_size)
+            # Start with a guess of an exponential decay to give the solver an easier time.
+            y0 = z_paO2 / np.e * np.exp(1 / (x - x[0] + 1))
+            # The derivative of an exponential decay is equal to the function value.
+            y1 = y0
+            y = np.array([y0, y1])
+
+        with instrumentation.timed("solve_bvp"):
+            solution = solve_bvp(ode, bc, x, y, fun_jac=ode_jac, bc_jac=bc_jac, tol=1e-2, max_nodes=2000)
+        slice_iterations.append(solution.niter)
+        slice_nodes.append(len(solution.x))
+        instrumentation.count("bvp_solves")
+        instrumentation.count("bvp_iterations", solution.niter)
+        instrumentation.count("bvp_mesh_nodes", len(solution.x))
+
+        if solution.success:
+            previous_solution = solution
+            previous_paO2 = z_paO2
+        else:
+            previous_solution = None
 
-        r_values = np.linspace(r_capillary, r_Krogh, r_steps)
         p_sol, _ = solution.sol(r_values)
 
         min_pressure = np.min(p_sol)
@@ -160,79 +589,88 @@ def integrate(CMRO2, z_capillary, velocity, D, r_Krogh, r_capillary, paO2, Hb, s
 
         if not solution.success:
             log("Solver warning: %s" % solution.message)
+            instrumentation.count("bvp_failed_solves")
 
-        p_sol = np.maximum(0, p_sol)
-        p[z, :] = p_sol * units.mmHg
-
-        pressure_gradient = (p[z, 0] - p[z, 1]) / (dr.to(units.cm))
-
-        if verbose:
-            log("p0: %s, p1: %s, pressure_gradient: %s" % (p[z, 0], p[z, 1], pressure_gradient))
-
-        density_gradient = (sigma * pressure_gradient).to(units.mlO2 / units.ml / units.cm)
+        return np.maximum(0, p_sol)
 
-        if verbose:
-            log("density_gradient: %s" % density_gradient)
-
-        capillary_surface_area = (2 * np.pi * r_capillary * dz).to(units.cm ** 2)
+    def add_slice(z, p_sol):
+        with instrumentation.timed("summary"):
+            summary.add_slice(p_sol)
+            if store_pressure_field:
+                p[z, :] = p_sol
 
-        o2_extracted_per_second = D * capillary_surface_area * density_gradient * ml_to_cm3
+        if z % report_interval == 0:
+            log("step %s, pa: %s, pb: %s" % (z, p_sol[0] * units.mmHg, p_sol[-1] * units.mmHg))
 
-        if verbose:
-            log("o2_extracted_per_second: %s" % o2_extracted_per_second)
+    def get_o2_concentration_remaining(p_sol, steps=1.0):
+        # Blood O2 concentration left after the O2 that diffused into the tissue over the given number of z-steps
+        # from a slice, in mlO2/dL.
+        return (get_blood_o2_concentration_value(p_sol[0], sigma_value, Hb_value)
+                - steps * extraction_factor * (p_sol[0] - p_sol[1]))
 
-        o2_extracted = o2_extracted_per_second * dz.to(units.cm) / velocity
+    if z_tol is None:
+        for z in range(z_steps):
+            p_sol = solve_slice(z_paO2, z)
+            add_slice(z, p_sol)
 
-        if verbose:
-            log("o2_extracted: %s" % o2_extracted)
+            if verbose:
+                log_extraction(p_sol[0] * units.mmHg, p_sol[1] * units.mmHg)
 
-        blood_o2_concentration = get_blood_o2_concentration(p[z, 0], sigma, Hb).to(units.mlO2 / units.ml)
-        blood_o2_content = blood_o2_concentration * np.pi * dz.to(units.cm) * r_capillary.to(units.cm) ** 2 * ml_to_cm3
+            if z < (z_steps - 1):
+                z_paO2 = float(table.get_blood_o2_pressure_value(get_o2_concentration_remaining(p_sol)))
+    else:
+        # Adaptive steps along the capillary, measured in z-steps.  Each step is taken with the explicit mass
+        # balance, and its error is estimated from the wall pressure given by the trapezoidal rule instead, using the
+        # extraction at both ends of the step.  The slices are interpolated back onto the regular z-steps for the
+        # summary.
+        position = 0.0
+        step = 1.0
+        p_sol = solve_slice(z_paO2, 0)
+        add_slice(0, p_sol)
+        next_z = 1
+
+        while next_z < z_steps:
+            step = min(step, z_max_step, (z_steps - 1) - position)
+
+            next_paO2 = float(table.get_blood_o2_pressure_value(get_o2_concentration_remaining(p_sol, step)))
+            next_p_sol = solve_slice(next_paO2, int(round(position + step)))
+
+            trapezoidal_concentration = (get_blood_o2_concentration_value(p_sol[0], sigma_value, Hb_value)
+                                         - step * extraction_factor * ((p_sol[0] - p_sol[1])
+                                                                       + (next_p_sol[0] - next_p_sol[1])) / 2)
+            error = abs(float(table.get_blood_o2_pressure_value(trapezoidal_concentration)) - next_paO2)
+
+            if error <= z_tol or step <= z_min_step:
+                # The blood O2 concentration changes almost linearly along a step, but the pressure doesn't, so
+                # the wall pressure at each regular z-step comes from the interpolated concentration.  The radial
+                # profiles relative to the wall are interpolated directly.
+                concentrations = get_blood_o2_concentration_value(np.array([p_sol[0], next_p_sol[0]]), sigma_value,
+                                                                  Hb_value)
+                while next_z < z_steps and next_z <= position + step + 1e-9:
+                    t = (next_z - position) / step
+                    wall_pressure = float(table.get_blood_o2_pressure_value((1 - t) * concentrations[0]
+                                                                            + t * concentrations[1]))
+                    profile = (1 - t) * (p_sol - p_sol[0]) + t * (next_p_sol - next_p_sol[0])
+                    add_slice(next_z, np.maximum(0, wall_pressure + profile))
+                    next_z += 1
+
+                position += step
+                p_sol = next_p_sol
+
+            # The local error of the explicit step goes as the square of its size.
+            step *= min(4.0, max(0.2, 0.9 * np.sqrt(z_tol / max(error, 1e-12))))
+            step = max(step, z_min_step)
 
         if verbose:
-            log("blood_o2_content: %s" % blood_o2_content)
-
-        o2_concentration_remaining = ((blood_o2_content - o2_extracted)
-                                      / (np.pi * dz.to(units.cm) * r_capillary.to(units.cm) ** 2)
-                                      / ml_to_cm3).to(units.mlO2 / units.dL)
-
-        if z % report_interval == 0:
-            log("step %s, pa: %s, pb: %s" % (z, p[z, 0], p[z, -1]))
-
-        if z < (z_steps - 1):
-            p_next = table.get_blood_o2_pressure(o2_concentration_remaining)
-            p[z + 1, 0] = p_next
-
-    inner_radii = np.arange(0, r_steps) * dr + r_capillary
-    outer_radii = np.arange(1, r_steps + 1) * dr + r_capillary
-    element_volumes = (np.pi * ((outer_radii ** 2) - (inner_radii ** 2)) * dz)
-    volume_weighted_pbO2 = np.multiply(p, element_volumes)
-    total_weighted_pbO2 = np.sum(volume_weighted_pbO2)
-    total_volume = z_steps * np.sum(element_volumes)
-    average_pbO2 = total_weighted_pbO2 / total_volume
-
-    # A-V oxygen pressure difference.
-    pavO2 = p[0, 0] - p[-1, 0]
-
-    # A-V oxygen concentration difference.
-    av_o2_difference = get_blood_o2_concentration(p[0, 0], sigma, Hb) - get_blood_o2_concentration(p[-1, 0], sigma, Hb)
-
-    # Fraction of oxygen concentration extracted.
-    o2_extraction_fraction = av_o2_difference / get_blood_o2_concentration(p[0, 0], sigma, Hb)
-
-    # Calculates jugular venous o2 saturation percentage.
-    jugular_venous_o2_sat = blood_o2_saturation(p[-1, 0])
-
-    hypoxic_volume = np.sum((p.magnitude <= 10.0) * element_volumes)
-    hypoxic_fraction = hypoxic_volume / total_volume
-
-    return {
-        "paO2": paO2,
-        "pbO2": average_pbO2,
-        "av_o2_difference": av_o2_difference,
-        "jugular_venous_o2_sat": jugular_venous_o2_sat,
-        "o2_extraction_fraction": o2_extraction_fraction,
-        "pavO2": pavO2,
-        "hypoxic_fraction": hypoxic_fraction,
-        "p": p
-    }
+            log("Adaptive z-steps: %s slices solved for %s regular steps" % (len(slice_iterations), z_steps))
+
+    with instrumentation.timed("summary"):
+        results = summary.get_results(paO2, sigma, Hb)
+    results.update({
+        "p": p * units.mmHg if store_pressure_field else None,
+        "bvp_iterations": int(np.sum(slice_iterations)),
+        "bvp_nodes": int(np.sum(slice_nodes)),
+        "slice_iterations": np.array(slice_iterations, dtype=int),
+        "slice_nodes": np.array(slice_nodes, dtype=int)
+    })
+    return results
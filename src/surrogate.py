@@ -0,0 +1,273 @@
+import csv
+import sys
+import numpy as np
+from data import CSV_FIELDS, load_results, save_results
+from parameters import get_plain_values
+from result_cache import cached_integrate
+
+
+# The parameters that the surrogate is a function of, and the base results that it predicts.  The CSV column of
+# each, as written by data.export_csv, is looked up in CSV_FIELDS.
+INPUT_NAMES = ["CMRO2", "velocity", "D", "r_Krogh", "paO2", "Hb"]
+OUTPUT_NAMES = ["pbO2", "hypoxic_fraction", "jugular_venous_o2_sat"]
+
+# The largest predicted standard deviation of each output that query accepts without calling the solver.
+DEFAULT_MAX_STD = {
+    "pbO2": 1.0,
+    "hypoxic_fraction": 0.01,
+    "jugular_venous_o2_sat": 0.5,
+}
+
+# How far outside the range of the training points, as a fraction of that range, query still trusts the surrogate.
+RANGE_MARGIN = 0.05
+
+# The kernel length scales and noise levels that fit tries, in the scaled input space where the training points
+# span [0, 1] in each input.
+LENGTH_SCALES = [0.05, 0.1, 0.2, 0.3, 0.5, 0.7, 1.0, 1.5, 2.0, 3.0]
+NOISE_LEVELS = [1e-8, 1e-6, 1e-4, 1e-2]
+
+
+def _magnitude(value):
+    return float(getattr(value, "magnitude", value))
+
+
+def _get_csv_column(name):
+    # The CSV column of an input parameter or base result, such as "vel" for "params.velocity".
+    for column, field in CSV_FIELDS.items():
+        if field in ("params." + name, "base_results." + name):
+            return column
+    raise KeyError(name)
+
+
+def load_csv(file_name):
+    """ Returns the inputs and outputs of each row of a CSV file written by data.export_csv, as two arrays. """
+    inputs = []
+    outputs = []
+    with open(file_name, 'r') as f:
+        for row in csv.DictReader(f):
+            inputs.append([float(row[_get_csv_column(name)]) for name in INPUT_NAMES])
+            outputs.append([float(row[_get_csv_column(name)]) for name in OUTPUT_NAMES])
+    return np.array(inputs).reshape(-1, len(INPUT_NAMES)), np.array(outputs).reshape(-1, len(OUTPUT_NAMES))
+
+
+def get_inputs(params_list):
+    """ Returns an array with the inputs of each parameter set in params_list, as plain values in the units of the
+    parameter files. """
+    inputs = []
+    for params in params_list:
+        values = get_plain_values(params)
+        inputs.append([float(values[name]) for name in INPUT_NAMES])
+    return np.array(inputs).reshape(-1, len(INPUT_NAMES))
+
+
+def get_outputs(results_list):
+    """ Returns an array with the outputs of each of the integrate results in results_list. """
+    return np.array([[_magnitude(results[name]) for name in OUTPUT_NAMES]
+                     for results in results_list]).reshape(-1, len(OUTPUT_NAMES))
+
+
+def integrate_fallback(base_params):
+    """ Returns a function for Surrogate.query that solves a query with cached_integrate, taking the parameters that
+    the query doesn't give, such as the grid size, from base_params. """
+    def fallback(params):
+        return cached_integrate(**dict(base_params, **params))
+    return fallback
+
+
+class Surrogate:
+    """ A Gaussian process emulator of the base results of integrate, trained on earlier solves.
+
+    The inputs are scaled to the range of the training points, on a log scale since they are all positive, and the
+    outputs are each scaled to zero mean and unit variance.  All the outputs share one squared exponential kernel
+    with a length scale for each input, chosen by fit to minimise the leave-one-out cross-validation error.
+    """
+
+    def __init__(self):
+        self.inputs = np.zeros((0, len(INPUT_NAMES)))
+        self.outputs = np.zeros((0, len(OUTPUT_NAMES)))
+        self.length_scales = None
+        self.noise = None
+        self.cross_validation_error = None
+
+    def add(self, inputs, outputs):
+        """ Adds training points, given as arrays like those from load_csv.  fit must be called before the next
+        prediction. """
+        self.inputs = np.concatenate([self.inputs, np.asarray(inputs, dtype=float).reshape(-1, len(INPUT_NAMES))])
+        self.outputs = np.concatenate([self.outputs,
+                                       np.asarray(outputs, dtype=float).reshape(-1, len(OUTPUT_NAMES))])
+
+    def add_results(self, results_list):
+        """ Adds the points of a list of results from evaluate.evaluate_points. """
+        self.add(get_inputs([results["params"] for results in results_list]),
+                 get_outputs([results["base_results"] for results in results_list]))
+
+    def _scale_inputs(self, inputs):
+        return (np.log(inputs) - self.input_min) / self.input_range
+
+    def _get_kernel(self, a, b, length_scales):
+        a = a / length_scales
+        b = b / length_scales
+        squared_distances = np.sum(a ** 2, axis=1)[:, np.newaxis] + np.sum(b ** 2, axis=1)[np.newaxis, :] \
+            - 2 * a @ b.T
+        return np.exp(-0.5 * np.maximum(squared_distances, 0.0))
+
+    def _solve(self, length_scales, noise):
+        # Returns the inverse of the kernel matrix, the weights of the training points and the leave-one-out
+        # residuals of the scaled outputs, which a Gaussian process gives without refitting.
+        kernel = self._get_kernel(self.scaled_inputs, self.scaled_inputs, length_scales)
+        kernel[np.diag_indices_from(kernel)] += noise
+        try:
+            cholesky = np.linalg.cholesky(kernel)
+        except np.linalg.LinAlgError:
+            return None
+        inverse_cholesky = np.linalg.inv(cholesky)
+        inverse = inverse_cholesky.T @ inverse_cholesky
+        weights = inverse @ self.scaled_outputs
+        residuals = weights / np.diag(inverse)[:, np.newaxis]
+        return inverse, weights, residuals
+
+    def _get_loo_error(self, length_scales, noise):
+        solution = self._solve(length_scales, noise)
+        if solution is None:
+            return np.inf
+        return np.mean(solution[2] ** 2)
+
+    def fit(self, optimize=True):
+        """ Fits the surrogate to its training points.
+
+        With optimize, the kernel parameters are chosen again: first a single length scale and the noise level from
+        LENGTH_SCALES and NOISE_LEVELS, and then the length scale of each input in turn is halved or doubled while
+        that lowers the leave-one-out error.  Otherwise the kernel parameters of the last fit are kept, which is
+        much faster when only a few points have been added.
+        """
+        num_points = len(self.inputs)
+        if num_points < 2:
+            raise ValueError("The surrogate needs at least 2 training points, but has {}".format(num_points))
+
+        log_inputs = np.log(self.inputs)
+        self.input_min = np.min(log_inputs, axis=0)
+        self.input_range = np.max(log_inputs, axis=0) - self.input_min
+        self.input_range[self.input_range == 0] = 1.0
+        self.scaled_inputs = self._scale_inputs(self.inputs)
+
+        self.output_mean = np.mean(self.outputs, axis=0)
+        self.output_std = np.std(self.outputs, axis=0)
+        self.output_std[self.output_std == 0] = 1.0
+        self.scaled_outputs = (self.outputs - self.output_mean) / self.output_std
+
+        if optimize or self.length_scales is None:
+            best_error = np.inf
+            for length_scale in LENGTH_SCALES:
+                for noise in NOISE_LEVELS:
+                    length_scales = np.full(len(INPUT_NAMES), length_scale)
+                    error = self._get_loo_error(length_scales, noise)
+                    if error < best_error:
+                        best_error, self.length_scales, self.noise = error, length_scales, noise
+
+            is_improved = True
+            while is_improved:
+                is_improved = False
+                for i in range(len(INPUT_NAMES)):
+                    for factor in (0.5, 2.0):
+                        length_scales = self.length_scales.copy()
+                        length_scales[i] *= factor
+                        error = self._get_loo_error(length_scales, self.noise)
+                        if error < best_error * (1 - 1e-3):
+                            best_error, self.length_scales, is_improved = error, length_scales, True
+
+        self.inverse, self.weights, residuals = self._solve(self.length_scales, self.noise)
+
+        # Scale the predicted variance of each output so that it matches the leave-one-out residuals on average,
+        # since the variance of a Gaussian process with a fixed kernel amplitude is usually far too small.
+        self.variance_scale = np.mean(residuals ** 2 * np.diag(self.inverse)[:, np.newaxis], axis=0)
+        self.cross_validation_error = dict(zip(OUTPUT_NAMES, np.sqrt(np.mean(residuals ** 2, axis=0))
+                                               * self.output_std))
+
+    def predict(self, inputs):
+        """ Returns the predicted outputs at an array of inputs, and their standard deviations, as two arrays with a
+        row for each input. """
+        scaled_inputs = self._scale_inputs(np.asarray(inputs, dtype=float).reshape(-1, len(INPUT_NAMES)))
+        kernel = self._get_kernel(scaled_inputs, self.scaled_inputs, self.length_scales)
+        outputs = kernel @ self.weights * self.output_std + self.output_mean
+        variance = np.maximum(1.0 + self.noise - np.sum((kernel @ self.inverse) * kernel, axis=1), 0.0)
+        stds = np.sqrt(variance[:, np.newaxis] * self.variance_scale) * self.output_std
+        outputs[:, OUTPUT_NAMES.index("hypoxic_fraction")] = np.clip(
+            outputs[:, OUTPUT_NAMES.index("hypoxic_fraction")], 0.0, 1.0)
+        return outputs, stds
+
+    def is_in_range(self, inputs):
+        """ Returns whether each of an array of inputs is within the range of the training points, give or take
+        RANGE_MARGIN. """
+        scaled_inputs = self._scale_inputs(np.asarray(inputs, dtype=float).reshape(-1, len(INPUT_NAMES)))
+        return np.all((scaled_inputs >= -RANGE_MARGIN) & (scaled_inputs <= 1 + RANGE_MARGIN), axis=1)
+
+    def query(self, params_list, max_std=None, fallback=None):
+        """ Returns the predicted outputs for each parameter set in params_list, as a dict with the value and the
+        standard deviation ("<name>_std") of each output, whether it can be trusted ("trusted") and whether it came
+        from the solver ("from_solver").
+
+        A prediction is trusted if the parameters are within the range of the training points and the standard
+        deviation of each output is within max_std, which defaults to DEFAULT_MAX_STD.  If fallback is given, the
+        parameter sets whose predictions aren't trusted are passed to it instead (see integrate_fallback), and the
+        results, which are trusted, are returned and added to the training points.  Otherwise the untrusted
+        predictions are returned as they are.
+        """
+        max_std = dict(DEFAULT_MAX_STD, **(max_std or {}))
+        inputs = get_inputs(params_list)
+        outputs, stds = self.predict(inputs)
+
+        is_trusted = self.is_in_range(inputs)
+        for j, name in enumerate(OUTPUT_NAMES):
+            is_trusted &= stds[:, j] <= max_std[name]
+
+        query_results = []
+        for i in range(len(params_list)):
+            query_result = {"trusted": bool(is_trusted[i]), "from_solver": False}
+            for j, name in enumerate(OUTPUT_NAMES):
+                query_result[name] = outputs[i, j]
+                query_result[name + "_std"] = stds[i, j]
+            query_results.append(query_result)
+
+        untrusted = np.flatnonzero(~is_trusted) if fallback is not None else []
+        for i in untrusted:
+            solved_outputs = get_outputs([fallback(params_list[i])])[0]
+            self.add(inputs[i], solved_outputs)
+            query_results[i] = {"trusted": True, "from_solver": True}
+            for j, name in enumerate(OUTPUT_NAMES):
+                query_results[i][name] = solved_outputs[j]
+                query_results[i][name + "_std"] = 0.0
+
+        if len(untrusted) > 0:
+            self.fit(optimize=False)
+
+        return query_results
+
+    def print_cross_validation_error(self):
+        print("Surrogate with {} training points, leave-one-out RMS error:".format(len(self.inputs)))
+        for name in OUTPUT_NAMES:
+            print("  {}: {:.4g}".format(name, self.cross_validation_error[name]))
+
+
+def load_surrogate(file_name):
+    return load_results(file_name)
+
+
+def save_surrogate(file_name, surrogate):
+    save_results(file_name, surrogate)
+
+
+if __name__ == "__main__":
+    # Usage: python surrogate.py SURROGATE_FILE CSV_FILE [CSV_FILE ...]
+    # Trains a surrogate on the results in the CSV files, such as random_grid_results.csv, and saves it.
+    if len(sys.argv) < 3:
+        print("Usage: python surrogate.py SURROGATE_FILE CSV_FILE [CSV_FILE ...]")
+        sys.exit(1)
+
+    surrogate = Surrogate()
+    for csv_file_name in sys.argv[2:]:
+        surrogate.add(*load_csv(csv_file_name))
+    surrogate.fit()
+    surrogate.print_cross_validation_error()
+
+    save_surrogate(sys.argv[1], surrogate)
+    print("Saved to '{}'.".format(sys.argv[1]))
@@ -14,4 +14,9 @@ def get_units():
         units.define("mlO2 = [volumeO2]")
         pint._APP_REGISTRY = units
 
+        # Newer versions of pint ignore _APP_REGISTRY, and quantities unpickled in another process are only
+        # understood if they use the application registry.
+        if hasattr(pint, "set_application_registry"):
+            pint.set_application_registry(units)
+
     return units
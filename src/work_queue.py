@@ -0,0 +1,283 @@
+import contextlib
+import os
+import pickle
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from data import get_job_key
+from evaluate import evaluate_points
+
+
+# How long a claimed job stays claimed without its worker renewing the lease, after which it is given to another
+# worker.  Workers renew their leases every third of this while they are working.
+DEFAULT_LEASE_SECONDS = 600
+
+# How many times a job is tried before it is marked as failed.
+DEFAULT_MAX_ATTEMPTS = 3
+
+# How long a worker waits before looking for work again when all the jobs that are left are claimed by others.
+POLL_SECONDS = 5
+
+
+class WorkQueue:
+    """ A queue of grid points in an SQLite database, shared by any number of worker processes on any host.
+
+    Each point is a job, keyed by get_job_key so that the same point is only solved once.  A worker claims jobs with
+    a lease, renews the lease while it works, and commits the results of each job when it finishes.  If a worker
+    crashes, its lease runs out and the jobs go back to the other workers.  The database can be on a shared
+    filesystem, as long as the filesystem supports the file locks that SQLite uses.
+    """
+
+    def __init__(self, file_name, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.file_name = file_name
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+        # Each transaction that changes the queue takes the database lock straight away with BEGIN IMMEDIATE, so
+        # two workers never claim the same job.
+        self.connection = sqlite3.connect(file_name, timeout=60, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self._transaction() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    key TEXT PRIMARY KEY,
+                    position INTEGER,
+                    params BLOB,
+                    state TEXT,
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER,
+                    result BLOB,
+                    error TEXT
+                )""")
+            cursor.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, position)")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+
+    def enqueue(self, params_list):
+        """ Adds a job for each parameter set in params_list that isn't in the queue yet, and returns the keys of
+        all of them. """
+        keys = [get_job_key(params) for params in params_list]
+        with self._transaction() as cursor:
+            position = cursor.execute("SELECT COALESCE(MAX(position), -1) + 1 FROM jobs").fetchone()[0]
+            for key, params in zip(keys, params_list):
+                cursor.execute("INSERT OR IGNORE INTO jobs (key, position, params, state, attempts) "
+                               "VALUES (?, ?, ?, 'pending', 0)",
+                               (key, position, pickle.dumps(params, pickle.HIGHEST_PROTOCOL)))
+                position += 1
+        return keys
+
+    def claim(self, count=1):
+        """ Claims up to count jobs that are pending or whose lease has run out, and returns their keys and
+        parameters.
+
+        A job that has already been claimed max_attempts times is marked as failed instead.  That is how jobs whose
+        worker died, e.g. because the solve ran out of memory, stop being retried.
+        """
+        now = time.time()
+        jobs = []
+        with self._transaction() as cursor:
+            while len(jobs) < count:
+                rows = cursor.execute("SELECT key, params, attempts FROM jobs WHERE state = 'pending' OR "
+                                      "(state = 'claimed' AND lease_expires < ?) ORDER BY position LIMIT ?",
+                                      (now, count - len(jobs))).fetchall()
+                if len(rows) == 0:
+                    break
+                for key, params, attempts in rows:
+                    if attempts >= self.max_attempts:
+                        cursor.execute("UPDATE jobs SET state = 'failed', error = COALESCE(error, ?) WHERE key = ?",
+                                       ("Not finished after {} attempts".format(attempts), key))
+                    else:
+                        cursor.execute("UPDATE jobs SET state = 'claimed', worker = ?, lease_expires = ?, "
+                                       "attempts = attempts + 1 WHERE key = ?",
+                                       (self.worker_id, now + self.lease_seconds, key))
+                        jobs.append((key, pickle.loads(params)))
+        return jobs
+
+    def renew(self, keys):
+        """ Extends the leases of the jobs in keys that this worker still holds. """
+        with self._transaction() as cursor:
+            for key in keys:
+                cursor.execute("UPDATE jobs SET lease_expires = ? WHERE key = ? AND state = 'claimed' AND "
+                               "worker = ?", (time.time() + self.lease_seconds, key, self.worker_id))
+
+    def complete(self, key, result):
+        """ Commits the results of a job.  The first results for a job are kept, even if its lease ran out and
+        another worker solved it too. """
+        with self._transaction() as cursor:
+            cursor.execute("UPDATE jobs SET state = 'done', worker = ?, result = ?, error = NULL "
+                           "WHERE key = ? AND state != 'done'",
+                           (self.worker_id, pickle.dumps(result, pickle.HIGHEST_PROTOCOL), key))
+
+    def release(self, keys):
+        """ Gives the jobs in keys that this worker still holds back to the queue, without blaming them for an
+        error.  They still count the attempt. """
+        with self._transaction() as cursor:
+            for key in keys:
+                cursor.execute("UPDATE jobs SET state = 'pending', worker = NULL, lease_expires = NULL "
+                               "WHERE key = ? AND state = 'claimed' AND worker = ?", (key, self.worker_id))
+
+    def fail(self, key, error):
+        """ Gives a job back to the queue after an error, or marks it as failed once it has been tried
+        max_attempts times. """
+        with self._transaction() as cursor:
+            cursor.execute("UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                           "error = ? WHERE key = ? AND state = 'claimed' AND worker = ?",
+                           (self.max_attempts, str(error), key, self.worker_id))
+
+    def get_counts(self):
+        """ Returns the number of jobs in each state. """
+        with self.lock:
+            rows = self.connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        counts = {"pending": 0, "claimed": 0, "done": 0, "failed": 0}
+        counts.update(dict(rows))
+        return counts
+
+    def get_failures(self):
+        """ Returns the key and error of each failed job. """
+        with self.lock:
+            return self.connection.execute("SELECT key, error FROM jobs WHERE state = 'failed' "
+                                           "ORDER BY position").fetchall()
+
+    def is_done(self, keys):
+        """ Returns whether every job in keys is done or failed. """
+        with self.lock:
+            return all(self.connection.execute("SELECT state IN ('done', 'failed') FROM jobs WHERE key = ?",
+                                               (key,)).fetchone()[0] for key in keys)
+
+    def load(self, key):
+        """ Returns the results of a job that is done. """
+        with self.lock:
+            row = self.connection.execute("SELECT result FROM jobs WHERE key = ? AND state = 'done'",
+                                          (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def close(self):
+        self.connection.close()
+
+
+def run_worker(queue, num_cores=None, claim_size=None, exit_when_idle=True, keys=None):
+    """ Claims and solves jobs from queue until there are none left, using evaluate_points on num_cores cores.
+
+    Each claim takes up to claim_size jobs, which defaults to twice the number of cores so that the searches of one
+    point can overlap with the solves of the next.  The leases are renewed by a background thread while the jobs
+    are solved.  When the only jobs left are claimed by other workers, the worker waits for them in case one of the
+    leases runs out, unless exit_when_idle.  If keys is given, the worker stops once all of those jobs are done or
+    failed.
+    """
+    if claim_size is None:
+        claim_size = 2 * (num_cores or os.cpu_count())
+
+    while True:
+        if keys is not None and queue.is_done(keys):
+            return
+
+        jobs = queue.claim(claim_size)
+        if len(jobs) == 0:
+            counts = queue.get_counts()
+            if counts["claimed"] == 0 or (exit_when_idle and keys is None):
+                return
+            time.sleep(POLL_SECONDS)
+            continue
+
+        unfinished = {key for key, _ in jobs}
+        params_list = [params for _, params in jobs]
+
+        # The point results hold the same params object that was passed to evaluate_points, so they can be matched
+        # to their jobs even if the job numbers of points from different sweeps clash.
+        keys_by_params_id = {id(params): key for key, params in jobs}
+
+        stop_renewing = threading.Event()
+
+        def renew_leases():
+            while not stop_renewing.wait(queue.lease_seconds / 3):
+                queue.renew(list(unfinished))
+
+        renew_thread = threading.Thread(target=renew_leases, daemon=True)
+        renew_thread.start()
+
+        def commit_point_results(point_results):
+            key = keys_by_params_id[id(point_results["params"])]
+            queue.complete(key, point_results)
+            unfinished.discard(key)
+
+        def fail_point(params, error):
+            key = keys_by_params_id[id(params)]
+            queue.fail(key, repr(error))
+            unfinished.discard(key)
+
+        try:
+            evaluate_points(params_list, num_cores=num_cores, on_point_done=commit_point_results,
+                            on_point_failed=fail_point, return_results=False)
+        except Exception as e:
+            # Not the fault of any one job, e.g. a solve killed its worker process.  The jobs that are left go back
+            # to the queue, and claim fails any that keep doing this.
+            queue.release(list(unfinished))
+            print("Worker {}: {} jobs given back to the queue after: {!r}".format(queue.worker_id, len(unfinished),
+                                                                                  e))
+        finally:
+            stop_renewing.set()
+            renew_thread.join()
+
+
+def evaluate_points_with_queue(queue, params_list, num_cores=None, on_point_done=None):
+    """ Like evaluate_points, but the points go through queue, so that workers on other hosts can help solve them.
+
+    This process works on the queue as well, and then waits for the other workers to finish the rest.  Points that
+    are already done in the queue aren't solved again.  Returns the results for each point in params_list.
+    """
+    keys = queue.enqueue(params_list)
+    run_worker(queue, num_cores=num_cores, keys=keys)
+
+    failures = [(key, error) for key, error in queue.get_failures() if key in set(keys)]
+    if len(failures) > 0:
+        raise RuntimeError("{} jobs failed, the first with: {}".format(len(failures), failures[0][1]))
+
+    results_list = []
+    for key, params in zip(keys, params_list):
+        results = queue.load(key)
+        if on_point_done is not None:
+            on_point_done(results)
+        results_list.append(results)
+    return results_list
+
+
+if __name__ == "__main__":
+    # Usage: python work_queue.py worker QUEUE_FILE [--cores=N] [--lease=SECONDS] [--wait]
+    #        python work_queue.py status QUEUE_FILE
+    # Workers solve the jobs that main.py or random_grid.py put in the queue with --queue=QUEUE_FILE.  With --wait,
+    # a worker keeps waiting while other workers hold jobs, so that it can take over any whose lease runs out.
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    options = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if arg.startswith("--") and "=" in arg)
+
+    if len(args) != 2 or args[0] not in ("worker", "status"):
+        print("Usage: python work_queue.py worker|status QUEUE_FILE [--cores=N] [--lease=SECONDS] [--wait]")
+        sys.exit(1)
+
+    queue = WorkQueue(args[1], lease_seconds=float(options.get("lease", DEFAULT_LEASE_SECONDS)))
+    if args[0] == "worker":
+        num_cores = int(options["cores"]) if "cores" in options else None
+        print("Worker {} started.".format(queue.worker_id))
+        run_worker(queue, num_cores=num_cores, exit_when_idle="--wait" not in sys.argv[1:])
+
+    counts = queue.get_counts()
+    print("Jobs: {} pending, {} claimed, {} done, {} failed.".format(counts["pending"], counts["claimed"],
+                                                                   counts["done"], counts["failed"]))
+    for key, error in queue.get_failures():
+        print("  {} failed: {}".format(key, error))
@@ -0,0 +1,16 @@
+import os
+import sys
+import pytest
+
+# The modules in src import each other as top-level modules, as when they are run from there.
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, SRC_DIR)
+
+from parameters import Parameters, create_param_grid, load_param_values  # noqa: E402
+
+
+@pytest.fixture
+def basic_params():
+    """ The first grid point of basic_params.json, without test mode or progress reports. """
+    params = create_param_grid(Parameters(load_param_values(os.path.join(SRC_DIR, "basic_params.json"))))[0]
+    return dict(params, test=False, report_interval=10 ** 9)
@@ -0,0 +1,42 @@
+import pytest
+import compiled_solver
+import solver
+from solver import get_grid_size, integrate
+
+RESULTS = ["pbO2", "hypoxic_fraction", "jugular_venous_o2_sat", "pavO2"]
+
+
+def _value(quantity):
+    return float(getattr(quantity, "magnitude", quantity))
+
+
+def test_compiled_agrees_with_march_and_newton(basic_params):
+    pytest.importorskip("numba")
+    params = dict(basic_params, r_steps=20, z_steps=50)
+    compiled_results = compiled_solver.integrate_compiled(**params)
+    newton_results = integrate(**dict(params, engine="newton"))
+    march_results = integrate(**dict(params, engine="march"))
+
+    # The Newton engine solves the same finite differences, so only the Newton tolerances separate them.  The
+    # march engine's solve_bvp slices differ by the discretisation error, which is about 0.06% with 50 radial steps
+    # and falls with the square of the step.
+    r_steps, _ = get_grid_size(params["r_steps"], params["z_steps"], params["r_Krogh"])
+    march_tolerance = 2e-3 * (50 / r_steps) ** 2
+    for name in RESULTS:
+        compiled_value = _value(compiled_results[name])
+        assert compiled_value == pytest.approx(_value(newton_results[name]), rel=1e-4, abs=1e-4), name
+        assert compiled_value == pytest.approx(_value(march_results[name]), rel=march_tolerance,
+                                               abs=march_tolerance), name
+
+
+def test_compiled_engine_falls_back_to_march_without_numba(basic_params, monkeypatch, capsys):
+    monkeypatch.setattr(compiled_solver, "numba", None)
+    solver._warn_no_numba.cache_clear()
+    params = dict(basic_params, r_steps=10, z_steps=20)
+
+    compiled_results = integrate(**dict(params, engine="compiled"))
+    assert "falls back to the march engine" in capsys.readouterr().out
+
+    march_results = integrate(**dict(params, engine="march"))
+    for name in RESULTS:
+        assert _value(compiled_results[name]) == _value(march_results[name]), name
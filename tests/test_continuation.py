@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from continuation import get_continuation_stats, integrate_chain, seeded_integrate
+from evaluate import search
+
+RESULTS = ["pbO2", "hypoxic_fraction", "jugular_venous_o2_sat"]
+
+
+def _value(quantity):
+    return float(getattr(quantity, "magnitude", quantity))
+
+
+@pytest.fixture
+def small_params(basic_params):
+    return dict(basic_params, r_steps=20, z_steps=50, continuation=True)
+
+
+def test_seeded_solve_agrees_with_cold_solve_in_fewer_iterations(small_params):
+    seed_results = seeded_integrate(dict(small_params, paO2=small_params["paO2"] * 1.05))
+    cold_results = seeded_integrate(small_params)
+    seeded_results = seeded_integrate(small_params, seed_results)
+
+    for name in RESULTS:
+        assert _value(seeded_results[name]) == pytest.approx(_value(cold_results[name]), rel=1e-3, abs=1e-4), name
+    assert np.sum(seeded_results["slice_iterations"]) < np.sum(cold_results["slice_iterations"])
+
+
+def test_search_starts_from_the_base_pressure_field(small_params):
+    base_results, = integrate_chain([small_params], keep_pressure_fields=[True])
+    assert base_results["p"] is not None
+
+    stats_before = get_continuation_stats()
+    search_results, _, evaluations = search(small_params, "paO2", 1.05, base_results)
+    stats_after = get_continuation_stats()
+
+    assert evaluations > 0
+    assert stats_after["cold_solves"] == stats_before["cold_solves"]
+    assert stats_after["seeded_solves"] - stats_before["seeded_solves"] == evaluations
+    assert search_results["p"] is None
+
+
+def test_chain_leaves_out_the_pressure_fields_it_doesnt_keep(small_params):
+    chain_params = [small_params, dict(small_params, paO2=small_params["paO2"] * 1.05)]
+    results_list = integrate_chain(chain_params)
+    assert all(results["p"] is None for results in results_list)
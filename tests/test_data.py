@@ -0,0 +1,53 @@
+import os
+import numpy as np
+from data import ResultsTable, save_results_table
+from units import get_units
+
+
+def get_result(row, r_steps):
+    units = get_units()
+    p = np.arange(2.0 * r_steps).reshape(2, r_steps) + row
+    return {
+        "params": {"paO2": (100 + row) * units.mmHg, "r_steps": r_steps, "engine": "march",
+                   "cache_dir": "integrate_cache", "cache_max_bytes": 1e9},
+        "base_results": {"pbO2": (10.0 + row) * units.mmHg, "p": p * units.mmHg, "bvp_iterations": 3,
+                         "slice_iterations": np.ones(2, dtype=int), "slice_nodes": np.ones(2, dtype=int)},
+        "paO2_results": {"pbO2": None, "p": None},
+    }
+
+
+def test_results_table_keeps_numeric_columns_and_stacks_fields(tmp_path):
+    results = [get_result(0, 3), get_result(1, 4)]
+    # The same results, as when paO2_multiple is 1.
+    results[1]["paO2_results"] = results[1]["base_results"]
+    directory = str(tmp_path / "table")
+    save_results_table(directory, iter(results))
+
+    table = ResultsTable(directory)
+    assert len(table) == 2
+    assert sorted(table.columns) == ["base_results.bvp_iterations", "base_results.pbO2",
+                                     "paO2_results.bvp_iterations", "paO2_results.pbO2", "params.paO2",
+                                     "params.r_steps"]
+    assert np.array_equal(table.get_column("base_results.pbO2"), [10.0, 11.0])
+    assert np.isnan(table.get_column("paO2_results.pbO2")[0])
+    assert table.get_column("params.paO2", with_units=True)[1] == 101 * get_units().mmHg
+
+    # One file for each field, holding every row, with arrays that are shared between fields stored once.
+    assert sorted(os.listdir(os.path.join(directory, "fields"))) == ["base_results.p.npy"]
+    for row, result in enumerate(results):
+        assert np.array_equal(table.get_field("base_results.p", row), result["base_results"]["p"].magnitude)
+    assert table.get_field("paO2_results.p", 0) is None
+    shared_field = table.get_field("paO2_results.p", 1, with_units=True)
+    assert shared_field.units == get_units().mmHg
+    assert np.array_equal(shared_field.magnitude, results[1]["base_results"]["p"].magnitude)
+
+
+def test_results_table_compressed_fields(tmp_path):
+    results = [get_result(row, 3) for row in range(3)]
+    directory = str(tmp_path / "table")
+    save_results_table(directory, results, compress_fields=True)
+
+    table = ResultsTable(directory)
+    assert os.listdir(os.path.join(directory, "fields")) == ["base_results.p.npz"]
+    for row, result in enumerate(results):
+        assert np.array_equal(table.get_field("base_results.p", row), result["base_results"]["p"].magnitude)
@@ -0,0 +1,27 @@
+import pytest
+from resolution import integrate_to_tolerance
+from units import get_units
+
+
+def first_order_results(r_steps, z_steps, r_Krogh):
+    # Results whose error is first order in the step size, as the solver's is.
+    return {
+        "pbO2": 20.0 + 10.0 / r_steps,
+        "hypoxic_fraction": 0.1 + 1.0 / z_steps,
+        "jugular_venous_o2_sat": 90.0 + 10.0 / z_steps,
+    }
+
+
+def test_reports_scaled_step_counts():
+    params = {"r_steps": 40, "z_steps": 80, "r_Krogh": 30 * get_units().um}
+    results = integrate_to_tolerance(first_order_results, params, resolution_tol=1e-12, resolution_levels=3)
+
+    # The finest grid, scaled by r_Krogh / 20um as in solver.get_grid_size.
+    assert (results["r_steps_used"], results["z_steps_used"]) == (60, 120)
+    assert results["pbO2_extrapolated"] == pytest.approx(20.0)
+
+
+def test_rejects_a_single_level():
+    params = {"r_steps": 40, "z_steps": 80, "r_Krogh": 20 * get_units().um}
+    with pytest.raises(ValueError):
+        integrate_to_tolerance(first_order_results, params, resolution_tol=1e-3, resolution_levels=1)
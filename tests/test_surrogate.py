@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from parameters import from_plain_values
+from surrogate import INPUT_NAMES, OUTPUT_NAMES, Surrogate
+
+
+def get_outputs(inputs):
+    # A smooth stand-in for the solver, with outputs in a realistic range.
+    inputs = np.asarray(inputs, dtype=float).reshape(-1, len(INPUT_NAMES))
+    pbO2 = 0.2 * inputs[:, INPUT_NAMES.index("paO2")]
+    return np.stack([pbO2, np.full(len(inputs), 0.1), 90.0 + 0.01 * pbO2], axis=1)
+
+
+def get_params(inputs):
+    return from_plain_values(dict(zip(INPUT_NAMES, inputs)))
+
+
+def get_surrogate():
+    # Points spread over the same range of every input, from 1 to 2 in the units of the parameter files.
+    rng = np.random.default_rng(0)
+    inputs = 1 + rng.random((40, len(INPUT_NAMES)))
+    inputs[:, INPUT_NAMES.index("paO2")] *= 100
+    surrogate = Surrogate()
+    surrogate.add(inputs, get_outputs(inputs))
+    surrogate.fit()
+    return surrogate
+
+
+def test_query_flags_untrusted_predictions_without_fallback():
+    surrogate = get_surrogate()
+    inside = np.array([1.5] * len(INPUT_NAMES))
+    inside[INPUT_NAMES.index("paO2")] = 150
+    outside = inside.copy()
+    outside[INPUT_NAMES.index("D")] = 10.0
+
+    query_results = surrogate.query([get_params(inside), get_params(outside)])
+
+    assert [query_result["trusted"] for query_result in query_results] == [True, False]
+    assert not any(query_result["from_solver"] for query_result in query_results)
+    assert query_results[0]["pbO2"] == pytest.approx(30.0, abs=0.5)
+
+
+def test_query_solves_untrusted_predictions_with_fallback():
+    surrogate = get_surrogate()
+    num_points = len(surrogate.inputs)
+    outside = np.array([1.5] * len(INPUT_NAMES))
+    outside[INPUT_NAMES.index("paO2")] = 400
+
+    solved = []
+
+    def fallback(params):
+        solved.append(params)
+        return dict(zip(OUTPUT_NAMES, get_outputs([outside])[0]))
+
+    (query_result,) = surrogate.query([get_params(outside)], fallback=fallback)
+
+    assert len(solved) == 1
+    assert query_result["trusted"] and query_result["from_solver"]
+    assert query_result["pbO2"] == 80.0
+    assert len(surrogate.inputs) == num_points + 1
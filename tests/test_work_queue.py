@@ -0,0 +1,124 @@
+import collections
+import threading
+import time
+import pytest
+import work_queue
+from work_queue import WorkQueue, run_worker
+
+
+class FakeJobs:
+    """ Stands in for evaluate_points, solving each point in this process straight away.  Points with "fail" set
+    raise, and the number of times each point is solved is counted. """
+
+    def __init__(self, seconds_per_point=0.0):
+        self.seconds_per_point = seconds_per_point
+        self.solved = collections.Counter()
+        self.lock = threading.Lock()
+
+    def __call__(self, params_list, num_cores=None, on_point_done=None, on_point_failed=None, return_results=True):
+        for params in params_list:
+            with self.lock:
+                self.solved[params["index"]] += 1
+            time.sleep(self.seconds_per_point)
+            if params.get("fail", False):
+                on_point_failed(params, ValueError("bad point {}".format(params["index"])))
+            else:
+                on_point_done({"params": params, "value": 2 * params["index"]})
+
+
+@pytest.fixture
+def fake_jobs(monkeypatch):
+    jobs = FakeJobs(seconds_per_point=0.01)
+    monkeypatch.setattr(work_queue, "evaluate_points", jobs)
+    return jobs
+
+
+def get_attempts(queue, key):
+    return queue.connection.execute("SELECT attempts FROM jobs WHERE key = ?", (key,)).fetchone()[0]
+
+
+def test_every_job_completes_exactly_once(tmp_path, fake_jobs):
+    file_name = str(tmp_path / "queue.sqlite")
+    queue = WorkQueue(file_name)
+    params_list = [{"index": i} for i in range(24)]
+    keys = queue.enqueue(params_list)
+
+    workers = [threading.Thread(target=run_worker, args=(WorkQueue(file_name),), kwargs={"claim_size": 2})
+               for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert queue.get_counts() == {"pending": 0, "claimed": 0, "done": 24, "failed": 0}
+    assert fake_jobs.solved == {i: 1 for i in range(24)}
+    for key, params in zip(keys, params_list):
+        assert queue.load(key)["value"] == 2 * params["index"]
+        assert get_attempts(queue, key) == 1
+
+
+def test_failed_job_fails_only_itself(tmp_path, fake_jobs):
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"), max_attempts=2)
+    params_list = [{"index": i} for i in range(8)]
+    params_list[0]["fail"] = True
+    keys = queue.enqueue(params_list)
+
+    # The bad job is claimed together with the others, so they are still to be solved when it fails.
+    run_worker(queue, claim_size=4)
+
+    assert [key for key, _ in queue.get_failures()] == [keys[0]]
+    assert "bad point 0" in queue.get_failures()[0][1]
+    assert queue.get_counts()["done"] == 7
+    assert fake_jobs.solved[0] == 2
+    for key in keys[1:]:
+        assert get_attempts(queue, key) == 1
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    file_name = str(tmp_path / "queue.sqlite")
+    crashed_worker = WorkQueue(file_name, lease_seconds=0.01)
+    (key,) = crashed_worker.enqueue([{"index": 0}])
+    assert [claimed_key for claimed_key, _ in crashed_worker.claim()] == [key]
+
+    other_worker = WorkQueue(file_name)
+    time.sleep(0.05)
+    assert [claimed_key for claimed_key, _ in other_worker.claim()] == [key]
+    assert get_attempts(other_worker, key) == 2
+
+    # The first worker no longer holds the job, so it can't renew it or fail it.
+    crashed_worker.renew([key])
+    crashed_worker.fail(key, "too late")
+    assert other_worker.claim() == []
+    other_worker.complete(key, {"value": 0})
+    assert other_worker.get_counts()["done"] == 1
+
+
+def test_abandoned_job_fails_after_max_attempts(tmp_path):
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"), lease_seconds=0.01, max_attempts=2)
+    queue.enqueue([{"index": 0}])
+    attempts = 0
+    while attempts <= queue.max_attempts and queue.claim():
+        attempts += 1
+        time.sleep(0.05)
+
+    assert attempts == 2
+    assert queue.get_counts()["failed"] == 1
+
+
+def test_worker_error_retries_jobs_until_max_attempts(tmp_path, monkeypatch):
+    calls = []
+
+    def broken_pool(params_list, **kwargs):
+        calls.append(len(params_list))
+        raise RuntimeError("worker process died")
+
+    # An error that isn't any one job's fault gives the jobs back to the queue, where they are claimed again until
+    # claim fails them.
+    monkeypatch.setattr(work_queue, "evaluate_points", broken_pool)
+    queue = WorkQueue(str(tmp_path / "queue.sqlite"), max_attempts=3)
+    queue.enqueue([{"index": i} for i in range(3)])
+    run_worker(queue, claim_size=3)
+
+    assert calls == [3, 3, 3]
+    assert queue.get_counts()["failed"] == 3
+    assert all(error == "Not finished after 3 attempts" for _, error in queue.get_failures())